@@ -1,3 +1,4 @@
+drop table if exists "SchemaMigration" cascade;
 drop table if exists "User" cascade;
 drop table if exists "Order" cascade;
 drop table if exists "Address" cascade;
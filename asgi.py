@@ -0,0 +1,331 @@
+# ===================================================================================================
+# Dependencies
+# ===================================================================================================
+import asyncio
+import inspect
+import time
+from functools import wraps
+
+from a2wsgi import WSGIMiddleware
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import HTTPException
+from werkzeug.sansio.request import Request
+from werkzeug.sansio.response import Response
+
+import async_db_api
+import db_api
+import main
+import metrics
+
+# ===================================================================================================
+# ASGI application
+# ===================================================================================================
+# main.py的ASGI入口：uvicorn asgi:application
+# URL仍由main.app的路由表匹配。/events和JSON接口的读取路由在事件循环中处理，通过async_db_api访问数据库，
+# 等待数据库和事件时不占用线程；其余路由（页面、表单、上传和静态文件）交给线程池中的Flask处理，行为与WSGI模式相同。
+# 两种处理方式共用session cookie、缓存、ETag和指标。
+WSGI_THREADS = 20  # 运行Flask路由的线程数
+ASYNC_METHODS = ('GET', 'HEAD')  # 异步处理的请求方法，其他方法（如OPTIONS）交给Flask
+ROUTES = {}  # 路由名 -> 异步处理函数(request, session, **路由参数)
+
+
+class AsyncRequest(Request):
+    """
+    由ASGI scope构造的请求，只包含请求头和URL，异步处理的路由都不读取请求体。
+    """
+
+    def __init__(self, scope):
+        root_path = scope.get('root_path', '')
+        path = scope['path']
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        client = scope.get('client')
+        super().__init__(scope['method'], scope.get('scheme', 'http'), scope.get('server'), root_path, path,
+                         scope['query_string'],
+                         Headers([(key.decode('latin-1'), value.decode('latin-1')) for key, value in scope['headers']]),
+                         client[0] if client else None)
+        self.url_adapter = main.app.url_map.bind(self.host, script_name=root_path or None,
+                                                 url_scheme=self.scheme)
+        self.endpoint = None
+
+
+class AsyncResponse(Response):
+    """
+    带响应体的响应，body为bytes、str，或产生str的异步迭代器（流式响应）。
+    """
+
+    def __init__(self, body=b'', status=200, mimetype='text/html'):
+        super().__init__(status=status, mimetype=mimetype)
+        self.body = body.encode('utf-8') if isinstance(body, str) else body
+        self._on_close = []
+
+    def call_on_close(self, func):
+        """
+        响应发送完毕或客户端断开后调用func。
+        """
+        self._on_close.append(func)
+
+    def close(self):
+        for func in self._on_close:
+            func()
+
+
+def route(endpoint):
+    """
+    注册main.app中某个路由的异步处理函数。
+    """
+    def decorator(func):
+        ROUTES[endpoint] = func
+        return func
+
+    return decorator
+
+
+def jsonify(data, status=200):
+    # 与flask.jsonify的输出相同
+    return AsyncResponse(main.app.json.dumps(data, separators=(',', ':')) + '\n', status, main.app.json.mimetype)
+
+
+def redirect(location):
+    response = AsyncResponse(status=302)
+    response.headers['Location'] = location
+    return response
+
+
+def login_required(func):
+    @wraps(func)
+    async def wrapper(request, session, **kwargs):
+        if 'logged_in' not in session or not session['logged_in']:
+            return redirect(request.url_adapter.build('login') + '?next=' + request.url)
+        return await func(request, session, **kwargs)
+
+    return wrapper
+
+
+def api_login_required(func):
+    @wraps(func)
+    async def wrapper(request, session, **kwargs):
+        if 'logged_in' not in session or not session['logged_in']:
+            return jsonify({'error': '请先登录！'}, 401)
+        return await func(request, session, **kwargs)
+
+    return wrapper
+
+
+async def api_response(request, etag, load):
+    """
+    同main.api_response，load可以返回协程。
+    """
+    if request.if_none_match.contains_weak(etag):
+        response = AsyncResponse(status=304)
+    else:
+        data = load()
+        if inspect.isawaitable(data):
+            data = await data
+        if data is None:
+            return jsonify({'error': '资源不存在！'}, 404)
+        response = AsyncResponse(main.api_json(data), mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+
+
+@route('events')
+@login_required
+async def events(request, session):
+    """
+    同main.events。每个连接只占用一个协程和一个订阅队列。
+    """
+    user_id = session.get('user_id')
+    goods_id = request.args.get('goods_id', type=int)
+    orders_version = request.args.get('orders_version', type=int)
+    comments_version = request.args.get('comments_version')
+    subscription = await async_db_api.subscribe_events(user_id, goods_id)
+    try:
+        if orders_version is not None:
+            versions = await async_db_api.get_user_versions(user_id)
+            if versions is not None and versions['orders_version'] != orders_version:
+                subscription.put({'type': 'order'})
+        if goods_id is not None and comments_version is not None:
+            versions = await async_db_api.get_goods_versions(goods_id)
+            if versions is not None and versions['comments_version'] != comments_version:
+                subscription.put({'type': 'comment', 'goods_id': goods_id})
+    except BaseException:
+        subscription.close()
+        raise
+
+    async def stream():
+        yield 'retry: %d\n\n' % (main.EVENT_RETRY * 1000)
+        while True:
+            event = await subscription.get(main.EVENT_HEARTBEAT)
+            yield main.format_event(event)
+
+    response = AsyncResponse(stream(), mimetype='text/event-stream')
+    response.call_on_close(subscription.close)
+    response.cache_control.no_cache = True
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@route('api_goods_list')
+@api_login_required
+async def api_goods_list(request, session):
+    key, exempt_postage, state, price = main.normalize_goods_query(request.args.get('key', ''),
+                                                                   request.args.get('exempt_postage', 'all'),
+                                                                   request.args.get('state', 'all'),
+                                                                   request.args.get('price', 'asc'))
+    cursor = request.args.get('cursor')
+    etag = main.api_etag(await async_db_api.get_goods_list_version(), key, exempt_postage, state, price, cursor,
+                         endpoint=request.endpoint)
+    return await api_response(request, etag,
+                              lambda: async_db_api.get_goods_page(key, exempt_postage, state, price, cursor))
+
+
+@route('api_goods_detail')
+@api_login_required
+async def api_goods_detail(request, session, goods_id):
+    versions = await async_db_api.get_goods_versions(goods_id)
+    if versions is None:
+        return jsonify({'error': '该商品不存在！'}, 404)
+    etag = main.api_etag(goods_id, versions['version'], versions['apply_count'], endpoint=request.endpoint)
+    return await api_response(request, etag, lambda: async_db_api.get_goods_detail.uncached(goods_id))
+
+
+@route('api_comments')
+@api_login_required
+async def api_comments(request, session, goods_id):
+    versions = await async_db_api.get_goods_versions(goods_id)
+    if versions is None:
+        return jsonify({'error': '该商品不存在！'}, 404)
+    order, cursor = request.args.get('order', 'asc'), request.args.get('cursor')
+    etag = main.api_etag(goods_id, versions['comments_version'], order, cursor, endpoint=request.endpoint)
+    return await api_response(request, etag, lambda: async_db_api.get_comment_page(goods_id, order, cursor))
+
+
+@route('api_orders')
+@api_login_required
+async def api_orders(request, session):
+    user_id = session.get('user_id')
+    versions = await async_db_api.get_user_versions(user_id)
+    if versions is None:
+        return jsonify({'error': '用户不存在！'}, 404)
+    args = [request.args.get(name) for name in ('from_state', 'from_cursor', 'to_state', 'to_cursor')]
+
+    async def load():
+        page = await async_db_api.get_manage_order_page(user_id, *args)
+        return {'orders_from_user': page['orders_from_user'], 'orders_to_user': page['orders_to_user']}
+
+    return await api_response(request, main.api_etag(user_id, versions['orders_version'], *args,
+                                                     endpoint=request.endpoint), load)
+
+
+@route('api_addresses')
+@api_login_required
+async def api_addresses(request, session):
+    user_id = session.get('user_id')
+    versions = await async_db_api.get_user_versions(user_id)
+    if versions is None:
+        return jsonify({'error': '用户不存在！'}, 404)
+    etag = main.api_etag(user_id, versions['addresses_version'], endpoint=request.endpoint)
+    return await api_response(request, etag, lambda: async_db_api.get_address_list.uncached(user_id))
+
+
+async def send_response(response, request, receive, send):
+    """
+    发送响应。流式响应一直发送到迭代结束或客户端断开。
+    """
+    streaming = not isinstance(response.body, bytes)
+    if not streaming and response.status_code != 304:
+        response.headers['Content-Length'] = str(len(response.body))
+    await send({'type': 'http.response.start', 'status': response.status_code,
+                'headers': [(key.lower().encode('latin-1'), value.encode('latin-1'))
+                            for key, value in response.headers.items()]})
+    if request.method == 'HEAD' or not streaming:
+        await send({'type': 'http.response.body', 'body': b'' if request.method == 'HEAD' else response.body})
+        return
+
+    async def stream():
+        async for chunk in response.body:
+            await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    tasks = [asyncio.ensure_future(stream()), asyncio.ensure_future(disconnect())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await response.body.aclose()
+    for task in done:
+        task.result()
+
+
+async def handle(handler, request, view_args, receive, send):
+    token = metrics.start_request() if db_api.METRICS_ENABLED else None
+    start = time.perf_counter()
+    try:
+        session = main.app.session_interface.open_session(main.app, request) or {}
+        response = await handler(request, session, **view_args)
+        response.vary.add('Cookie')  # 与Flask相同，读取了session的响应随cookie变化
+        try:
+            await send_response(response, request, receive, send)
+        finally:
+            response.close()
+    finally:
+        if token is not None:
+            main.observe_request(request.endpoint, request.method, time.perf_counter() - start,
+                                 metrics.finish_request(token))
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await async_db_api.get_pool()
+                db_api.get_listener()
+            except Exception as err:
+                await send({'type': 'lifespan.startup.failed', 'message': str(err)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await async_db_api.close_pool()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+_wsgi = WSGIMiddleware(main.app, workers=WSGI_THREADS)
+
+
+async def application(scope, receive, send):
+    """
+    ASGI应用。ROUTES中的路由在事件循环中处理，其余请求交给线程池中的Flask。
+    """
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] == 'http' and scope['method'] in ASYNC_METHODS:
+        request = AsyncRequest(scope)
+        try:
+            endpoint, view_args = request.url_adapter.match(request.path, request.method)
+        except HTTPException:  # 404、405和重定向由Flask返回
+            endpoint, view_args = None, None
+        if endpoint in ROUTES:
+            request.endpoint = endpoint
+            await handle(ROUTES[endpoint], request, view_args, receive, send)
+            return
+    await _wsgi(scope, receive, send)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    db_api.apply_migrations()
+    uvicorn.run(application, port=8000)
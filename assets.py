@@ -0,0 +1,134 @@
+# ===================================================================================================
+# Dependencies
+# ===================================================================================================
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+
+# ===================================================================================================
+# Fingerprinted static assets
+# ===================================================================================================
+DIST_DIR = 'dist'  # 构建结果目录，位于静态文件目录下
+MANIFEST = 'manifest.json'  # 构建结果目录中的清单文件：原文件名 -> 带指纹的文件名
+ENTRY_TEMPLATES = ('base.html',)  # 从这些模板中引用的静态文件开始构建
+FINGERPRINT_LENGTH = 12  # 文件名中内容摘要的长度
+COMPRESSIBLE = ('.css', '.js', '.map', '.svg', '.ttf', '.eot')  # 生成压缩版本的文件类型，woff/woff2和图片本身已压缩
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))  # 按优先级排列的(Content-Encoding, 压缩文件后缀)
+
+STATIC_REFERENCE = re.compile(r"url_for\(\s*'static'\s*,\s*filename\s*=\s*'([^']+)'\s*\)")
+CSS_REFERENCE = re.compile(r"url\(\s*(['\"]?)([^'\")]+)\1\s*\)")
+SOURCE_MAP_REFERENCE = re.compile(r'([/*]# sourceMappingURL=)(\S+?)(\s*\*/|\s*$)', re.M)
+
+
+def template_assets(template):
+    """
+    功能：模板中通过url_for('static', filename=...)引用的静态文件
+    :param template: 模板文件路径
+    :return: 文件名list，相对于静态文件目录
+    """
+    with open(template, encoding='utf-8') as file:
+        return STATIC_REFERENCE.findall(file.read())
+
+
+def _compressors():
+    compressors = {'gzip': lambda data: gzip.compress(data, 9, mtime=0)}
+    try:
+        import brotli
+    except ImportError:  # 没有安装Brotli时只生成gzip版本
+        return compressors
+    compressors['br'] = lambda data: brotli.compress(data, quality=11)
+    return compressors
+
+
+def _write(path, data):
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as file:
+        file.write(data)
+    os.replace(path + '.tmp', path)
+
+
+def build(static_folder, entries):
+    """
+    功能：为entries及其引用的文件（CSS中的url()、CSS和JS的source map）生成带内容指纹的副本，以及gzip和Brotli压缩版本，
+    写入DIST_DIR并更新清单。CSS和JS中的引用改写为带指纹的文件名，因此被引用的文件改变时引用它的文件的指纹也会改变。
+    已存在的文件不会重写，旧版本的文件保留，正在使用旧页面的浏览器仍然可以访问。
+    :param static_folder: 静态文件目录
+    :param entries: 文件名list，相对于静态文件目录
+    :return: list，每一项为dict：filename为原文件名，asset为带指纹的文件名，size为字节数，
+        以及每种压缩版本的字节数（例如gzip、br，未生成时没有该字段）
+    """
+    compressors = _compressors()
+    manifest, results = {}, []
+
+    def visit(filename):
+        if filename not in manifest:
+            manifest[filename] = None  # 循环引用时保留原引用
+            manifest[filename] = fingerprint(filename)
+        return manifest[filename]
+
+    def rewrite(filename, reference):
+        path, suffix = re.match(r'([^?#]*)(.*)', reference, re.S).groups()  # 保留?#iefix等后缀
+        if not path or path.startswith(('data:', '/')) or '://' in path:
+            return reference
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(filename), path))
+        if not os.path.isfile(os.path.join(static_folder, *target.split('/'))):
+            return reference
+        asset = visit(target)
+        if asset is None:
+            return reference
+        return posixpath.relpath(asset, posixpath.dirname(posixpath.join(DIST_DIR, filename))) + suffix
+
+    def fingerprint(filename):
+        with open(os.path.join(static_folder, *filename.split('/')), 'rb') as file:
+            data = file.read()
+        stem, extension = posixpath.splitext(filename)
+        if extension in ('.css', '.js'):
+            text = data.decode('utf-8')
+            if extension == '.css':
+                text = CSS_REFERENCE.sub(lambda match: 'url(%s%s%s)' % (
+                    match.group(1), rewrite(filename, match.group(2)), match.group(1)), text)
+            text = SOURCE_MAP_REFERENCE.sub(lambda match: match.group(1) + rewrite(filename, match.group(2)) +
+                                            match.group(3), text)
+            data = text.encode('utf-8')
+        asset = '%s/%s.%s%s' % (DIST_DIR, stem, hashlib.sha256(data).hexdigest()[:FINGERPRINT_LENGTH], extension)
+        path = os.path.join(static_folder, *asset.split('/'))
+        _write(path, data)
+        result = {'filename': filename, 'asset': asset, 'size': len(data)}
+        if extension in COMPRESSIBLE:
+            for encoding, suffix in ENCODINGS:
+                if encoding not in compressors:
+                    continue
+                if not os.path.exists(path + suffix):
+                    compressed = compressors[encoding](data)
+                    if len(compressed) >= len(data):
+                        continue
+                    _write(path + suffix, compressed)
+                result[encoding] = os.path.getsize(path + suffix)
+        results.append(result)
+        return asset
+
+    for filename in entries:
+        visit(filename)
+    path = os.path.join(static_folder, DIST_DIR, MANIFEST)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+    return results
+
+
+def load_manifest(static_folder):
+    """
+    功能：读取build生成的清单
+    :return: dict，原文件名 -> 带指纹的文件名；没有构建时为空dict
+    """
+    try:
+        with open(os.path.join(static_folder, DIST_DIR, MANIFEST), encoding='utf-8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
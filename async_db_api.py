@@ -0,0 +1,538 @@
+# ===================================================================================================
+# Dependencies
+# ===================================================================================================
+import asyncio
+import sys
+import time
+from contextlib import asynccontextmanager
+
+import psycopg
+import psycopg.conninfo
+from psycopg_pool import AsyncConnectionPool
+
+import db_api
+import metrics
+
+# ===================================================================================================
+# Async database API
+# ===================================================================================================
+# db_api中供页面和JSON接口调用的函数的asyncio版本，函数名、参数和返回值与db_api相同，在asgi.py中使用。
+# 等待数据库时只挂起当前协程，不占用线程，一个进程可以同时处理大量较慢的请求和长连接。
+# 连接通过psycopg（psycopg 3）的异步连接池获得，游标在客户端绑定参数，与psycopg2的行为相同。查询语句、参数、
+# 结果的整理和需要删除的缓存键都由db_api中各个函数对应的_xxx_statement和_xxx_transition生成，本模块只负责执行。
+# 配置（DB_CONFIG、POOL_*等）、进程内缓存、通知监听线程和事件分发都与db_api共用，同一进程中两者的缓存失效互相可见。
+# 批量导入、缩略图、图片回收、迁移和重新计数只在命令行和后台使用，没有异步版本。
+
+
+class InstrumentedCursor(psycopg.AsyncClientCursor):
+    """
+    同db_api.InstrumentedCursor，统计计入同一组指标，按db_api的函数名区分。
+    """
+
+    async def execute(self, query, params=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            db_api._record_query(time.perf_counter() - start, query, params)
+
+    async def fetchone(self):
+        row = await super().fetchone()
+        if row is not None:
+            db_api._record_rows(1)
+        return row
+
+    async def fetchall(self):
+        rows = await super().fetchall()
+        db_api._record_rows(len(rows))
+        return rows
+
+
+class InstrumentedConnection(psycopg.AsyncConnection):
+    """
+    记录新建连接耗时的连接，同db_api.get_db_conn。
+    """
+
+    @classmethod
+    async def connect(cls, conninfo='', **kwargs):
+        start = time.perf_counter()
+        conn = await super().connect(conninfo, **kwargs)
+        db_api.CONNECT_SECONDS.observe(time.perf_counter() - start)
+        return conn
+
+
+def _conninfo():
+    # DB_CONFIG是psycopg2.connect的参数：dsn为连接串，database是dbname的别名
+    config = dict(db_api.DB_CONFIG)
+    dsn = config.pop('dsn', '')
+    if 'database' in config:
+        config['dbname'] = config.pop('database')
+    return psycopg.conninfo.make_conninfo(dsn, **config)
+
+
+_pool = None
+_pool_lock = None  # 在第一次调用get_pool的事件循环中创建
+
+
+async def get_pool():
+    """
+    功能：获取进程内共享的异步连接池，首次调用时按db_api的POOL_*配置创建并打开，之后只能在同一个事件循环中使用。
+    :return: psycopg_pool.AsyncConnectionPool
+    """
+    global _pool, _pool_lock
+    if _pool is not None:
+        return _pool
+    if _pool_lock is None:
+        _pool_lock = asyncio.Lock()
+    async with _pool_lock:
+        if _pool is None:
+            if db_api.METRICS_ENABLED:
+                kwargs = {'cursor_factory': InstrumentedCursor}
+                connection_class = InstrumentedConnection
+            else:
+                kwargs = {'cursor_factory': psycopg.AsyncClientCursor}
+                connection_class = psycopg.AsyncConnection
+            pool = AsyncConnectionPool(_conninfo(), connection_class=connection_class, kwargs=kwargs,
+                                       min_size=db_api.POOL_MIN_SIZE, max_size=db_api.POOL_MAX_SIZE,
+                                       timeout=db_api.POOL_TIMEOUT, open=False, name='async_db_api')
+            await pool.open()
+            _pool = pool
+        return _pool
+
+
+async def close_pool():
+    """
+    功能：关闭异步连接池，下一次调用get_pool()时会在当时的事件循环中重新创建。
+    """
+    global _pool, _pool_lock
+    if _pool_lock is None:
+        return
+    async with _pool_lock:
+        if _pool is not None:
+            await _pool.close()
+        _pool = None
+    _pool_lock = None
+
+
+@asynccontextmanager
+async def db_conn():
+    """
+    功能：从异步连接池借出一个数据库连接，async with块结束时自动归还，未提交的事务会被回滚。
+    用法：
+        async with db_conn() as conn:
+            cursor = conn.cursor()
+            await cursor.execute(...)
+            await conn.commit()
+    :return: psycopg.AsyncConnection
+    """
+    pool = await get_pool()
+    conn = await pool.getconn()
+    token = None
+    if db_api.METRICS_ENABLED:
+        # 调用栈：db_conn <- _AsyncGeneratorContextManager.__aenter__ <- 调用方
+        function = _caller_name(sys._getframe(2))
+        token = db_api._db_function.set(function)
+        db_api.CHECKOUTS.inc(1, function)
+        stats = metrics.current_request()
+        if stats is not None:
+            stats.connections += 1
+    try:
+        yield conn
+    finally:
+        if token is not None:
+            db_api._db_function.reset(token)
+        if not conn.closed:
+            try:
+                await conn.rollback()
+            except psycopg.Error:
+                await conn.close()
+        await pool.putconn(conn)
+
+
+def _caller_name(frame):
+    # 同db_api._caller_name，跳过本模块内部的辅助函数
+    while frame.f_code.co_name.startswith('_') and frame.f_globals is globals() and frame.f_back is not None:
+        frame = frame.f_back
+    return frame.f_code.co_name
+
+
+@db_api.METRICS.collector
+def _pool_metrics():
+    pool = _pool
+    if pool is None:
+        return []
+    collected = []
+    for key, value in pool.get_stats().items():
+        if key in ('pool_size', 'pool_available', 'requests_waiting'):
+            collected.append(('tp_async_pool_%s' % key, 'gauge', '异步连接池统计：%s' % key, value))
+        elif key not in ('pool_min', 'pool_max'):
+            collected.append(('tp_async_pool_%s_total' % key, 'counter', '异步连接池统计：%s' % key, value))
+    return collected
+
+
+async def commit_and_invalidate(conn, *keys):
+    """
+    功能：同db_api.commit_and_invalidate
+    """
+    keys, payload = db_api._invalidation(keys)
+    if keys:
+        cursor = conn.cursor()
+        await cursor.execute('select pg_notify(%s, %s)', (db_api.CACHE_CHANNEL, payload))
+    await conn.commit()
+    db_api.evict(keys)
+
+
+async def _run_query(statement):
+    """
+    功能：同db_api._run_query
+    """
+    query, params, result = statement
+    async with db_conn() as conn:
+        cursor = conn.cursor()
+        await cursor.execute(query, params)
+        rows = await cursor.fetchall()
+    return result(rows)
+
+
+async def _run_update(statement):
+    """
+    功能：同db_api._run_update
+    """
+    query, params, keys = statement
+    async with db_conn() as conn:
+        cursor = conn.cursor()
+        await cursor.execute(query, params)
+        if cursor.rowcount == 0:
+            await conn.rollback()
+            return False
+        await commit_and_invalidate(conn, *keys)
+        return True
+
+
+async def subscribe_events(user_id, goods_id=None, timeout=db_api.NOTIFY_RETRY):
+    """
+    功能：同db_api.subscribe_events，在当前事件循环中等待事件
+    :return: events.AsyncSubscription，使用完毕后必须调用close
+    """
+    listener = db_api.get_listener()
+    if not listener.connected.is_set():
+        await asyncio.get_running_loop().run_in_executor(None, listener.connected.wait, timeout)
+    return db_api.EVENTS.subscribe(db_api._event_topics(user_id, goods_id), asyncio.get_running_loop())
+
+
+# ======================= 用户接口 ======================= #
+
+async def check_username_used(username):
+    """
+    功能：同db_api.check_username_used
+    """
+    return await _run_query(db_api._check_username_used_statement(username))
+
+
+async def create_user(username, password):
+    """
+    功能：同db_api.create_user
+    """
+    try:
+        return await _run_update(db_api._create_user_statement(username, password))
+    except psycopg.Error as err:
+        print(err)
+        return False
+
+
+async def login(username, password):
+    """
+    功能：同db_api.login
+    """
+    return await _run_query(db_api._login_statement(username, password))
+
+
+@db_api.cached
+async def get_user_info(user_id):
+    """
+    功能：同db_api.get_user_info
+    """
+    return await _run_query(db_api._get_user_info_statement(user_id))
+
+
+async def get_user_versions(user_id):
+    """
+    功能：同db_api.get_user_versions
+    """
+    return await _run_query(db_api._get_user_versions_statement(user_id))
+
+
+# ======================= 商品接口 ======================= #
+
+async def create_goods(owner, name, description, img, price, exempt_postage):
+    """
+    功能：同db_api.create_goods
+    """
+    return await _run_update(db_api._create_goods_statement(owner, name, description, img, price, exempt_postage))
+
+
+async def update_goods(owner, goods_id, name, description, img, price, exempt_postage):
+    """
+    功能：同db_api.update_goods
+    """
+    return await _run_update(db_api._update_goods_statement(owner, goods_id, name, description, img, price,
+                                                            exempt_postage))
+
+
+@db_api.cached
+async def get_goods_list(key=None, exempt_postage=None, state=None, price=None):
+    """
+    功能：同db_api.get_goods_list
+    """
+    return await _run_query(db_api._get_goods_list_statement(key, exempt_postage, state, price))
+
+
+@db_api.cached
+async def get_goods_page(key=None, exempt_postage=None, state=None, price=None, cursor=None,
+                         page_size=db_api.GOODS_PAGE_SIZE):
+    """
+    功能：同db_api.get_goods_page
+    """
+    return await _run_query(db_api._get_goods_page_statement(key, exempt_postage, state, price, cursor,
+                                                             page_size))
+
+
+async def get_goods_list_version():
+    """
+    功能：同db_api.get_goods_list_version
+    """
+    return await _run_query(db_api._get_goods_list_version_statement())
+
+
+async def get_goods_list_of_user(user_id):
+    """
+    功能：同db_api.get_goods_list_of_user
+    """
+    return await _run_query(db_api._get_goods_list_of_user_statement(user_id))
+
+
+async def delete_goods(owner, goods_id):
+    """
+    功能：同db_api.delete_goods
+    """
+    return await _run_update(db_api._delete_goods_statement(owner, goods_id))
+
+
+@db_api.cached
+async def get_goods_detail(goods_id):
+    """
+    功能：同db_api.get_goods_detail
+    """
+    return await _run_query(db_api._get_goods_detail_statement(goods_id))
+
+
+async def get_goods_versions(goods_id):
+    """
+    功能：同db_api.get_goods_versions
+    """
+    return await _run_query(db_api._get_goods_versions_statement(goods_id))
+
+
+# ======================= 订单接口 ======================= #
+
+async def _transition_order(transition, args, keys):
+    """
+    功能：同db_api._transition_order
+    """
+    query = db_api._transition_query(transition, args)
+    async with db_conn() as conn:
+        cursor = conn.cursor()
+        try:
+            await cursor.execute(query, args)
+        except (psycopg.DataError, psycopg.IntegrityError) as err:
+            print(err)
+            await conn.rollback()
+            return False
+        seller = (await cursor.fetchone())[0]
+        if seller is None:
+            await conn.rollback()
+            return False
+        await commit_and_invalidate(conn, *keys(seller))
+        return True
+
+
+async def _transition_orders(transition, args, keys):
+    """
+    功能：同db_api._transition_orders
+    """
+    query = db_api._transition_query(transition, args, rows=True)
+    async with db_conn() as conn:
+        cursor = conn.cursor()
+        try:
+            await cursor.execute(query, args)
+        except (psycopg.DataError, psycopg.IntegrityError) as err:
+            print(err)
+            await conn.rollback()
+            return []
+        rows = await cursor.fetchall()
+        if not rows:
+            await conn.rollback()
+            return []
+        await commit_and_invalidate(conn, *keys(rows))
+        return rows
+
+
+async def apply_order(customer, goods_id):
+    """
+    功能：同db_api.apply_order
+    """
+    return await _transition_order(*db_api._apply_order_transition(customer, goods_id))
+
+
+async def abandon_order(customer, goods_id):
+    """
+    功能：同db_api.abandon_order
+    """
+    return await _transition_order(*db_api._abandon_order_transition(customer, goods_id))
+
+
+async def approve_order(owner, goods_id, order_id):
+    """
+    功能：同db_api.approve_order
+    """
+    return await _transition_order(*db_api._approve_order_transition(owner, goods_id, order_id))
+
+
+async def establish_order(customer, goods_id, order_id, address_id):
+    """
+    功能：同db_api.establish_order
+    """
+    return await _transition_order(*db_api._establish_order_transition(customer, goods_id, order_id, address_id))
+
+
+async def deliver_goods(owner, goods_id, order_id, code, company):
+    """
+    功能：同db_api.deliver_goods
+    """
+    return await _transition_order(*db_api._deliver_goods_transition(owner, goods_id, order_id, code, company))
+
+
+async def finish_order(customer, goods_id, order_id):
+    """
+    功能：同db_api.finish_order
+    """
+    return await _transition_order(*db_api._finish_order_transition(customer, goods_id, order_id))
+
+
+async def approve_orders(owner, order_ids):
+    """
+    功能：同db_api.approve_orders
+    """
+    transition = db_api._approve_orders_transition(owner, order_ids)
+    if transition is None:
+        return []
+    return [row[0] for row in await _transition_orders(*transition)]
+
+
+async def deliver_orders(owner, shipments):
+    """
+    功能：同db_api.deliver_orders
+    """
+    transition = db_api._deliver_orders_transition(owner, shipments)
+    if transition is None:
+        return []
+    return [row[0] for row in await _transition_orders(*transition)]
+
+
+async def get_order_by_user_and_goods(user_id, goods_id):
+    """
+    功能：同db_api.get_order_by_user_and_goods
+    """
+    return await _run_query(db_api._get_order_by_user_and_goods_statement(user_id, goods_id))
+
+
+async def get_orders_from_user(user_id):
+    """
+    功能：同db_api.get_orders_from_user
+    """
+    return await _run_query(db_api._get_orders_from_user_statement(user_id))
+
+
+async def get_orders_to_user(user_id):
+    """
+    功能：同db_api.get_orders_to_user
+    """
+    return await _run_query(db_api._get_orders_to_user_statement(user_id))
+
+
+# ======================= 评论接口 ======================= #
+
+async def create_comment(user_id, goods_id, content):
+    """
+    功能：同db_api.create_comment
+    """
+    return await _run_update(db_api._create_comment_statement(user_id, goods_id, content))
+
+
+@db_api.cached(normalize={'order': db_api._comment_direction})
+async def get_comments(goods_id, order='asc'):
+    """
+    功能：同db_api.get_comments
+    """
+    return await _run_query(db_api._get_comments_statement(goods_id, order))
+
+
+async def get_comment_page(goods_id, order='asc', cursor=None, page_size=db_api.COMMENT_PAGE_SIZE):
+    """
+    功能：同db_api.get_comment_page
+    """
+    return await _run_query(db_api._get_comment_page_statement(goods_id, order, cursor, page_size))
+
+
+async def delete_comment(user_id, goods_id, comment_id):
+    """
+    功能：同db_api.delete_comment
+    """
+    return await _run_update(db_api._delete_comment_statement(user_id, goods_id, comment_id))
+
+
+# ======================= 收货地址接口 ======================= #
+
+async def create_address(user_id, name, phone, location):
+    """
+    功能：同db_api.create_address
+    """
+    return await _run_update(db_api._create_address_statement(user_id, name, phone, location))
+
+
+@db_api.cached
+async def get_address_list(user_id):
+    """
+    功能：同db_api.get_address_list
+    """
+    return await _run_query(db_api._get_address_list_statement(user_id))
+
+
+async def delete_address(user_id, address_id):
+    """
+    功能：同db_api.delete_address
+    """
+    try:
+        return await _run_update(db_api._delete_address_statement(user_id, address_id))
+    except Exception as e:
+        print(e)
+        return e
+
+
+# ======================= 页面接口 ======================= #
+
+async def get_goods_detail_page(goods_id, user_id, comment_order='asc', comment_cursor=None):
+    """
+    功能：同db_api.get_goods_detail_page
+    """
+    return await _run_query(db_api._get_goods_detail_page_statement(goods_id, user_id, comment_order,
+                                                                    comment_cursor))
+
+
+async def get_manage_order_page(user_id, from_state=None, from_cursor=None, to_state=None, to_cursor=None,
+                                page_size=db_api.ORDER_PAGE_SIZE):
+    """
+    功能：同db_api.get_manage_order_page
+    """
+    return await _run_query(db_api._get_manage_order_page_statement(user_id, from_state, from_cursor, to_state,
+                                                                    to_cursor, page_size))
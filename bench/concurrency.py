@@ -0,0 +1,253 @@
+"""
+并发基准测试：比较线程模式（main.app + 多线程WSGI服务器）和ASGI模式（asgi.application + uvicorn）在大量并发连接下的
+吞吐量和延迟。
+
+每种模式在单独的子进程中启动服务器。先打开--sse个一直保持的/events连接，模拟打开着订单管理页和商品详情页的用户；
+再由--concurrency个客户端在--duration秒内不断请求JSON接口的商品详情和评论，每个客户端使用一个keep-alive连接。
+输出每种模式的延迟分位数、每秒完成的请求数、失败数，以及服务器进程的峰值线程数和内存（只在Linux上统计）。
+客户端也运行在单个Python进程中，吞吐量很高时客户端本身可能成为瓶颈。
+
+用法：python -m bench.concurrency --dsn <数据库连接串> [--concurrency 1000] [--sse 1000] [--duration 10]
+                                 [--modes wsgi,asgi] [--port 8700]
+"""
+import argparse
+import asyncio
+import logging
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+import db_api
+from bench import make_parser, configure, ensure_user, summarize, format_summary
+
+HOST = '127.0.0.1'
+BACKLOG = 4096  # 两种服务器相同的监听队列长度，避免大量连接同时建立时的差异来自队列长度
+REQUEST_TIMEOUT = 30  # 秒，超过后计为失败
+STARTUP_TIMEOUT = 30  # 秒，等待服务器开始监听的最长时间
+SAMPLE_GOODS = 100  # 随机选取的商品数量
+MODES = ('wsgi', 'asgi')
+
+
+def serve(mode, port, dsn):
+    """
+    功能：在当前进程中运行服务器，由子进程调用
+    :param mode: wsgi为Flask和Werkzeug的多线程服务器（每个连接一个线程），asgi为asgi.application和uvicorn
+    """
+    configure(dsn)
+    if mode == 'wsgi':
+        from werkzeug.serving import ThreadedWSGIServer, make_server
+        from main import app
+        ThreadedWSGIServer.request_queue_size = BACKLOG
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)  # 与uvicorn相同，不输出每个请求的日志
+        make_server(HOST, port, app, threaded=True).serve_forever()
+    else:
+        import uvicorn
+        import asgi
+        uvicorn.run(asgi.application, host=HOST, port=port, backlog=BACKLOG, log_level='warning')
+
+
+def start_server(mode, port, dsn):
+    process = subprocess.Popen([sys.executable, '-m', 'bench.concurrency', '--dsn', dsn, '--serve', mode,
+                                '--port', str(port)])
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('%s server exited with %s' % (mode, process.returncode))
+        try:
+            socket.create_connection((HOST, port), 1).close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('%s server did not start within %s seconds' % (mode, STARTUP_TIMEOUT))
+
+
+def process_status(pid):
+    """
+    功能：读取进程的线程数和常驻内存
+    :return: (线程数, 常驻内存KB)；不是Linux时返回(None, None)
+    """
+    try:
+        with open('/proc/%d/status' % pid) as file:
+            fields = dict(line.split(':', 1) for line in file)
+    except OSError:
+        return None, None
+    return int(fields['Threads']), int(fields['VmRSS'].split()[0])
+
+
+async def read_response(reader):
+    """
+    功能：读取一个HTTP/1.1响应，响应体按Content-Length或chunked读取
+    :return: (状态码, 连接是否可以继续使用)
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('connection closed')
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip().lower()
+    if 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    elif headers.get('transfer-encoding') == 'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    return int(status_line.split()[1]), headers.get('connection') != 'close'
+
+
+def request_bytes(path, cookie):
+    return ('GET %s HTTP/1.1\r\nHost: %s\r\nCookie: %s\r\n\r\n' % (path, HOST, cookie)).encode('latin-1')
+
+
+async def client(port, paths, cookie, deadline, results):
+    """
+    功能：在deadline之前不断发送请求，results为(samples, errors)，samples为成功请求的耗时毫秒
+    """
+    samples, errors = results
+    reader = writer = None
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(HOST, port), REQUEST_TIMEOUT)
+            writer.write(request_bytes(random.choice(paths), cookie))
+            status, keep_alive = await asyncio.wait_for(read_response(reader), REQUEST_TIMEOUT)
+        except (OSError, EOFError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            errors.append(time.perf_counter() - start)
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+            await asyncio.sleep(0.1)
+            continue
+        if status == 200:
+            samples.append((time.perf_counter() - start) * 1000)
+        else:
+            errors.append(time.perf_counter() - start)
+        if not keep_alive:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def hold_events(port, cookie, opened, stop):
+    """
+    功能：打开一个/events连接并一直读取，直到stop被设置；收到200响应头后opened加一
+    """
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(HOST, port), REQUEST_TIMEOUT)
+    except (OSError, asyncio.TimeoutError):
+        return
+    try:
+        writer.write(request_bytes('/events', cookie))
+        status_line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+        if status_line.split()[1:2] != [b'200']:
+            return
+        opened.append(1)
+        while not stop.is_set() and await reader.read(4096):
+            pass
+    except (OSError, asyncio.TimeoutError):
+        pass
+    finally:
+        writer.close()
+
+
+async def run(port, paths, cookie, concurrency, sse, duration, pid):
+    """
+    功能：先打开sse个/events连接，再用concurrency个客户端请求duration秒
+    :return: dict，包括请求耗时、失败数、吞吐量、已打开的/events连接数和服务器的峰值线程数、内存
+    """
+    stop = asyncio.Event()
+    opened = []
+    holders = [asyncio.ensure_future(hold_events(port, cookie, opened, stop)) for _ in range(sse)]
+    deadline = time.monotonic() + REQUEST_TIMEOUT
+    while len(opened) < sse and time.monotonic() < deadline and not all(holder.done() for holder in holders):
+        await asyncio.sleep(0.1)
+    results = ([], [])
+    peak_threads, peak_rss = process_status(pid)
+    start = time.perf_counter()
+    clients = asyncio.ensure_future(asyncio.gather(
+        *[client(port, paths, cookie, time.monotonic() + duration, results) for _ in range(concurrency)]))
+    while not clients.done():
+        threads, rss = process_status(pid)
+        if threads is not None:
+            peak_threads, peak_rss = max(peak_threads, threads), max(peak_rss, rss)
+        await asyncio.wait([clients], timeout=0.5)
+    elapsed = time.perf_counter() - start
+    await clients
+    stop.set()
+    for holder in holders:
+        holder.cancel()
+    await asyncio.gather(*holders, return_exceptions=True)
+    return {'samples': results[0], 'errors': len(results[1]), 'throughput': len(results[0]) / elapsed,
+            'sse': len(opened), 'threads': peak_threads, 'rss': peak_rss}
+
+
+def raise_file_limit(connections):
+    # 每个连接在客户端和服务器各占用一个文件描述符，子进程继承提高后的限制
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = connections + 1024
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted if hard == resource.RLIM_INFINITY else min(wanted, hard),
+                                                    hard))
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--concurrency', type=int, default=1000, help='同时发送请求的客户端数')
+    parser.add_argument('--sse', type=int, default=1000, help='测试期间一直保持的/events连接数')
+    parser.add_argument('--duration', type=float, default=10, help='每种模式发送请求的秒数')
+    parser.add_argument('--modes', default=','.join(MODES), help='逗号分隔的服务器模式：wsgi、asgi')
+    parser.add_argument('--port', type=int, default=8700, help='服务器监听的端口')
+    parser.add_argument('--serve', choices=MODES, help=argparse.SUPPRESS)  # 内部使用：在子进程中运行服务器
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve, args.port, args.dsn)
+        return
+    configure(args.dsn)
+    db_api.apply_migrations()
+    raise_file_limit(args.concurrency + args.sse)
+
+    from main import app
+    username = 'bench_concurrency'
+    user_id = ensure_user(username)
+    with db_api.db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute('select id from "Goods" order by random() limit %s', (SAMPLE_GOODS,))
+        goods = [row[0] for row in cursor.fetchall()]
+    if not goods:
+        parser.error('测试数据库中没有商品，先运行python -m bench.seed')
+    paths = ['/api/v1/goods/%d' % goods_id for goods_id in goods] + \
+            ['/api/v1/goods/%d/comments' % goods_id for goods_id in goods]
+    session = app.session_interface.get_signing_serializer(app).dumps(
+        {'logged_in': True, 'username': username, 'user_id': user_id})
+    cookie = '%s=%s' % (app.config['SESSION_COOKIE_NAME'], session)
+
+    for mode in args.modes.split(','):
+        process = start_server(mode, args.port, args.dsn)
+        try:
+            result = asyncio.run(run(args.port, paths, cookie, args.concurrency, args.sse, args.duration,
+                                     process.pid))
+        finally:
+            process.terminate()
+            process.wait()
+        name = 'GET /api/v1/goods/* [%s]' % mode
+        if result['samples']:
+            print(format_summary(name, summarize(result['samples'])))
+        else:
+            print('%-40s no successful requests' % name)
+        print('%-40s %.1f req/s, %d errors, %d/%d events connections, %s threads, %s KB rss' % (
+            '', result['throughput'], result['errors'], result['sse'], args.sse, result['threads'], result['rss']))
+
+
+if __name__ == '__main__':
+    main()
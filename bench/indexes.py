@@ -0,0 +1,115 @@
+"""
+索引基准测试：在大数据量下对比执行迁移脚本（创建索引）前后各个查询函数的延迟。
+
+需要一个尚未执行迁移的测试数据库，--seed会先写入模拟数据。
+迁移之后db_api的函数会读取迁移添加的列（如sale_count、seller），不能在未迁移的数据库上执行，所以这里执行的是
+CreateDB.sql版本中各个函数的查询（QUERIES），迁移前后执行相同的SQL，差异只来自索引。当前db_api函数的延迟见bench.suite。
+用法：python -m bench.indexes --dsn <数据库连接串> [--seed] [--samples 100]
+"""
+import random
+
+import db_api
+from bench import make_parser, configure, timed, summarize, format_summary
+from bench.seed import seed_args, add_arguments
+
+
+def id_range(table):
+    with db_api.db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute('select min(id), max(id) from "%s"' % table)
+        return cursor.fetchone()
+
+
+# 函数名 -> 该函数在CreateDB.sql版本中依次执行的查询，参数中的'user'和'goods'替换为随机的用户id和商品id
+QUERIES = {
+    'get_user_info': [
+        ('select username from "User" where id = %s', ('user',)),
+        ('select count(*) from "Order" where user_id = %s and state = %s', ('user', db_api.ORDER_STATE_FINISHED)),
+    ],
+    'get_goods_list_of_user': [
+        ('select id, name, description, img, price, exempt_postage from "Goods" where owner = %s', ('user',)),
+    ],
+    'get_goods_detail': [
+        ('select name, description, img, price, exempt_postage, owner from "Goods" where id = %s', ('goods',)),
+        ('select count(*) from "Order" where goods_id = %s and state = %s', ('goods', db_api.ORDER_STATE_OFF_SALE)),
+        ('select count(*) from "Order" where goods_id = %s and state = %s', ('goods', db_api.ORDER_STATE_APPLIED)),
+    ],
+    'get_order_by_user_and_goods': [
+        ('select id, state from "Order" where user_id = %s and goods_id = %s', ('user', 'goods')),
+    ],
+    'get_orders_from_user': [
+        ('select "Order".id, goods_id, name, state, price, exempt_postage, express_code, express_company from '
+         '"Order" join "Goods" on "Order".goods_id = "Goods".id where user_id = %s', ('user',)),
+    ],
+    'get_orders_to_user': [
+        ('select "Order".id, "Order".user_id, "Order".goods_id, "Goods".name, "Order".state, "Goods".price, '
+         '"Goods".exempt_postage, "User".username, "Address".name, "Address".phone, "Address".location from '
+         '"Order" left outer join "Goods" on "Order".goods_id = "Goods".id left outer join "User" on '
+         '"Order".user_id = "User".id left outer join "Address" on "Order".address_id = "Address".id where '
+         '"Goods".owner = %s', ('user',)),
+    ],
+    'get_comments': [
+        ('select "Comment".id, user_id, username, content, "Comment".create_at from "Comment" join "User" on '
+         '"Comment".user_id = "User".id where goods_id = %s order by create_at asc', ('goods',)),
+    ],
+    'get_address_list': [
+        ('select id, name, phone, location from "Address" where user_id = %s', ('user',)),
+    ],
+}
+# 商品详情页在CreateDB.sql版本中调用的函数
+QUERIES['get_goods_detail_page'] = (QUERIES['get_goods_detail'] + QUERIES['get_user_info'] +
+                                    QUERIES['get_order_by_user_and_goods'] + QUERIES['get_comments'])
+
+
+def make_cases():
+    users = id_range('User')
+    goods = id_range('Goods')
+
+    def run(queries):
+        ids = {'user': random.randint(*users), 'goods': random.randint(*goods)}
+        with db_api.db_conn() as conn:
+            cursor = conn.cursor()
+            for query, params in queries:
+                cursor.execute(query, tuple(ids.get(param, param) for param in params))
+                cursor.fetchall()
+
+    return [(name, lambda queries=queries: run(queries)) for name, queries in QUERIES.items()]
+
+
+def measure(cases, samples):
+    results = {}
+    for name, case in cases:
+        random.seed(name)
+        results[name] = summarize([timed(case)[1] for _ in range(samples)])
+    return results
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--seed', action='store_true', help='先写入模拟数据')
+    parser.add_argument('--samples', type=int, default=100, help='每个函数的调用次数')
+    add_arguments(parser)
+    args = parser.parse_args()
+    configure(args.dsn)
+    if args.seed:
+        seed_args(args)
+
+    cases = make_cases()
+    before = measure(cases, args.samples)
+    applied = db_api.apply_migrations()
+    if not applied:
+        print('warning: no pending migrations, "before" already uses the indexes')
+    with db_api.db_conn() as conn:
+        conn.autocommit = True
+        conn.cursor().execute('analyze')
+        conn.autocommit = False
+    after = measure(cases, args.samples)
+
+    for name, _ in cases:
+        print(format_summary(name + ' [before]', before[name]))
+        print(format_summary(name + ' [after]', after[name]))
+        print('%-40s speedup(p50)=%.1fx' % ('', before[name]['p50'] / after[name]['p50']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+执行计划回归检查：运行bench.suite中db_api的全部用例和路由用例，记录db_api执行的每一种语句（按函数和语句形状去重），
+再对每种语句用当时的参数执行EXPLAIN。热点语句在"Order"、"Goods"或"Comment"上使用顺序扫描，或者估算代价超过上限时
+检查失败，以非零退出码结束，可以在CI中于迁移或查询修改之后运行。
+
+执行计划与数据量和统计信息有关，应在数据量接近生产环境的测试数据库上运行，--seed会先按bench.seed的参数写入模拟数据。
+存储函数（例如order_approve）内部的语句不会出现在EXPLAIN的结果中，只检查调用它们的语句。
+
+用法：python -m bench.plans --dsn <数据库连接串> [--seed] [--samples 20] [--max-cost 10000] [--output plans.json]
+"""
+import json
+import re
+import sys
+import threading
+
+import psycopg2
+
+import db_api
+from main import app
+from bench import make_parser, configure
+from bench.seed import seed_args, add_arguments
+from bench.suite import Dataset, db_api_cases, route_cases
+
+HOT_TABLES = ('Order', 'Goods', 'Comment')
+MAX_COST = 10000  # 默认的估算代价上限
+COST_BUDGETS = {  # 函数名 -> 该函数中语句的估算代价上限，覆盖--max-cost
+    'get_goods_page': 20000,
+}
+EXEMPT = {  # 函数名 -> 原因，这些函数本来就需要读取整张表，不检查顺序扫描和代价
+    'get_goods_list': '返回全部商品，交易大厅使用get_goods_page',
+    'get_goods_images': '维护命令，读取全部商品图片',
+    'recount_counters': '维护命令，重新统计全部订单和评论',
+    'apply_migrations': '维护命令',
+}
+EXPLAINABLE = re.compile(r'\s*(select|with|insert|update|delete)\b', re.I)
+
+_statements = {}  # (函数名, 语句形状) -> (SQL, 参数)
+_statements_lock = threading.Lock()
+_functions = {name for name, value in vars(db_api).items() if callable(value) and not name.startswith('_')}
+
+
+class CapturingCursor(db_api.InstrumentedCursor):
+    """
+    记录db_api公开函数执行的每种语句及其第一次执行时的参数
+    """
+
+    def execute(self, query, vars=None):
+        function = db_api._db_function.get()
+        if function in _functions and isinstance(query, str) and EXPLAINABLE.match(query):
+            key = (function, db_api.normalize_query(query))
+            with _statements_lock:
+                _statements.setdefault(key, (query, vars))
+        return super().execute(query, vars)
+
+
+def paging_calls(data):
+    """
+    功能：翻页时才会执行的语句，用第一页返回的游标再取下一页和上一页
+    """
+    user_id, goods_id = data.user()[0], data.commented_goods()
+    for price in ('asc', 'desc', 'rank'):
+        page = db_api.get_goods_page.uncached('自行车' if price == 'rank' else '', price=price)
+        if page['next_cursor']:
+            page = db_api.get_goods_page.uncached('自行车' if price == 'rank' else '', price=price,
+                                                  cursor=page['next_cursor'])
+            db_api.get_goods_page.uncached('自行车' if price == 'rank' else '', price=price,
+                                           cursor=page['prev_cursor'])
+    for order in ('asc', 'desc'):
+        page = db_api.get_comment_page(goods_id, order, page_size=1)
+        if page['next_cursor']:
+            db_api.get_comment_page(goods_id, order, page['next_cursor'], page_size=1)
+    for state in ('', str(db_api.ORDER_STATE_APPLIED)):
+        page = db_api.get_manage_order_page(user_id, state, None, state, None, page_size=1)
+        db_api.get_manage_order_page(user_id, state, page['orders_from_user']['next_cursor'], state,
+                                     page['orders_to_user']['next_cursor'], page_size=1)
+    db_api.update_goods(data.seller, data.new_goods(), 'bench_plans', 'bench', '/static/images/cart.jpeg', 1, True)
+
+
+def capture(data, samples):
+    """
+    功能：运行全部用例，记录执行的语句
+    """
+    for cases in (db_api_cases(data), route_cases(data, app.test_client())):
+        for name, case in cases.items():
+            for _ in range(samples):
+                try:
+                    next(case)()
+                except Exception as err:
+                    print('%-40s %s: %s' % (name, type(err).__name__, err), file=sys.stderr)
+                    break
+    paging_calls(data)
+
+
+def plan_nodes(node):
+    yield node
+    for child in node.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+def check(cursor, function, query, params, max_cost):
+    """
+    功能：EXPLAIN一条语句并检查
+    :return: dict，字段为function, shape, cost, seq_scans（顺序扫描的热点表）, problems（失败原因list）, error
+    """
+    result = {'function': function, 'shape': db_api.normalize_query(query), 'cost': None, 'seq_scans': [],
+              'problems': []}
+    try:
+        cursor.execute('explain (format json) ' + query, params)
+        plan = cursor.fetchone()[0][0]['Plan']
+    except psycopg2.Error as err:
+        result['error'] = str(err).strip()
+        return result
+    finally:
+        cursor.connection.rollback()
+    result['cost'] = plan['Total Cost']
+    result['seq_scans'] = sorted({node['Relation Name'] for node in plan_nodes(plan)
+                                  if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') in HOT_TABLES})
+    if function in EXEMPT:
+        result['exempt'] = EXEMPT[function]
+        return result
+    if result['seq_scans']:
+        result['problems'].append('seq scan on ' + ', '.join('"%s"' % table for table in result['seq_scans']))
+    budget = COST_BUDGETS.get(function, max_cost)
+    if result['cost'] > budget:
+        result['problems'].append('cost %.0f > %d' % (result['cost'], budget))
+    return result
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--seed', action='store_true', help='先写入模拟数据，数量参数与bench.seed相同')
+    parser.add_argument('--samples', type=int, default=20, help='每个用例的调用次数，次数越多覆盖的语句分支越多')
+    parser.add_argument('--max-cost', type=float, default=MAX_COST, help='语句的估算代价上限')
+    parser.add_argument('--output', help='把每条语句的检查结果写入该JSON文件')
+    add_arguments(parser)
+    args = parser.parse_args()
+    db_api.CACHE_LISTEN = False
+    db_api.SLOW_QUERY_THRESHOLD = None
+    configure(args.dsn)
+    db_api.apply_migrations()
+    if args.seed:
+        seed_args(args)
+
+    db_api.InstrumentedCursor = CapturingCursor
+    db_api.close_pool()
+    capture(Dataset(), args.samples)
+
+    results = []
+    conn = psycopg2.connect(**db_api.DB_CONFIG)
+    try:
+        cursor = conn.cursor()
+        for (function, _), (query, params) in sorted(_statements.items()):
+            results.append(check(cursor, function, query, params, args.max_cost))
+    finally:
+        conn.close()
+
+    failures = [result for result in results if result['problems'] or result.get('error')]
+    for result in results:
+        status = 'FAIL' if result in failures else 'skip' if result.get('exempt') else 'ok'
+        cost = '-' if result['cost'] is None else '%.0f' % result['cost']
+        print('%-4s %-28s cost=%-8s %s' % (status, result['function'], cost, result['shape'][:100]))
+        for problem in result['problems'] + ([result['error']] if result.get('error') else []):
+            print('     ' + problem)
+    covered = {result['function'] for result in results}
+    print('%d statements in %d functions, %d failed' % (len(results), len(covered), len(failures)))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+连接池基准测试：对比“每次调用新建连接”和连接池两种模式下，商品详情页每个请求新建的连接数和延迟。
+
+用法：python -m bench.pool --dsn <数据库连接串> [--requests 500] [--warmup 20]
+"""
+import db_api
+from main import app
+from bench import make_parser, configure, ensure_user, timed, summarize, format_summary
+
+
+class ConnectPerCallPool(db_api.ConnectionPool):
+    """
+    模拟引入连接池之前的行为：每次借出都新建连接，归还时直接关闭。
+    """
+
+    def getconn(self):
+        with self._cond:
+            self.stats['checkouts'] += 1
+        return self._new_conn()
+
+    def putconn(self, conn):
+        self._close(conn)
+
+
+def run(client, goods_id, requests, warmup):
+    for _ in range(warmup):
+        client.get('/goods_detail?id=%s' % goods_id)
+    pool = db_api.get_pool()
+    before = dict(pool.stats)
+    samples = []
+    for _ in range(requests):
+        response, elapsed = timed(client.get, '/goods_detail?id=%s' % goods_id)
+        assert response.status_code == 200, response.status_code
+        samples.append(elapsed)
+    connects = pool.stats['connects'] - before['connects']
+    checkouts = pool.stats['checkouts'] - before['checkouts']
+    return samples, connects / requests, checkouts / requests
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--requests', type=int, default=500, help='每种模式下的请求数')
+    parser.add_argument('--warmup', type=int, default=20, help='计时前的预热请求数')
+    args = parser.parse_args()
+    configure(args.dsn)
+
+    seller = ensure_user('bench_pool_seller')
+    buyer = ensure_user('bench_pool_buyer')
+    db_api.create_goods(seller, 'bench_pool_goods', 'bench_pool_goods', None, 1, True)
+    goods_id = max(g['id'] for g in db_api.get_goods_list_of_user(seller))
+    db_api.create_comment(buyer, goods_id, 'bench')
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['logged_in'] = True
+        session['username'] = 'bench_pool_buyer'
+        session['user_id'] = buyer
+
+    db_api.close_pool()
+    db_api._pool = ConnectPerCallPool(0, db_api.POOL_MAX_SIZE, db_api.POOL_TIMEOUT, db_api.POOL_CHECK_IDLE)
+    baseline = run(client, goods_id, args.requests, args.warmup)
+    db_api.close_pool()
+    pooled = run(client, goods_id, args.requests, args.warmup)
+    db_api.close_pool()
+
+    for name, (samples, connects, checkouts) in (('connect per call', baseline), ('pooled', pooled)):
+        print(format_summary('GET /goods_detail [%s]' % name, summarize(samples)))
+        print('%-40s connects/request=%.2f checkouts/request=%.2f' % ('', connects, checkouts))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+搜索基准测试：对比关键词搜索在原来的like查询和全文检索（migrations/0003_goods_search.sql）下的延迟。
+
+--seed会先写入指定数量的商品，名称和描述由常见的中英文商品词随机组成。
+用法：python -m bench.search --dsn <数据库连接串> [--seed 1000000] [--samples 50]
+"""
+import random
+
+import db_api
+from bench import make_parser, configure, ensure_user, timed, summarize, format_summary
+
+WORDS = ['自行车', '山地车', '头盔', '台灯', '键盘', '机械键盘', '鼠标', '显示器', '耳机', '手机', '平板', '充电器',
+         '数据库系统概念', '教材', '笔记本', '电脑', '吉他', '篮球', '羽毛球拍', '衣柜', '书架', '九成新', '全新',
+         '二手', '包邮', '自提', 'iPhone', 'iPad', 'Kindle', 'ThinkPad', 'Switch', 'Giant', 'Nike', 'Sony']
+KEYWORDS = ['自行车', '机械键盘', '数据库', '九成新', 'kindle', 'think', '耳机 全新', '羽毛球']
+
+LIKE_QUERY = 'select id, name, description, img, price, exempt_postage, owner from "Goods" where (name like %s or ' \
+             'description like %s) order by price, id limit %s'
+
+
+def seed_goods(owner, count):
+    words = '{%s}' % ','.join(WORDS)
+    with db_api.db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute('insert into "Goods" (name, description, img, price, owner, exempt_postage) '
+                       'select w[1 + floor(random() * n)::int] || w[1 + floor(random() * n)::int], '
+                       'w[1 + floor(random() * n)::int] || \' \' || w[1 + floor(random() * n)::int] || \' \' || '
+                       'w[1 + floor(random() * n)::int], null, round((random() * 1000)::numeric, 2), %s, '
+                       'random() < 0.5 '
+                       'from generate_series(1, %s), (select %s::text[] w, cardinality(%s::text[]) n) words',
+                       (owner, count, words, words))
+        conn.commit()
+        conn.autocommit = True
+        cursor.execute('analyze "Goods"')
+        conn.autocommit = False
+
+
+def like(pattern):
+    with db_api.db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute(LIKE_QUERY, (pattern, pattern, db_api.GOODS_PAGE_SIZE))
+        return cursor.fetchall()
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--seed', type=int, default=0, help='先写入的商品数量')
+    parser.add_argument('--samples', type=int, default=50, help='每个关键词的查询次数')
+    args = parser.parse_args()
+    configure(args.dsn)
+    db_api.apply_migrations()
+    if args.seed:
+        seed_goods(ensure_user('bench_search'), args.seed)
+
+    cases = [
+        ('like (exact, before)', lambda key: like(key)),
+        ('like %key%', lambda key: like('%' + key + '%')),
+        ('get_goods_page', lambda key: db_api.get_goods_page.uncached(key)),
+        ('get_goods_page rank', lambda key: db_api.get_goods_page.uncached(key, price='rank')),
+    ]
+    for name, case in cases:
+        samples = []
+        for _ in range(args.samples):
+            samples.append(timed(case, random.choice(KEYWORDS))[1])
+        print(format_summary(name, summarize(samples)))
+
+
+if __name__ == '__main__':
+    main()
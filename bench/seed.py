@@ -0,0 +1,201 @@
+"""
+向测试数据库写入大量模拟数据。
+
+数据在Python中按业务规则生成，通过COPY FROM STDIN流式写入：订单的买家不是卖家，同一买家对同一商品只有一个订单，
+每个商品至多有一个已售出（已同意、已确认、运输中、已完成）的订单，其他订单为已下架；待处理的订单只出现在未售出的商品上，
+已确认之后的订单使用买家自己的地址。每种状态的订单数量通过--orders-<状态>分别指定。
+模拟用户的密码均为SEED_PASSWORD。
+
+用法：python -m bench.seed --dsn <数据库连接串> [--users 10000] [--goods 200000] [--orders-applied 600000] ...
+"""
+import random
+import uuid
+from datetime import datetime, timedelta
+
+import db_api
+from bench import make_parser, configure
+from bench.search import WORDS
+
+SEED_PASSWORD = 'bench'
+SOLD_STATES = (db_api.ORDER_STATE_APPROVED, db_api.ORDER_STATE_ESTABLISHED, db_api.ORDER_STATE_ON_ROAD,
+               db_api.ORDER_STATE_FINISHED)
+ORDER_STATES = {name[len('ORDER_STATE_'):].lower(): value for name, value in vars(db_api).items()
+                if name.startswith('ORDER_STATE_') and isinstance(value, int)}
+DEFAULT_ORDERS = {
+    db_api.ORDER_STATE_APPLIED: 600000,
+    db_api.ORDER_STATE_APPROVED: 20000,
+    db_api.ORDER_STATE_ESTABLISHED: 20000,
+    db_api.ORDER_STATE_ON_ROAD: 20000,
+    db_api.ORDER_STATE_FINISHED: 100000,
+    db_api.ORDER_STATE_OFF_SALE: 600000,
+}
+EXPRESS_COMPANIES = ['顺丰', '圆通', '中通', '申通', '韵达', '邮政']
+
+
+def copy_rows(cursor, table, columns, rows):
+    """
+    功能：通过COPY FROM STDIN写入rows，rows为元组的可迭代对象，元素为None或可以转为字符串的值
+    :return: 写入的行数
+    """
+    lines = ('\t'.join(db_api._copy_text(None if value is None else str(value)) for value in row) + '\n'
+             for row in rows)
+    cursor.copy_expert('copy "%s" (%s) from stdin' % (table, ', '.join(columns)), db_api._LineReader(lines))
+    return cursor.rowcount
+
+
+def max_id(cursor, table):
+    cursor.execute('select coalesce(max(id), 0) from "%s"' % table)
+    return cursor.fetchone()[0]
+
+
+def generate_orders(rng, users, goods, addresses, orders):
+    """
+    功能：生成满足业务规则的订单
+    :param users: 用户id列表
+    :param goods: (商品id, 卖家id)列表
+    :param addresses: dict，用户id -> 地址id列表
+    :param orders: dict，订单状态 -> 订单数量
+    :return: (user_id, goods_id, state, address_id, express_code, express_company)的生成器
+    """
+    sold = [state for state in SOLD_STATES for _ in range(orders.get(state, 0))]
+    if len(sold) > len(goods):
+        raise ValueError('已售出的订单数（%d）不能超过商品数（%d）' % (len(sold), len(goods)))
+    if any(state != db_api.ORDER_STATE_APPROVED for state in sold) and not addresses:
+        raise ValueError('已确认的订单需要地址，--addresses不能为0')
+    rng.shuffle(sold)
+    indexes = list(range(len(goods)))
+    rng.shuffle(indexes)
+    sold_goods, unsold_goods = indexes[:len(sold)], indexes[len(sold):]
+    if orders.get(db_api.ORDER_STATE_OFF_SALE, 0) and not sold_goods:
+        raise ValueError('已下架的订单需要已售出的商品')
+    if orders.get(db_api.ORDER_STATE_APPLIED, 0) and not unsold_goods:
+        raise ValueError('待处理的订单需要未售出的商品')
+
+    extra = [0] * len(goods)
+    for _ in range(orders.get(db_api.ORDER_STATE_OFF_SALE, 0)):
+        extra[rng.choice(sold_goods)] += 1
+    for _ in range(orders.get(db_api.ORDER_STATE_APPLIED, 0)):
+        extra[rng.choice(unsold_goods)] += 1
+    sold_state = dict(zip(sold_goods, sold))
+    buyers_with_address = list(addresses)
+
+    for index, (goods_id, owner) in enumerate(goods):
+        state = sold_state.get(index)
+        count = min(extra[index], len(users) - 2)
+        buyers = [user for user in rng.sample(users, count + 2) if user != owner]
+        if state is not None:
+            if state == db_api.ORDER_STATE_APPROVED:
+                buyer = buyers.pop()
+                yield buyer, goods_id, state, None, None, None
+            else:
+                buyer = rng.choice(buyers_with_address)
+                if buyer == owner:
+                    buyer = next((user for user in buyers_with_address if user != owner), None)
+                    if buyer is None:
+                        raise ValueError('只有卖家自己有地址，无法生成已确认的订单')
+                buyers = [user for user in buyers if user != buyer]
+                code = company = None
+                if state in (db_api.ORDER_STATE_ON_ROAD, db_api.ORDER_STATE_FINISHED):
+                    code, company = 'SF%012d' % rng.randrange(10 ** 12), rng.choice(EXPRESS_COMPANIES)
+                yield buyer, goods_id, state, rng.choice(addresses[buyer]), code, company
+            other_state = db_api.ORDER_STATE_OFF_SALE
+        else:
+            other_state = db_api.ORDER_STATE_APPLIED
+        for buyer in buyers[:count]:
+            yield buyer, goods_id, other_state, None, None, None
+
+
+def seed(users, goods, orders, comments, addresses, random_seed=None):
+    """
+    功能：写入模拟数据并更新统计信息，已有的数据不受影响
+    :param orders: dict，订单状态 -> 订单数量
+    :param random_seed: 随机数种子，相同的种子在空数据库中生成除用户名外相同的数据
+    :return: dict，每个表写入的行数
+    """
+    rng = random.Random(random_seed)
+    prefix = 'seed_%s_' % uuid.uuid4().hex[:8]
+    password = db_api.get_md5(SEED_PASSWORD)
+    now = datetime.now()
+    counts = {}
+    with db_api.db_conn() as conn:
+        cursor = conn.cursor()
+        start = max_id(cursor, 'User')
+        counts['User'] = copy_rows(cursor, 'User', ('username', 'password'),
+                                   ((prefix + str(i), password) for i in range(users)))
+        cursor.execute('select id from "User" where id > %s order by id', (start,))
+        user_ids = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+
+        start = max_id(cursor, 'Address')
+        counts['Address'] = copy_rows(cursor, 'Address', ('user_id', 'name', 'phone', 'location'), (
+            (rng.choice(user_ids), '收件人%d' % i, '138%08d' % i, '地址%d' % i) for i in range(addresses)))
+        cursor.execute('select id, user_id from "Address" where id > %s order by id', (start,))
+        address_ids = {}
+        for address_id, user_id in cursor.fetchall():
+            address_ids.setdefault(user_id, []).append(address_id)
+        conn.commit()
+
+        start = max_id(cursor, 'Goods')
+        counts['Goods'] = copy_rows(cursor, 'Goods', ('name', 'description', 'price', 'owner', 'exempt_postage'), (
+            (rng.choice(WORDS) + rng.choice(WORDS), ' '.join(rng.choice(WORDS) for _ in range(3)),
+             '%.2f' % (rng.random() * 1000), rng.choice(user_ids), rng.random() < 0.5) for _ in range(goods)))
+        cursor.execute('select id, owner from "Goods" where id > %s order by id', (start,))
+        goods_ids = cursor.fetchall()
+        conn.commit()
+
+        counts['Order'] = copy_rows(
+            cursor, 'Order', ('user_id', 'goods_id', 'state', 'address_id', 'express_code', 'express_company'),
+            generate_orders(rng, user_ids, goods_ids, address_ids, orders))
+        conn.commit()
+
+        counts['Comment'] = copy_rows(cursor, 'Comment', ('user_id', 'goods_id', 'content', 'create_at'), (
+            (rng.choice(user_ids), rng.choice(goods_ids)[0], '评论%d' % i,
+             now - timedelta(seconds=rng.randrange(365 * 24 * 3600))) for i in range(comments)))
+        conn.commit()
+
+        conn.autocommit = True
+        cursor.execute('analyze')
+        conn.autocommit = False
+    db_api.CACHE.clear()
+    return counts
+
+
+def add_arguments(parser):
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--goods', type=int, default=200000)
+    for name, state in ORDER_STATES.items():
+        parser.add_argument('--orders-' + name.replace('_', '-'), type=int, default=DEFAULT_ORDERS[state],
+                            help='%s的订单数量' % db_api.ORDER_STATE_MAP[state])
+    parser.add_argument('--comments', type=int, default=1000000)
+    parser.add_argument('--addresses', type=int, default=20000)
+    parser.add_argument('--random-seed', type=int, help='随机数种子')
+
+
+def order_counts(args):
+    """
+    功能：从add_arguments添加的命令行参数中取出每种状态的订单数量
+    :return: dict，订单状态 -> 订单数量
+    """
+    return {state: getattr(args, 'orders_' + name) for name, state in ORDER_STATES.items()}
+
+
+def seed_args(args):
+    """
+    功能：按add_arguments添加的命令行参数写入模拟数据
+    :return: seed的返回值
+    """
+    return seed(args.users, args.goods, order_counts(args), args.comments, args.addresses, args.random_seed)
+
+
+def main():
+    parser = make_parser(__doc__)
+    add_arguments(parser)
+    args = parser.parse_args()
+    configure(args.dsn)
+    counts = seed_args(args)
+    for table, count in counts.items():
+        print('%-8s %d rows' % (table, count))
+
+
+if __name__ == '__main__':
+    main()
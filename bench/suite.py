@@ -0,0 +1,572 @@
+"""
+端到端基准测试：测量db_api中每个公开函数和main.py中每个路由（通过Flask测试客户端）的延迟分位数和吞吐量，
+结果写为JSON，可以与之前保存的结果比较以发现性能退化。
+
+读操作随机选取数据库中已有的数据，--seed会先按bench.seed的参数写入模拟数据；写操作在计时之前用db_api准备好各自需要的
+商品、订单、评论和地址，因此可以在任何已执行迁移的测试数据库上重复运行。带缓存的函数同时测量经过缓存（name）和
+绕过缓存（name.uncached）的调用。db_api中没有用例的公开函数和main.py中没有用例的路由会列在结果的missing中。
+
+用法：python -m bench.suite --dsn <数据库连接串> [--seed] [--samples 200] [--concurrency 1] [--only <正则>]
+                         [--output result.json] [--compare baseline.json] [--threshold 1.25]
+"""
+import inspect
+import io
+import json
+import platform
+import random
+import re
+import subprocess
+import sys
+import threading
+import uuid
+from datetime import datetime
+
+import db_api
+from main import app
+from bench import make_parser, configure, ensure_user, timed, summarize, format_summary
+from bench.search import KEYWORDS
+from bench.seed import seed_args, add_arguments
+
+SAMPLE_SIZE = 1000  # 每个表随机选取的已有数据行数
+SAMPLE_LIMITS = {  # 单次调用耗时与数据量成正比的用例的最多调用次数
+    'db_api.get_goods_list': 20,
+    'db_api.get_goods_list.uncached': 20,
+    'db_api.recount_counters': 5,
+    'db_api.get_goods_images': 20,
+}
+SKIPPED = {
+    'get_pool': '连接池的借出和归还由db_conn测量',
+    'close_pool': '会丢弃连接池中的全部连接，影响其他用例',
+    'cached': '装饰器，由各个带缓存的函数测量',
+    'evict': '由各个写操作测量',
+    'commit_and_invalidate': '由各个写操作测量',
+    'get_listener': '后台线程，由CACHE_LISTEN控制',
+    'get_slow_query_log': '后台线程，由SLOW_QUERY_THRESHOLD控制',
+    'slow_query_report': '读取慢查询日志文件，不访问数据库',
+    'subscribe_events': '长连接的订阅，不访问连接池',
+}
+SKIPPED_ROUTES = {
+    'static': '静态文件不访问数据库',
+    'events': '长连接，一直推送事件直到客户端断开',
+}
+
+
+class Dataset:
+    """
+    各个用例共用的数据：从数据库中随机选取的已有数据，以及基准测试自己的卖家、买家和买家的地址。
+    new_*方法通过db_api创建写操作需要的数据并返回其id，可以在多个线程中同时调用。
+    """
+
+    def __init__(self, sample_size=SAMPLE_SIZE):
+        self.seller = ensure_user('bench_suite_seller')
+        self.buyer = ensure_user('bench_suite_buyer')
+        self.address = self.new_address()
+        goods_id, _ = self.new_order(db_api.ORDER_STATE_APPLIED)
+        db_api.create_comment(self.buyer, goods_id, 'bench')
+        with db_api.db_conn() as conn:
+            cursor = conn.cursor()
+            self.users = self._sample(cursor, 'select id, username from "User"', sample_size)
+            self.goods = [row[0] for row in self._sample(cursor, 'select id from "Goods"', sample_size)]
+            self.orders = self._sample(cursor, 'select user_id, goods_id from "Order"', sample_size)
+            self.commented = [row[0] for row in self._sample(cursor, 'select goods_id from "Comment"', sample_size)]
+
+    @staticmethod
+    def _sample(cursor, query, size):
+        cursor.execute(query + ' order by random() limit %s', (size,))
+        return cursor.fetchall()
+
+    def user(self):
+        return random.choice(self.users)
+
+    def goods_id(self):
+        return random.choice(self.goods)
+
+    def order(self):
+        return random.choice(self.orders)
+
+    def commented_goods(self):
+        return random.choice(self.commented)
+
+    def _find(self, query, params):
+        with db_api.db_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            return cursor.fetchone()[0]
+
+    def new_goods(self):
+        name = 'bench_suite_' + uuid.uuid4().hex
+        db_api.create_goods(self.seller, name, 'bench', None, 100, True)
+        return self._find('select id from "Goods" where owner = %s and name = %s', (self.seller, name))
+
+    def new_order(self, state):
+        """
+        功能：创建一个新商品，由买家申请，并依次转换到state（待处理、已同意、已确认或运输中）
+        :return: (商品id, 订单id)
+        """
+        goods_id = self.new_goods()
+        db_api.apply_order(self.buyer, goods_id)
+        order_id = db_api.get_order_by_user_and_goods(self.buyer, goods_id)['id']
+        if state >= db_api.ORDER_STATE_APPROVED:
+            db_api.approve_order(self.seller, goods_id, order_id)
+        if state >= db_api.ORDER_STATE_ESTABLISHED:
+            db_api.establish_order(self.buyer, goods_id, order_id, self.address)
+        if state >= db_api.ORDER_STATE_ON_ROAD:
+            db_api.deliver_goods(self.seller, goods_id, order_id, 'SF' + uuid.uuid4().hex[:12], '顺丰')
+        return goods_id, order_id
+
+    def new_comment(self, goods_id):
+        content = 'bench_suite_' + uuid.uuid4().hex
+        db_api.create_comment(self.buyer, goods_id, content)
+        return self._find('select id from "Comment" where user_id = %s and content = %s', (self.buyer, content))
+
+    def new_address(self):
+        name = 'bench_suite_' + uuid.uuid4().hex
+        db_api.create_address(self.buyer, name, '13800000000', 'bench')
+        return self._find('select id from "Address" where user_id = %s and name = %s', (self.buyer, name))
+
+
+def repeat(func, make_args):
+    """
+    功能：生成用例的调用，每次调用前用make_args()生成新的参数
+    """
+    while True:
+        args = make_args()
+        yield lambda: func(*args)
+
+
+def goods_filters():
+    return (random.choice(['', random.choice(KEYWORDS)]), random.choice(['all', 'yes', 'no']),
+            random.choice(['all', 'yes', 'no']), random.choice(['asc', 'desc', 'rank']))
+
+
+def read_cases(data):
+    """
+    功能：db_api中只读函数的参数生成函数
+    :return: dict，函数名 -> 返回参数元组的函数
+    """
+    return {
+        'get_md5': lambda: ('bench',),
+        'check_username_used': lambda: (data.user()[1],),
+        'login': lambda: ('bench_suite_buyer', 'bench'),
+        'get_user_info': lambda: (data.user()[0],),
+        'get_goods_list': goods_filters,
+        'get_goods_page': goods_filters,
+        'get_goods_list_version': tuple,
+        'get_goods_list_of_user': lambda: (data.user()[0],),
+        'get_goods_detail': lambda: (data.goods_id(),),
+        'get_goods_images': lambda: (random.choice([False, True]),),
+        'get_order_by_user_and_goods': data.order,
+        'get_orders_from_user': lambda: (data.user()[0],),
+        'get_orders_to_user': lambda: (data.user()[0],),
+        'get_comments': lambda: (data.commented_goods(), random.choice(['asc', 'desc'])),
+        'get_comment_page': lambda: (data.commented_goods(), random.choice(['asc', 'desc'])),
+        'get_address_list': lambda: (data.user()[0],),
+        'get_goods_detail_page': lambda: (data.goods_id(), data.user()[0]),
+        'get_manage_order_page': lambda: (data.user()[0],),
+        'get_user_versions': lambda: (data.user()[0],),
+        'get_goods_versions': lambda: (data.goods_id(),),
+        'get_cache_stats': tuple,
+        'render_metrics': tuple,
+        'normalize_query': lambda: ('select id from "Order" where user_id = %s and state in (%s, %s, 3)',),
+        'get_migrations': tuple,
+        'apply_migrations': tuple,
+        'recount_counters': tuple,
+    }
+
+
+def write_cases(data):
+    """
+    功能：db_api中写操作的用例，每个用例是一个生成器，先准备数据再产生要计时的调用
+    :return: dict，函数名 -> 生成器
+    """
+
+    def create_user():
+        while True:
+            username = 'bench_suite_' + uuid.uuid4().hex
+            yield lambda: db_api.create_user(username, 'bench')
+
+    def update_goods():
+        goods_id = data.new_goods()
+        while True:
+            price = random.randint(1, 1000)
+            yield lambda: db_api.update_goods(data.seller, goods_id, 'bench_suite_goods', 'bench', None, price, True)
+
+    def import_goods():
+        while True:
+            rows = [(line, {'name': 'bench_suite_import', 'price': line}) for line in range(1, 101)]
+            yield lambda: db_api.import_goods(data.seller, iter(rows))
+
+    def set_goods_thumbnails():
+        while True:
+            goods_id, img = data.new_goods(), '/static/images/bench_suite_%s.jpeg' % uuid.uuid4().hex
+            db_api.update_goods(data.seller, goods_id, 'bench_suite_goods', 'bench', img, 100, True)
+            yield lambda: db_api.set_goods_thumbnails(img, [{'width': 256, 'url': img + '.webp'}])
+
+    def order_transition(state, transition):
+        while True:
+            goods_id, order_id = data.new_order(state)
+            yield lambda: transition(goods_id, order_id)
+
+    def approve_orders():
+        while True:
+            order_ids = [data.new_order(db_api.ORDER_STATE_APPLIED)[1] for _ in range(10)]
+            yield lambda: db_api.approve_orders(data.seller, order_ids)
+
+    def deliver_orders(func):
+        while True:
+            shipments = [(data.new_order(db_api.ORDER_STATE_ESTABLISHED)[1], '顺丰', 'SF' + uuid.uuid4().hex[:12])
+                         for _ in range(10)]
+            yield lambda: func(data.seller, shipments)
+
+    def delete_comment():
+        while True:
+            goods_id = data.commented_goods()
+            comment_id = data.new_comment(goods_id)
+            yield lambda: db_api.delete_comment(data.buyer, goods_id, comment_id)
+
+    def delete_address():
+        while True:
+            address_id = data.new_address()
+            yield lambda: db_api.delete_address(data.buyer, address_id)
+
+    def connection():
+        with db_api.db_conn() as conn:
+            conn.cursor().execute('select 1')
+
+    applied, approved, established, on_road = (db_api.ORDER_STATE_APPLIED, db_api.ORDER_STATE_APPROVED,
+                                               db_api.ORDER_STATE_ESTABLISHED, db_api.ORDER_STATE_ON_ROAD)
+    return {
+        'get_db_conn': repeat(lambda: db_api.get_db_conn().close(), tuple),
+        'db_conn': repeat(connection, tuple),
+        'create_user': create_user(),
+        'create_goods': repeat(db_api.create_goods, lambda: (data.seller, 'bench_suite_goods', 'bench', None,
+                                                             random.randint(1, 1000), True)),
+        'update_goods': update_goods(),
+        'delete_goods': repeat(db_api.delete_goods, lambda: (data.seller, data.new_goods())),
+        'import_goods': import_goods(),
+        'set_goods_thumbnails': set_goods_thumbnails(),
+        'register_image': repeat(db_api.register_image, lambda: (
+            '/static/images/content/bench_suite_%s.jpeg' % uuid.uuid4().hex, 1024)),
+        'collect_images': repeat(db_api.collect_images, lambda: (lambda img: None,)),
+        'apply_order': repeat(db_api.apply_order, lambda: (data.buyer, data.new_goods())),
+        'abandon_order': order_transition(applied, lambda goods_id, _: db_api.abandon_order(data.buyer, goods_id)),
+        'approve_order': order_transition(applied, lambda goods_id, order_id: db_api.approve_order(
+            data.seller, goods_id, order_id)),
+        'establish_order': order_transition(approved, lambda goods_id, order_id: db_api.establish_order(
+            data.buyer, goods_id, order_id, data.address)),
+        'deliver_goods': order_transition(established, lambda goods_id, order_id: db_api.deliver_goods(
+            data.seller, goods_id, order_id, 'SF' + uuid.uuid4().hex[:12], '顺丰')),
+        'finish_order': order_transition(on_road, lambda goods_id, order_id: db_api.finish_order(
+            data.buyer, goods_id, order_id)),
+        'approve_orders': approve_orders(),
+        'deliver_orders': deliver_orders(db_api.deliver_orders),
+        'import_shipments': deliver_orders(db_api.import_shipments),
+        'create_comment': repeat(db_api.create_comment, lambda: (data.buyer, data.commented_goods(), 'bench')),
+        'delete_comment': delete_comment(),
+        'create_address': repeat(db_api.create_address, lambda: (data.buyer, 'bench_suite_address',
+                                                                 '13800000000', 'bench')),
+        'delete_address': delete_address(),
+    }
+
+
+def db_api_cases(data):
+    """
+    功能：db_api的全部用例，带缓存的只读函数另外生成一个name.uncached用例
+    :return: dict，用例名 -> 生成器
+    """
+    cases = {}
+    for name, make_args in read_cases(data).items():
+        func = getattr(db_api, name)
+        cases[name] = repeat(func, make_args)
+        if hasattr(func, 'uncached'):
+            cases[name + '.uncached'] = repeat(func.uncached, make_args)
+    cases.update(write_cases(data))
+    return cases
+
+
+def route_cases(data, client):
+    """
+    功能：main.py中每个路由的用例，计时前先设置好测试客户端的登录状态
+    :return: dict，用例名（方法和路由的endpoint）-> 生成器
+    """
+
+    def login_as(user_id=None, username=None):
+        with client.session_transaction() as session:
+            session.clear()
+            if user_id is not None:
+                session['logged_in'] = True
+                session['user_id'] = user_id
+                session['username'] = username
+
+    def request(method, user, make_request):
+        while True:
+            login_as(*user())
+            url, kwargs = make_request()
+            yield lambda: client.open(url, method=method, **kwargs)
+
+    def get(user, url):
+        return request('GET', user, lambda: (url(), {}))
+
+    def post(user, url, fields=None, files=None):
+        def make_request():
+            form = dict(fields() if fields else {})
+            if files:
+                form.update(files())
+                return url, {'data': form, 'content_type': 'multipart/form-data'}
+            return url, {'data': form}
+
+        return request('POST', user, make_request)
+
+    def anonymous():
+        return None, None
+
+    def seller():
+        return data.seller, 'bench_suite_seller'
+
+    def buyer():
+        return data.buyer, 'bench_suite_buyer'
+
+    def index_url():
+        key, exempt_postage, state, price = goods_filters()
+        return '/?key=%s&exempt_postage=%s&state=%s&price=%s' % (key, exempt_postage, state, price)
+
+    def order_url(state, make_url):
+        def url():
+            return make_url(*data.new_order(state))
+
+        return url
+
+    def shipments():
+        lines = ['%d,顺丰,SF%s' % (data.new_order(db_api.ORDER_STATE_ESTABLISHED)[1], uuid.uuid4().hex[:12])
+                 for _ in range(10)]
+        return {'file': (io.BytesIO('\n'.join(lines).encode('utf-8')), 'shipments.csv')}
+
+    def goods_file():
+        lines = ['name,price'] + ['bench_suite_import,%d' % price for price in range(1, 101)]
+        return {'file': (io.BytesIO('\n'.join(lines).encode('utf-8')), 'goods.csv')}
+
+    def comment_url():
+        goods_id = data.commented_goods()
+        return '/delete_comment?goods_id=%s&comment_id=%s' % (goods_id, data.new_comment(goods_id))
+
+    return {
+        'GET login': get(anonymous, lambda: '/login'),
+        'POST login': post(anonymous, '/login', lambda: {'username': 'bench_suite_buyer', 'password': 'bench'}),
+        'GET logout': get(buyer, lambda: '/logout'),
+        'GET signup': get(anonymous, lambda: '/signup'),
+        'POST signup': post(anonymous, '/signup', lambda: {'username': 'bench_suite_' + uuid.uuid4().hex,
+                                                           'password': 'bench'}),
+        'GET index': get(data.user, index_url),
+        'GET manage_goods': get(data.user, lambda: '/manage_goods'),
+        'POST add_goods': post(seller, '/add_goods', lambda: {'name': 'bench_suite_goods', 'description': 'bench',
+                                                              'price': random.randint(1, 1000)}),
+        'POST import_goods': post(seller, '/import_goods', files=goods_file),
+        'POST update_goods': post(seller, '/update_goods', lambda: {
+            'id': data.new_goods(), 'name': 'bench_suite_goods', 'description': 'bench', 'price': 100}),
+        'GET delete_goods': get(seller, lambda: '/delete_goods?id=%s' % data.new_goods()),
+        'GET goods_detail': get(data.user, lambda: '/goods_detail?id=%s' % data.goods_id()),
+        'GET comment_list': get(data.user, lambda: '/comment_list?id=%s' % data.commented_goods()),
+        'GET apply_order': get(buyer, lambda: '/apply_order?id=%s' % data.new_goods()),
+        'GET abandon_order': get(buyer, order_url(db_api.ORDER_STATE_APPLIED, lambda goods_id, _: (
+                '/abandon_order?id=%s' % goods_id))),
+        'GET manage_order': get(data.user, lambda: '/manage_order'),
+        'GET approve_order': get(seller, order_url(db_api.ORDER_STATE_APPLIED, lambda goods_id, order_id: (
+                '/approve_order?goods_id=%s&order_id=%s' % (goods_id, order_id)))),
+        'GET establish_order': get(buyer, order_url(db_api.ORDER_STATE_APPROVED, lambda goods_id, order_id: (
+                '/establish_order/%s/%s?address=%s' % (goods_id, order_id, data.address)))),
+        'POST deliver_goods': post(seller, '/deliver_goods', lambda: dict(zip(
+            ('goods_id', 'order_id'), data.new_order(db_api.ORDER_STATE_ESTABLISHED)),
+            code='SF' + uuid.uuid4().hex[:12], company='顺丰')),
+        'POST approve_orders': post(seller, '/approve_orders', lambda: {
+            'order_id': [data.new_order(db_api.ORDER_STATE_APPLIED)[1] for _ in range(10)]}),
+        'POST deliver_orders': post(seller, '/deliver_orders', files=shipments),
+        'GET finish_order': get(buyer, order_url(db_api.ORDER_STATE_ON_ROAD, lambda goods_id, order_id: (
+                '/finish_order/%s/%s' % (goods_id, order_id)))),
+        'POST add_comment': post(buyer, '/add_comment', lambda: {'id': data.commented_goods(), 'content': 'bench'}),
+        'GET delete_comment': get(buyer, comment_url),
+        'GET manage_address': get(data.user, lambda: '/manage_address'),
+        'POST add_address': post(buyer, '/add_address', lambda: {'name': 'bench_suite_address',
+                                                                 'phone': '13800000000', 'location': 'bench'}),
+        'GET delete_address': get(buyer, lambda: '/delete_address?id=%s' % data.new_address()),
+        'POST api_login': post(anonymous, '/api/v1/login', lambda: {'username': 'bench_suite_buyer',
+                                                                    'password': 'bench'}),
+        'GET api_goods_list': get(data.user, lambda: index_url().replace('/', '/api/v1/goods', 1)),
+        'GET api_goods_detail': get(data.user, lambda: '/api/v1/goods/%s' % data.goods_id()),
+        'GET api_comments': get(data.user, lambda: '/api/v1/goods/%s/comments' % data.commented_goods()),
+        'GET api_orders': get(data.user, lambda: '/api/v1/orders'),
+        'GET api_addresses': get(data.user, lambda: '/api/v1/addresses'),
+        'GET cache_stats': get(buyer, lambda: '/cache_stats'),
+        'GET metrics_endpoint': get(anonymous, lambda: '/metrics'),
+    }
+
+
+def missing_cases(functions, routes):
+    """
+    功能：找出没有用例的db_api公开函数和main.py路由
+    :param functions: db_api_cases的用例名
+    :param routes: route_cases的用例名
+    :return: 用例名list，路由为“方法 endpoint”
+    """
+    covered = set(functions) | set(SKIPPED)
+    missing = [name for name, value in vars(db_api).items() if inspect.isfunction(value)
+               and value.__module__ == db_api.__name__ and not name.startswith('_') and name not in covered]
+    covered = set(routes)
+    for rule in app.url_map.iter_rules():
+        for method in sorted(rule.methods - {'HEAD', 'OPTIONS'}):
+            name = '%s %s' % (method, rule.endpoint)
+            if name not in covered and rule.endpoint not in SKIPPED_ROUTES:
+                missing.append(name)
+    return missing
+
+
+def run_case(name, make_case, samples, concurrency):
+    """
+    功能：在concurrency个线程中共执行samples次用例，每个线程使用make_case()创建的生成器
+    :return: dict，summarize的结果，另有throughput（每秒调用次数，按各线程计时部分的耗时计算）和errors
+        （抛出异常、返回False、HTTP错误或重定向到?error=的次数，不计入延迟）
+    """
+    per_thread = [samples // concurrency + (1 if i < samples % concurrency else 0) for i in range(concurrency)]
+    latencies, errors, rates = [], [], []
+
+    def worker(count):
+        case = make_case()
+        busy, done = 0.0, 0
+        for _ in range(count):
+            call = next(case)
+            try:
+                result, elapsed = timed(call)
+            except Exception as err:
+                errors.append('%s: %s' % (type(err).__name__, err))
+                continue
+            if result is False or getattr(result, 'status_code', 200) >= 400 or \
+                    'error=' in (getattr(result, 'location', None) or ''):
+                errors.append('failed: %r' % result)
+                continue
+            latencies.append(elapsed)
+            busy += elapsed
+            done += 1
+        if busy:
+            rates.append(done / busy * 1000)
+
+    threads = [threading.Thread(target=worker, args=(count,)) for count in per_thread if count]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result = summarize(latencies) if latencies else {'count': 0}
+    result['throughput'] = sum(rates)
+    result['errors'] = len(errors)
+    if errors:
+        print('%-40s %d errors, first: %s' % (name, len(errors), errors[0]), file=sys.stderr)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def table_counts():
+    with db_api.db_conn() as conn:
+        cursor = conn.cursor()
+        counts = {}
+        for table in ('User', 'Address', 'Goods', 'Order', 'Comment'):
+            cursor.execute('select count(*) from "%s"' % table)
+            counts[table] = cursor.fetchone()[0]
+        return counts
+
+
+def compare(baseline, results, threshold):
+    """
+    功能：与之前的结果比较，p50或p95超过基准值的threshold倍视为性能退化
+    :return: [(用例名, 指标, 基准值, 当前值)...]
+    """
+    regressions = []
+    for name, current in results.items():
+        before = baseline.get('results', {}).get(name)
+        if not before or not before.get('count') or not current.get('count'):
+            continue
+        for metric in ('p50', 'p95'):
+            if current[metric] > before[metric] * threshold:
+                regressions.append((name, metric, before[metric], current[metric]))
+    return regressions
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--seed', action='store_true', help='先写入模拟数据，数量参数与bench.seed相同')
+    parser.add_argument('--samples', type=int, default=200, help='每个用例的调用次数')
+    parser.add_argument('--concurrency', type=int, default=1, help='每个用例同时调用的线程数')
+    parser.add_argument('--only', help='只运行名称匹配该正则表达式的用例')
+    parser.add_argument('--output', help='结果JSON文件，默认输出到标准输出')
+    parser.add_argument('--compare', help='之前保存的结果JSON文件，性能退化时返回非零退出码')
+    parser.add_argument('--threshold', type=float, default=1.25, help='判定为性能退化的倍数')
+    add_arguments(parser)
+    args = parser.parse_args()
+    db_api.CACHE_LISTEN = False
+    db_api.POOL_MAX_SIZE = max(db_api.POOL_MAX_SIZE, args.concurrency + 2)
+    configure(args.dsn)
+    db_api.apply_migrations()
+    if args.seed:
+        seed_args(args)
+
+    data = Dataset()
+    functions, routes = list(db_api_cases(data)), list(route_cases(data, app.test_client()))
+    cases = {'db_api.' + name: name for name in functions}
+    cases.update({'route ' + name: name for name in routes})
+    selected = [name for name in cases if args.only is None or re.search(args.only, name)]
+    results = {}
+    started = datetime.now()
+    for name in selected:
+        if name.startswith('db_api.'):
+            def make_case(name=name):
+                return db_api_cases(data)[cases[name]]
+        else:
+            def make_case(name=name):
+                return route_cases(data, app.test_client())[cases[name]]
+        samples = min(args.samples, SAMPLE_LIMITS.get(name, args.samples))
+        results[name] = run_case(name, make_case, samples, args.concurrency)
+        if results[name]['count']:
+            print(format_summary(name, results[name]) + ' %8.1f/s' % results[name]['throughput'], file=sys.stderr)
+
+    report = {
+        'meta': {
+            'started': started.isoformat(timespec='seconds'),
+            'duration': (datetime.now() - started).total_seconds(),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'samples': args.samples,
+            'concurrency': args.concurrency,
+            'rows': table_counts(),
+        },
+        'results': results,
+        'skipped': dict(SKIPPED, **{'route ' + endpoint: reason for endpoint, reason in SKIPPED_ROUTES.items()}),
+        'missing': missing_cases(functions, routes),
+    }
+    if report['missing']:
+        print('no benchmark case for: ' + ', '.join(report['missing']), file=sys.stderr)
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            baseline = json.load(file)
+        if baseline['meta'].get('concurrency') != args.concurrency:
+            print('warning: baseline was measured with --concurrency %s' % baseline['meta'].get('concurrency'),
+                  file=sys.stderr)
+        regressions = compare(baseline, results, args.threshold)
+        for name, metric, before, after in regressions:
+            print('regression %-40s %s %.3fms -> %.3fms (%.2fx)' % (name, metric, before, after, after / before),
+                  file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+"""
+订单状态转换压力测试：多个线程同时对同一个商品执行申请、同意和放弃，统计吞吐量、各操作的延迟和锁等待时间。
+
+锁等待时间通过另一个连接定期采样pg_stat_activity中等待锁（wait_event_type = 'Lock'）的连接数估算。
+--legacy使用引入订单状态机之前的多语句实现作为对照，两种模式使用相同的数据库结构和触发器。
+用法：python -m bench.transitions --dsn <数据库连接串> [--workers 32] [--duration 10] [--legacy]
+"""
+import random
+import threading
+import time
+
+import psycopg2
+
+import db_api
+from bench import make_parser, configure, ensure_user, timed, summarize, format_summary
+
+
+def legacy_apply_order(customer, goods_id):
+    with db_api.db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute('insert into "Order" (user_id, goods_id, state) values (%s, %s, %s)',
+                       (customer, goods_id, db_api.ORDER_STATE_APPLIED))
+        conn.commit()
+        return cursor.rowcount == 1
+
+
+def legacy_abandon_order(customer, goods_id):
+    with db_api.db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute('delete from "Order" where user_id = %s and goods_id = %s', (customer, goods_id))
+        if cursor.rowcount == 0:
+            return False
+        cursor.execute('update "Order" set state = %s where goods_id = %s and state = %s',
+                       (db_api.ORDER_STATE_APPLIED, goods_id, db_api.ORDER_STATE_OFF_SALE))
+        conn.commit()
+        return True
+
+
+def legacy_approve_order(owner, goods_id, order_id):
+    with db_api.db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute('update "Order" set state = %s where id = %s and goods_id = %s and goods_id in '
+                       '(select id from "Goods" where owner = %s)',
+                       (db_api.ORDER_STATE_APPROVED, order_id, goods_id, owner))
+        if cursor.rowcount == 0:
+            return False
+        cursor.execute('update "Order" set state = %s where goods_id = %s and id != %s',
+                       (db_api.ORDER_STATE_OFF_SALE, goods_id, order_id))
+        conn.commit()
+        return True
+
+
+class LockWaitSampler(threading.Thread):
+    """
+    每隔interval秒统计一次当前数据库中等待锁的连接数，乘以距上次采样的时间累加为lock_wait，即估算的锁等待总秒数。
+    """
+
+    def __init__(self, interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.lock_wait = 0.0
+        self.samples = 0
+        self.stop = threading.Event()
+
+    def run(self):
+        conn = db_api.get_db_conn()
+        conn.autocommit = True
+        cursor = conn.cursor()
+        last = time.monotonic()
+        try:
+            while not self.stop.is_set():
+                cursor.execute('select count(*) from pg_stat_activity '
+                               'where datname = current_database() and wait_event_type = %s', ('Lock',))
+                now = time.monotonic()
+                self.lock_wait += cursor.fetchone()[0] * (now - last)
+                self.samples += 1
+                last = now
+                time.sleep(self.interval)
+        finally:
+            conn.close()
+
+
+def deadlocks():
+    with db_api.db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute('select deadlocks from pg_stat_database where datname = current_database()')
+        return cursor.fetchone()[0]
+
+
+def applied_order(goods_id):
+    with db_api.db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute('select id from "Order" where goods_id = %s and state = %s limit 1',
+                       (goods_id, db_api.ORDER_STATE_APPLIED))
+        row = cursor.fetchone()
+    return None if row is None else row[0]
+
+
+def worker(operations, seller, buyers, goods_id, deadline, results):
+    apply_order, abandon_order, approve_order = operations
+    while time.monotonic() < deadline:
+        choice = random.random()
+        if choice < 0.5:
+            name, func, args = 'apply_order', apply_order, (random.choice(buyers), goods_id)
+        elif choice < 0.8:
+            name, func, args = 'abandon_order', abandon_order, (random.choice(buyers), goods_id)
+        else:
+            order_id = applied_order(goods_id)
+            if order_id is None:
+                continue
+            name, func, args = 'approve_order', approve_order, (seller, goods_id, order_id)
+        try:
+            success, elapsed = timed(func, *args)
+            outcome = 'ok' if success else 'rejected'
+        except psycopg2.Error as err:
+            elapsed, outcome = 0.0, type(err).__name__
+        results.append((name, outcome, elapsed))
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--workers', type=int, default=32, help='并发线程数')
+    parser.add_argument('--buyers', type=int, default=64, help='参与申请的买家数量')
+    parser.add_argument('--duration', type=float, default=10, help='运行秒数')
+    parser.add_argument('--sample-interval', type=float, default=0.002, help='锁等待的采样间隔秒数')
+    parser.add_argument('--legacy', action='store_true', help='使用引入订单状态机之前的多语句实现')
+    args = parser.parse_args()
+    db_api.POOL_MAX_SIZE = args.workers
+    db_api.CACHE_LISTEN = False
+    configure(args.dsn)
+
+    seller = ensure_user('bench_transitions_seller')
+    buyers = [ensure_user('bench_transitions_buyer_%d' % i) for i in range(args.buyers)]
+    db_api.create_goods(seller, 'bench_transitions_goods', 'bench_transitions_goods', None, 1, True)
+    goods_id = max(g['id'] for g in db_api.get_goods_list_of_user(seller))
+    if args.legacy:
+        operations = legacy_apply_order, legacy_abandon_order, legacy_approve_order
+    else:
+        operations = db_api.apply_order, db_api.abandon_order, db_api.approve_order
+
+    results = []
+    sampler = LockWaitSampler(args.sample_interval)
+    deadlocks_before = deadlocks()
+    sampler.start()
+    deadline = time.monotonic() + args.duration
+    threads = [threading.Thread(target=worker, args=(operations, seller, buyers, goods_id, deadline, results))
+               for _ in range(args.workers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    sampler.stop.set()
+    sampler.join()
+
+    mode = 'legacy' if args.legacy else 'transitions'
+    for name in ('apply_order', 'abandon_order', 'approve_order'):
+        samples = [result[2] for result in results if result[0] == name and result[2] > 0]
+        outcomes = {}
+        for result in results:
+            if result[0] == name:
+                outcomes[result[1]] = outcomes.get(result[1], 0) + 1
+        if samples:
+            print(format_summary('%s [%s]' % (name, mode), summarize(samples)))
+        print('%-40s %s' % ('', ' '.join('%s=%d' % item for item in sorted(outcomes.items()))))
+    print('%-40s %.1f ops/s (%d ops in %.1fs, %d workers)' % ('throughput', len(results) / elapsed, len(results),
+                                                               elapsed, args.workers))
+    print('%-40s %.3fs total, %.1f%% of worker time (%d samples)' % (
+        'lock wait', sampler.lock_wait, sampler.lock_wait / (elapsed * args.workers) * 100, sampler.samples))
+    print('%-40s %d' % ('deadlocks', deadlocks() - deadlocks_before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+# ===================================================================================================
+# Dependencies
+# ===================================================================================================
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+
+# ===================================================================================================
+# In-process cache
+# ===================================================================================================
+class TTLCache:
+    """
+    线程安全的进程内缓存，按LRU淘汰，每个条目在ttl秒后过期。
+
+    缓存的键为tuple，第一个元素为命名空间，可以通过delete_namespace一次删除某个命名空间下的全部条目。
+    条目数超过max_entries或估算的总字节数超过max_bytes时，淘汰最久未使用的条目。
+    每次删除操作都会使generation加一，读取数据前记录generation并在写入时传入，
+    可以避免读取期间发生的失效被随后写入的旧数据覆盖。
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, 字节数, 过期时间)
+        self._bytes = 0
+        self.generation = 0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    def get(self, key, default=None):
+        """
+        功能：读取缓存
+        :param key: 缓存键
+        :param default: 未命中或已过期时的返回值
+        :return: 缓存的值或default
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return default
+            if entry[2] <= time.monotonic():
+                self._remove(key)
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return default
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry[0]
+
+    def set(self, key, value, generation=None):
+        """
+        功能：写入缓存，值的大小按pickle后的字节数估算，超过max_bytes的值不会被缓存
+        :param key: 缓存键
+        :param value: 要缓存的值，调用方不应修改已缓存的值
+        :param generation: 读取value之前的generation，之后发生过删除时不写入
+        """
+        size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic() + self.ttl)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+
+    def delete(self, key):
+        """
+        功能：删除一个条目
+        :param key: 缓存键
+        """
+        with self._lock:
+            self.generation += 1
+            if key in self._entries:
+                self._remove(key)
+                self._stats['invalidations'] += 1
+
+    def delete_namespace(self, namespace):
+        """
+        功能：删除某个命名空间下的全部条目
+        :param namespace: 命名空间，即缓存键的第一个元素
+        """
+        with self._lock:
+            self.generation += 1
+            for key in [key for key in self._entries if key[0] == namespace]:
+                self._remove(key)
+                self._stats['invalidations'] += 1
+
+    def clear(self):
+        """
+        功能：清空缓存，不影响统计信息
+        """
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        功能：获取缓存的统计信息
+        :return: dict，字段如下：
+            hits: 命中次数
+            misses: 未命中次数（包括已过期）
+            evictions: 因容量限制被淘汰的条目数
+            expirations: 因过期被删除的条目数
+            invalidations: 因数据修改被删除的条目数
+            entries: 当前条目数
+            bytes: 当前估算的总字节数
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        return stats
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
@@ -1,9 +1,36 @@
 # ===================================================================================================
 # Dependencies
 # ===================================================================================================
-import psycopg2
+import base64
+import contextvars
+import datetime
+import inspect
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import select
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+from functools import wraps
 from hashlib import md5
 
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+import psycopg2.pool
+
+import metrics
+from cache import TTLCache
+from events import EventHub
+
 # ===================================================================================================
 # Constants
 # ===================================================================================================
@@ -41,6 +68,62 @@ ORDER_STATE_COLOR_MAP = {
     ORDER_STATE_OFF_SALE: 'bg-secondary',
 }
 
+# 数据库连接信息，注意：替换为自己的数据库信息
+DB_CONFIG = {
+    'database': 'TradingPlatform',
+    'user': 'postgres',
+    'password': '20021202xiaozx',
+    'host': '127.0.0.1',
+    'port': 5432,
+}
+
+# 连接池配置
+POOL_MIN_SIZE = 2  # 连接池创建时预先建立的连接数
+POOL_MAX_SIZE = 20  # 连接池最多持有的连接数，应小于数据库的max_connections
+POOL_TIMEOUT = 10  # 连接池耗尽时等待空闲连接的最长秒数
+POOL_CHECK_IDLE = 30  # 空闲超过该秒数的连接在借出前先执行一次健康检查
+
+GOODS_PAGE_SIZE = 20  # 交易大厅每页显示的商品数量
+COMMENT_PAGE_SIZE = 20  # 商品详情页每次加载的评论数量
+COMMENT_TIME_FORMAT = 'YYYY-MM-DD HH24:MI:SS'  # 评论发布时间的显示格式，在数据库中完成格式化
+ORDER_PAGE_SIZE = 20  # 订单管理页每个订单列表每页显示的订单数量
+SHIPMENT_BATCH_SIZE = 1000  # 批量导入快递信息时每个事务处理的订单数量
+GOODS_IMPORT_FIELDS = ('name', 'description', 'price', 'exempt_postage', 'img')  # 批量导入商品时每行的字段
+# 已经在使用同一图片的商品的缩略图，新建或更换图片的商品直接沿用，不用等待后台重新生成
+_SAME_IMAGE_THUMBNAILS = '(select t.thumbnails from "Goods" t where t.img = %s and t.thumbnails is not null limit 1)'
+IMAGE_GC_GRACE = 3600  # 秒，登记后未被任何商品使用的图片至少保留这么久才会被collect_images回收
+IMAGE_GC_BATCH_SIZE = 1000  # collect_images每次最多回收的图片数
+
+# 进程内缓存配置，缓存商品列表、商品详情、用户信息、评论和收货地址的查询结果
+CACHE_MAX_ENTRIES = 4096  # 最多缓存的条目数
+CACHE_MAX_BYTES = 64 * 1024 * 1024  # 缓存的总字节数上限（按pickle后的大小估算）
+CACHE_TTL = 60  # 缓存条目的过期秒数
+CACHE_LISTEN = True  # 是否通过LISTEN/NOTIFY接收其他进程的缓存失效通知，只有一个应用进程时可以设为False
+CACHE_CHANNEL = 'trading_platform_cache'  # 缓存失效通知的channel
+CACHE_NOTIFY_MAX_BYTES = 7900  # 一条缓存失效通知的最大字节数，PostgreSQL默认限制为8000字节
+NOTIFY_RETRY = 5  # 通知监听连接断开后的重连间隔秒数，也是监听连接的保活间隔
+
+# 订单和评论事件配置，由migrations/0014_events.sql中的触发器发送，通过/events推送给浏览器
+EVENT_CHANNEL = 'trading_platform_events'  # 事件通知的channel，与触发器中的一致
+EVENT_QUEUE_SIZE = 100  # 每个客户端最多积压的事件数，超过时改为通知客户端重新加载
+
+# 指标配置
+METRICS_ENABLED = True  # 是否统计每条语句的耗时、读取的行数和连接的借出次数，在建立连接时生效
+
+# 慢查询日志配置（需要METRICS_ENABLED）
+SLOW_QUERY_THRESHOLD = 0.2  # 执行时间超过该秒数的语句记入慢查询日志，为None时不记录
+SLOW_QUERY_LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'slow_query.log')
+SLOW_QUERY_LOG_MAX_BYTES = 10 * 1024 * 1024  # 日志文件超过该字节数后轮转
+SLOW_QUERY_LOG_BACKUPS = 5  # 保留的轮转日志文件数
+SLOW_QUERY_QUEUE_SIZE = 1000  # 等待写入的慢查询数量上限，队列满时丢弃新的慢查询
+SLOW_QUERY_EXPLAIN_RATE = 0.1  # 慢查询中重新执行EXPLAIN (ANALYZE, BUFFERS)获取执行计划的比例
+SLOW_QUERY_EXPLAIN_INTERVAL = 60  # 同一形状的语句两次获取执行计划之间的最短秒数
+SLOW_QUERY_EXPLAIN_TIMEOUT = 5  # 获取执行计划时的statement_timeout秒数
+
+# 数据库迁移脚本目录，脚本命名为<版本号>_<名称>.sql
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_LOCK_ID = 20221202  # 执行迁移时使用的advisory lock id
+
 
 # ===================================================================================================
 # Additional functions
@@ -54,17 +137,935 @@ def get_md5(password):
     return md5(password.encode('utf-8')).hexdigest()
 
 
+METRICS = metrics.Registry()
+QUERY_SECONDS = METRICS.histogram('tp_db_query_duration_seconds', '每条语句的执行时间，按调用的db_api函数区分',
+                                  ('function',))
+ROWS_FETCHED = METRICS.counter('tp_db_rows_fetched_total', '读取的行数，按调用的db_api函数区分', ('function',))
+CHECKOUTS = METRICS.counter('tp_db_checkouts_total', '从连接池借出连接的次数，按调用的db_api函数区分', ('function',))
+CONNECT_SECONDS = METRICS.histogram('tp_db_connect_duration_seconds', '新建数据库连接的耗时')
+SLOW_QUERIES = METRICS.counter('tp_db_slow_queries_total', '执行时间超过SLOW_QUERY_THRESHOLD的语句数', ('function',))
+_db_function = contextvars.ContextVar('db_function', default='other')
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """
+    记录每条语句的耗时和读取的行数的游标，按当前的db_api函数（见db_conn）计入METRICS和当前请求的统计。
+    """
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            _record_query(time.perf_counter() - start, query, vars)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            _record_query(time.perf_counter() - start, query)
+
+    def callproc(self, procname, parameters=None):
+        start = time.perf_counter()
+        try:
+            return super().callproc(procname, parameters)
+        finally:
+            _record_query(time.perf_counter() - start, procname)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            _record_query(time.perf_counter() - start, sql)
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            _record_rows(1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        _record_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        _record_rows(len(rows))
+        return rows
+
+
+def _record_query(elapsed, query, vars=None):
+    function = _db_function.get()
+    QUERY_SECONDS.observe(elapsed, function)
+    stats = metrics.current_request()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += elapsed
+    if SLOW_QUERY_THRESHOLD is not None and elapsed >= SLOW_QUERY_THRESHOLD:
+        SLOW_QUERIES.inc(1, function)
+        get_slow_query_log().add(query, vars, elapsed, function)
+
+
+def _record_rows(count):
+    if count:
+        ROWS_FETCHED.inc(count, _db_function.get())
+        stats = metrics.current_request()
+        if stats is not None:
+            stats.rows += count
+
+
+class SlowQueryLog(threading.Thread):
+    """
+    后台线程，将慢查询以JSON行的形式写入按大小轮转的日志文件SLOW_QUERY_LOG，每行的字段如下：
+        time: 记录时间，function: 调用的db_api函数，duration: 执行秒数，query: SQL文本（参数为占位符），
+        shape: 归一化后的语句形状（见normalize_query），params: 脱敏后的参数，plan: 执行计划文本或None，
+        plan_error: 获取执行计划失败的原因
+    执行语句的线程只把慢查询放入有界队列，不等待写入。执行计划在独立的连接上以只读事务重新执行
+    EXPLAIN (ANALYZE, BUFFERS)获取，只对SLOW_QUERY_EXPLAIN_RATE比例的慢查询获取，同一形状至少间隔
+    SLOW_QUERY_EXPLAIN_INTERVAL秒；会修改数据的语句在只读事务中无法ANALYZE，改为只获取EXPLAIN的估算计划。
+    语句通过PREPARE以通用计划执行，执行计划中不会出现参数值。
+    """
+
+    def __init__(self, path):
+        super().__init__(name='SlowQueryLog', daemon=True)
+        self.path = path
+        self.pid = os.getpid()
+        self.dropped = 0
+        self._queue = queue.Queue(SLOW_QUERY_QUEUE_SIZE)
+        self._explained = {}  # 语句形状 -> 上次获取执行计划的时间
+        self._conn = None
+        self._logger = logging.getLogger('db_api.slow_query')
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+
+    def add(self, query, vars, duration, function):
+        """
+        功能：记录一条慢查询，队列已满时丢弃
+        """
+        if isinstance(query, bytes):
+            query = query.decode('utf-8', 'replace')
+        try:
+            self._queue.put_nowait((time.time(), str(query), vars, duration, function))
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(self.path, maxBytes=SLOW_QUERY_LOG_MAX_BYTES,
+                                                       backupCount=SLOW_QUERY_LOG_BACKUPS, encoding='utf-8')
+        self._logger.addHandler(handler)
+        while True:
+            logged_at, query, vars, duration, function = self._queue.get()
+            shape = normalize_query(query)
+            entry = {
+                'time': datetime.datetime.fromtimestamp(logged_at).isoformat(timespec='milliseconds'),
+                'function': function,
+                'duration': round(duration, 6),
+                'query': query,
+                'shape': shape,
+                'params': _redact(vars),
+                'plan': None,
+            }
+            now = time.monotonic()
+            if re.match(r'\s*(select|with|insert|update|delete)\b', query, re.I) and \
+                    random.random() < SLOW_QUERY_EXPLAIN_RATE and \
+                    now - self._explained.get(shape, -SLOW_QUERY_EXPLAIN_INTERVAL) >= SLOW_QUERY_EXPLAIN_INTERVAL:
+                self._explained[shape] = now
+                try:
+                    entry['plan'] = self._explain(query, vars)
+                except psycopg2.Error as err:
+                    entry['plan_error'] = str(err).strip()
+            self._logger.info(json.dumps(entry, ensure_ascii=False, default=str))
+
+    def _explain(self, query, vars):
+        if self._conn is None or self._conn.closed:
+            # 不经过get_db_conn，获取执行计划的语句不计入指标，也不会再被记为慢查询；
+            # 连接上的事务都是只读的，force_generic_plan使执行计划中的参数显示为$n而不是参数值
+            self._conn = psycopg2.connect(**DB_CONFIG)
+            self._conn.set_session(readonly=True, autocommit=True)
+            cursor = self._conn.cursor()
+            cursor.execute('set statement_timeout = %s', (int(SLOW_QUERY_EXPLAIN_TIMEOUT * 1000),))
+            cursor.execute('set plan_cache_mode = force_generic_plan')
+        cursor = self._conn.cursor()
+        try:
+            cursor.execute('deallocate all')
+            target, values = query, None
+            if vars is not None:
+                prepared, values = _numbered_params(query, vars)
+                cursor.execute('prepare slow_query as ' + prepared)
+                target = 'execute slow_query'
+                if values:
+                    target += ' (%s)' % ', '.join(['%s'] * len(values))
+            try:
+                cursor.execute('explain (analyze, buffers) ' + target, values)
+            except psycopg2.errors.ReadOnlySqlTransaction:
+                cursor.execute('explain ' + target, values)
+            return '\n'.join(row[0] for row in cursor.fetchall())
+        except psycopg2.OperationalError:
+            self._conn.close()
+            raise
+
+
+_slow_query_log = None
+_slow_query_log_lock = threading.Lock()
+
+
+def get_slow_query_log():
+    """
+    功能：获取本进程的慢查询日志线程，首次调用时启动；fork出的子进程会启动自己的线程。
+    :return: SlowQueryLog
+    """
+    global _slow_query_log
+    log = _slow_query_log
+    if log is not None and log.pid == os.getpid():
+        return log
+    with _slow_query_log_lock:
+        if _slow_query_log is None or _slow_query_log.pid != os.getpid():
+            _slow_query_log = SlowQueryLog(SLOW_QUERY_LOG)
+            _slow_query_log.start()
+        return _slow_query_log
+
+
+def normalize_query(query):
+    """
+    功能：将SQL文本归一化为语句形状，用于聚合慢查询：参数占位符和常量替换为?，in (...)和array[...]中的多个值合并为一个，
+    空白合并为一个空格，关键字转为小写
+    :param query: SQL文本
+    :return: 语句形状
+    """
+    shape = re.sub(r"'(?:[^']|'')*'", '?', query)
+    shape = re.sub(r'%(?:\([^)]*\))?s|\$\d+|\b\d+(?:\.\d+)?\b', '?', shape)
+    shape = re.sub(r'\s+', ' ', shape).strip()
+    shape = re.sub(r'\(\s*\?(?:\s*,\s*\?)+\s*\)', '(?)', shape)
+    shape = re.sub(r'\[\s*\?(?:\s*,\s*\?)+\s*\]', '[?]', shape)
+    return re.sub(r'"[^"]*"|[a-z_]+', lambda match: match.group(0) if match.group(0).startswith('"') else
+                  match.group(0).lower(), shape, flags=re.I)
+
+
+def _numbered_params(query, vars):
+    # 将psycopg2的%s和%(name)s占位符转换为PREPARE使用的$n，返回(转换后的SQL, 按$n顺序排列的参数)
+    values, names = [], {}
+
+    def replace(match):
+        if match.group(0) == '%%':
+            return '%'
+        name = match.group(1)
+        if name is None:
+            values.append(vars[len(values)])
+            return '$%d' % len(values)
+        if name not in names:
+            values.append(vars[name])
+            names[name] = len(values)
+        return '$%d' % names[name]
+
+    return re.sub(r'%%|%(?:\(([^)]*)\))?s', replace, query), values
+
+
+def _redact(vars):
+    # 字符串只保留长度，数字、布尔值和None保留原值，list和dict逐项脱敏，最多保留20项
+    if vars is None or isinstance(vars, (bool, int, float, Decimal)):
+        return vars
+    if isinstance(vars, dict):
+        return {key: _redact(value) for key, value in itertools.islice(vars.items(), 20)}
+    if isinstance(vars, (list, tuple)):
+        redacted = [_redact(value) for value in vars[:20]]
+        if len(vars) > 20:
+            redacted.append('<%d more>' % (len(vars) - 20))
+        return redacted
+    if isinstance(vars, (str, bytes)):
+        return '<%s len=%d>' % (type(vars).__name__, len(vars))
+    return '<%s>' % type(vars).__name__
+
+
+def slow_query_report(path=SLOW_QUERY_LOG, sort='total'):
+    """
+    功能：按语句形状聚合慢查询日志（包括轮转出的旧文件）
+    :param path: 日志文件路径
+    :param sort: 排序字段，total为总耗时，count为次数，max为最长耗时，mean为平均耗时
+    :return: list，每一项为一种语句形状，按sort降序，字段如下：
+        shape: 语句形状
+        functions: 执行该语句的db_api函数list
+        count: 次数
+        total: 总秒数
+        mean: 平均秒数
+        max: 最长秒数
+        plan: 最慢的一次带执行计划的记录的执行计划，没有时为None
+    """
+    groups = {}
+    paths = [path] + ['%s.%d' % (path, i) for i in range(1, SLOW_QUERY_LOG_BACKUPS + 1)]
+    for filename in paths:
+        if not os.path.exists(filename):
+            continue
+        with open(filename, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                group = groups.setdefault(entry['shape'], {
+                    'shape': entry['shape'], 'functions': set(), 'count': 0, 'total': 0.0, 'max': 0.0,
+                    'plan': None, 'plan_duration': -1.0})
+                group['functions'].add(entry['function'])
+                group['count'] += 1
+                group['total'] += entry['duration']
+                group['max'] = max(group['max'], entry['duration'])
+                if entry.get('plan') and entry['duration'] > group['plan_duration']:
+                    group['plan'], group['plan_duration'] = entry['plan'], entry['duration']
+    report = []
+    for group in groups.values():
+        del group['plan_duration']
+        group['functions'] = sorted(group['functions'])
+        group['mean'] = group['total'] / group['count']
+        report.append(group)
+    report.sort(key=lambda group: group[sort], reverse=True)
+    return report
+
+
+def _caller_name(frame):
+    # 跳过db_api内部的辅助函数，使_transition_order等函数中的查询计入调用它的公开函数
+    while frame.f_code.co_name.startswith('_') and frame.f_globals is globals() and frame.f_back is not None:
+        frame = frame.f_back
+    return frame.f_code.co_name
+
+
+def render_metrics():
+    """
+    功能：输出数据库访问、连接池和缓存的指标，以及其他模块注册到METRICS的指标
+    :return: Prometheus文本格式的字符串
+    """
+    return METRICS.render()
+
+
 def get_db_conn():
     """
-    功能：获取数据库连接
-    注意：替换为自己的数据库信息
+    功能：建立一个新的数据库连接（不经过连接池）
+    注意：数据库信息在DB_CONFIG中配置；业务函数应使用db_conn()从连接池借用连接
+    :return: psycopg2.connect
+    """
+    if not METRICS_ENABLED:
+        return psycopg2.connect(**DB_CONFIG)
+    start = time.perf_counter()
+    conn = psycopg2.connect(cursor_factory=InstrumentedCursor, **DB_CONFIG)
+    CONNECT_SECONDS.observe(time.perf_counter() - start)
+    stats = metrics.current_request()
+    if stats is not None:
+        stats.connects += 1
+    return conn
+
+
+class PoolTimeoutError(psycopg2.pool.PoolError):
+    """
+    连接池在POOL_TIMEOUT秒内没有可用连接时抛出。
+    """
+
+
+class ConnectionPool:
+    """
+    线程安全的数据库连接池。
+
+    每个连接同一时间只会被一个线程借用；连接池耗尽时借用方最多等待timeout秒。
+    借出前会检查连接状态，空闲时间超过check_idle秒的连接还会执行一次select 1，失效的连接会被替换为新连接。
+    stats记录连接池的运行情况：connects为新建连接数，checkouts为借出次数，waits为等待次数，discards为丢弃的失效连接数。
+    """
+
+    def __init__(self, min_size, max_size, timeout, check_idle, connect=get_db_conn):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError('invalid pool size: min_size=%s, max_size=%s' % (min_size, max_size))
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self.pid = os.getpid()
+        self.stats = {'connects': 0, 'checkouts': 0, 'waits': 0, 'discards': 0}
+        self._connect = connect
+        self._cond = threading.Condition()
+        self._idle = []  # (conn, 归还时间)，后进先出，使常用连接保持活跃
+        self._size = 0  # 已建立（空闲 + 借出）的连接数
+        self._closed = False
+        for _ in range(min_size):
+            self._idle.append((self._new_conn(), time.monotonic()))
+            self._size += 1
+
+    def _new_conn(self):
+        conn = self._connect()
+        with self._cond:
+            self.stats['connects'] += 1
+        return conn
+
+    def _healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if time.monotonic() - idle_since < self.check_idle:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute('select 1')
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def getconn(self):
+        """
+        功能：借出一个连接，连接池耗尽时等待，超时抛出PoolTimeoutError。
+        :return: psycopg2.connect
+        """
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise psycopg2.pool.PoolError('connection pool is closed')
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    conn, idle_since = None, None
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeoutError('no connection available within %s seconds' % self.timeout)
+                self.stats['waits'] += 1
+                self._cond.wait(remaining)
+            self.stats['checkouts'] += 1
+        if conn is not None and not self._healthy(conn, idle_since):
+            with self._cond:
+                self.stats['discards'] += 1
+            self._close(conn)
+            conn = None
+        if conn is None:
+            try:
+                conn = self._new_conn()
+            except BaseException:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+        return conn
+
+    def putconn(self, conn):
+        """
+        功能：归还连接。未提交的事务会被回滚，已关闭或无法回滚的连接会被丢弃。
+        :param conn: 由getconn借出的连接
+        """
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                self._close(conn)
+        with self._cond:
+            if conn.closed or self._closed:
+                self._close(conn)
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        """
+        功能：关闭连接池中的所有空闲连接，之后不能再借出连接；已借出的连接在归还时关闭。
+        """
+        with self._cond:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._close(conn)
+            self._size -= len(self._idle)
+            self._idle = []
+            self._cond.notify_all()
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    功能：获取进程内共享的连接池，首次调用时按POOL_*配置创建；fork出的子进程会创建自己的连接池。
+    :return: ConnectionPool
+    """
+    global _pool
+    pool = _pool
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = ConnectionPool(POOL_MIN_SIZE, POOL_MAX_SIZE, POOL_TIMEOUT, POOL_CHECK_IDLE)
+        return _pool
+
+
+def close_pool():
+    """
+    功能：关闭进程内的连接池，下一次调用get_pool()时会重新创建。
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool.pid == os.getpid():
+            _pool.closeall()
+        _pool = None
+
+
+@contextmanager
+def db_conn():
+    """
+    功能：从连接池借出一个数据库连接，with块结束时自动归还，未提交的事务会被回滚。
+    用法：
+        with db_conn() as conn:
+            cursor = conn.cursor()
+            ...
+            conn.commit()
     :return: psycopg2.connect
     """
-    return psycopg2.connect(database='TradingPlatform',
-                            user='postgres',
-                            password='20021202xiaozx',
-                            host='127.0.0.1',
-                            port=5432)
+    pool = get_pool()
+    conn = pool.getconn()
+    token = None
+    if METRICS_ENABLED:
+        # 调用栈：db_conn <- contextmanager.__enter__ <- 调用方
+        function = _caller_name(sys._getframe(2))
+        token = _db_function.set(function)
+        CHECKOUTS.inc(1, function)
+        stats = metrics.current_request()
+        if stats is not None:
+            stats.connections += 1
+    try:
+        yield conn
+    finally:
+        if token is not None:
+            _db_function.reset(token)
+        pool.putconn(conn)
+
+
+def get_migrations(migrations_dir=MIGRATIONS_DIR):
+    """
+    功能：列出迁移脚本
+    :param migrations_dir: 迁移脚本目录
+    :return: 按版本号升序排列的list，每一项为(版本号, 文件名)
+    """
+    migrations = []
+    for filename in os.listdir(migrations_dir):
+        version, _, _ = filename.partition('_')
+        if filename.endswith('.sql') and version.isdigit():
+            migrations.append((int(version), filename))
+    migrations.sort()
+    return migrations
+
+
+def apply_migrations(migrations_dir=MIGRATIONS_DIR):
+    """
+    功能：按版本号顺序执行尚未执行的迁移脚本，已执行的版本记录在"SchemaMigration"表中，可以重复调用。
+    每个脚本在单独的事务中执行；多个进程同时调用时通过advisory lock依次执行。
+    :param migrations_dir: 迁移脚本目录
+    :return: 本次执行的迁移脚本文件名列表
+    """
+    applied = []
+    with db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute('select pg_advisory_lock(%s)', (MIGRATION_LOCK_ID,))
+        try:
+            cursor.execute('create table if not exists "SchemaMigration" (version int4 primary key not null, '
+                           'name varchar(255), applied_at timestamp default current_timestamp)')
+            conn.commit()
+            cursor.execute('select version from "SchemaMigration"')
+            done = {row[0] for row in cursor.fetchall()}
+            for version, filename in get_migrations(migrations_dir):
+                if version in done:
+                    continue
+                with open(os.path.join(migrations_dir, filename), encoding='utf-8') as file:
+                    cursor.execute(file.read())
+                cursor.execute('insert into "SchemaMigration" (version, name) values (%s, %s)', (version, filename))
+                conn.commit()
+                applied.append(filename)
+        finally:
+            conn.rollback()
+            cursor.execute('select pg_advisory_unlock(%s)', (MIGRATION_LOCK_ID,))
+            conn.commit()
+    return applied
+
+
+def recount_counters():
+    """
+    功能：根据"Order"表、"Comment"表和"Goods"表重新计算"User".sale_count、"Goods".apply_count、"Goods".on_sale、
+    "Goods".comment_count和"Image".ref_count。这些字段由触发器维护，正常情况下不需要调用，只用于修复手动修改数据等原因
+    造成的不一致。计算期间"Order"表、"Comment"表和"Goods"表不能写入。
+    :return: 被修正的行数
+    """
+    with db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute('select recount_order_counters() + recount_comment_counts() + recount_image_ref_counts()')
+        fixed = cursor.fetchone()[0]
+        commit_and_invalidate(conn, ('get_user_info',), ('get_goods_detail',), *_goods_keys())
+    return fixed
+
+
+CACHE = TTLCache(CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, CACHE_TTL)
+EVENTS = EventHub(EVENT_QUEUE_SIZE)
+
+
+def _cache_key(namespace, args):
+    # 路由传入的id是字符串，统一转换为int，使'5'和5对应同一个缓存条目
+    return (namespace,) + tuple(int(arg) if isinstance(arg, str) and arg.isdigit() else arg for arg in args)
+
+
+def cached(func=None, normalize=None):
+    """
+    功能：缓存函数的返回值，缓存键为函数名和全部参数（包括默认值），返回None时不缓存。
+    被缓存的函数读取的数据发生变化时，写入方需要通过commit_and_invalidate删除相应条目。
+    CACHE_LISTEN为True时，只有在本进程的通知监听连接正常时才使用缓存，否则直接查询数据库。
+    用法：@cached，或@cached(normalize={参数名: 转换函数})
+    :param func: 要缓存的函数或协程函数（async_db_api中的函数，与db_api的同名函数共用缓存条目），参数必须是可哈希的
+    :param normalize: dict，参数名 -> 转换函数。计算缓存键和调用func之前先转换这些参数，使等价的取值对应同一个缓存条目，
+        写入方只需删除转换后的取值对应的条目
+    :return: 带缓存的函数，原函数可以通过uncached属性调用
+    """
+    if func is None:
+        return lambda func: cached(func, normalize)
+    signature = inspect.signature(func)
+    normalize = normalize or {}
+    missing = object()
+
+    def lookup(args, kwargs):
+        # 返回(转换后的参数, 缓存键, 缓存的值或missing, 读取数据库之前的generation)；不使用缓存时返回None
+        if CACHE_LISTEN and not get_listener().connected.is_set():
+            return None
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        for name, convert in normalize.items():
+            bound.arguments[name] = convert(bound.arguments[name])
+        key = _cache_key(func.__name__, bound.arguments.values())
+        return bound, key, CACHE.get(key, missing), CACHE.generation
+
+    def store(key, value, generation):
+        if value is not None:
+            CACHE.set(key, value, generation)
+
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            found = lookup(args, kwargs)
+            if found is None:
+                return await func(*args, **kwargs)
+            bound, key, value, generation = found
+            if value is missing:
+                value = await func(*bound.args, **bound.kwargs)
+                store(key, value, generation)
+            return value
+    else:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            found = lookup(args, kwargs)
+            if found is None:
+                return func(*args, **kwargs)
+            bound, key, value, generation = found
+            if value is missing:
+                value = func(*bound.args, **bound.kwargs)
+                store(key, value, generation)
+            return value
+
+    wrapper.uncached = func
+    return wrapper
+
+
+def evict(keys):
+    """
+    功能：删除本进程中的缓存条目
+    :param keys: 缓存键list，每个键为(函数名, 参数...)；只有函数名时删除该函数的全部条目
+    """
+    for key in keys:
+        if len(key) == 1:
+            CACHE.delete_namespace(key[0])
+        else:
+            CACHE.delete(tuple(key))
+
+
+def commit_and_invalidate(conn, *keys):
+    """
+    功能：提交事务，并删除所有进程中keys对应的缓存条目。
+    通知在提交前通过pg_notify写入同一事务，只有事务提交后其他进程才会收到；本进程的条目在提交后立即删除。
+    :param conn: 要提交的连接
+    :param keys: 缓存键，每个键为(函数名, 参数...)；只有函数名时删除该函数的全部条目
+    """
+    keys, payload = _invalidation(keys)
+    if keys:
+        cursor = conn.cursor()
+        cursor.execute('select pg_notify(%s, %s)', (CACHE_CHANNEL, payload))
+    conn.commit()
+    evict(keys)
+
+
+def _invalidation(keys):
+    """
+    功能：将commit_and_invalidate的缓存键规范化并编码为通知内容
+    :return: (规范化的缓存键list, 通知内容)
+    """
+    keys = [_cache_key(key[0], key[1:]) for key in keys]
+    payload = json.dumps(keys)
+    if len(payload.encode('utf-8')) > CACHE_NOTIFY_MAX_BYTES:
+        # 通知内容有长度限制，键太多时改为删除这些函数的全部条目
+        keys = [(namespace,) for namespace in sorted({key[0] for key in keys})]
+        payload = json.dumps(keys)
+    return keys, payload
+
+
+def get_cache_stats():
+    """
+    功能：获取进程内缓存的命中、未命中和淘汰等统计信息，用于确定缓存容量
+    :return: dict，字段见TTLCache.stats
+    """
+    return CACHE.stats()
+
+
+@METRICS.collector
+def _pool_metrics():
+    pool = _pool
+    if pool is None:
+        return []
+    return [('tp_pool_%s_total' % key, 'counter', '连接池统计：%s' % key, value) for key, value in pool.stats.items()]
+
+
+@METRICS.collector
+def _event_metrics():
+    collected = []
+    for key, value in EVENTS.stats().items():
+        if key == 'subscribers':
+            collected.append(('tp_event_%s' % key, 'gauge', '事件推送统计：%s' % key, value))
+        else:
+            collected.append(('tp_event_%s_total' % key, 'counter', '事件推送统计：%s' % key, value))
+    return collected
+
+
+@METRICS.collector
+def _cache_metrics():
+    collected = []
+    for key, value in CACHE.stats().items():
+        if key in ('entries', 'bytes'):
+            collected.append(('tp_cache_%s' % key, 'gauge', '进程内缓存统计：%s' % key, value))
+        else:
+            collected.append(('tp_cache_%s_total' % key, 'counter', '进程内缓存统计：%s' % key, value))
+    return collected
+
+
+def _goods_keys(goods_id=None):
+    """
+    功能：商品信息或状态发生变化后需要删除的缓存键
+    :param goods_id: 发生变化的商品id，为None时只包括商品列表
+    """
+    keys = [('get_goods_list',), ('get_goods_page',)]
+    if goods_id is not None:
+        keys.append(('get_goods_detail', goods_id))
+    return keys
+
+
+def _comment_keys(goods_id):
+    # get_comments的order参数只会是asc或desc（见_comment_direction），每个商品只有这两个缓存条目
+    return [('get_comments', goods_id, 'asc'), ('get_comments', goods_id, 'desc')]
+
+
+class NotificationListener(threading.Thread):
+    """
+    后台线程，在一个独立于连接池的数据库连接上LISTEN若干channel，收到通知后调用对应的处理函数。
+    连接断开或处理函数出错后每隔NOTIFY_RETRY秒重连。断开期间的通知会丢失，因此连接建立和断开时都会调用on_reset。
+    connected在LISTEN成功后被设置，连接断开时（包括线程因异常结束时）被清除。
+    """
+
+    def __init__(self, handlers, on_reset):
+        super().__init__(name='NotificationListener', daemon=True)
+        self.handlers = handlers  # channel -> 处理函数(payload)
+        self.on_reset = on_reset
+        self.connected = threading.Event()
+        self.pid = os.getpid()
+
+    def run(self):
+        while True:
+            try:
+                self._listen()
+            except Exception as err:  # 通知内容或处理函数出错时同样重连，不能让监听线程结束而connected仍被设置
+                print(err)
+            finally:
+                self.connected.clear()
+                self.on_reset()
+            time.sleep(NOTIFY_RETRY)
+
+    def _listen(self):
+        conn = get_db_conn()
+        try:
+            conn.autocommit = True
+            cursor = conn.cursor()
+            for channel in self.handlers:
+                cursor.execute('listen %s' % psycopg2.extensions.quote_ident(channel, cursor))
+            self.on_reset()
+            self.connected.set()
+            while True:
+                if select.select([conn], [], [], NOTIFY_RETRY) == ([], [], []):
+                    cursor.execute('select 1')
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    self.handlers[notify.channel](notify.payload)
+        finally:
+            conn.close()
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def get_listener():
+    """
+    功能：获取本进程的通知监听线程，首次调用时启动；fork出的子进程会启动自己的监听线程。
+    :return: NotificationListener
+    """
+    global _listener
+    listener = _listener
+    if listener is not None and listener.pid == os.getpid():
+        return listener
+    with _listener_lock:
+        if _listener is None or _listener.pid != os.getpid():
+            _listener = NotificationListener({CACHE_CHANNEL: _on_cache_notification,
+                                              EVENT_CHANNEL: _on_event_notification}, _on_listener_reset)
+            _listener.start()
+        return _listener
+
+
+def _on_cache_notification(payload):
+    evict(json.loads(payload))
+
+
+def _on_event_notification(payload):
+    event = json.loads(payload)
+    if event['type'] == 'order':
+        topics = [('user', event['user_id']), ('user', event['seller'])]
+    else:
+        topics = [('goods', event['goods_id'])]
+    EVENTS.publish(topics, event)
+
+
+def _on_listener_reset():
+    # 断开期间的缓存失效通知和事件都可能丢失
+    CACHE.clear()
+    EVENTS.reset()
+
+
+def subscribe_events(user_id, goods_id=None, timeout=NOTIFY_RETRY):
+    """
+    功能：订阅本进程收到的订单和评论事件。本进程的全部订阅共用get_listener的一个数据库连接，不占用连接池。
+    先等待监听连接建立再订阅，以免刚订阅就因为连接建立而收到RESET；等待超时时照常订阅，连接建立后会收到RESET。
+    :param user_id: 接收该用户作为买家或卖家的订单的状态变化
+    :param goods_id: 不为None时还接收该商品的评论增删
+    :param timeout: 等待监听连接建立的最长秒数
+    :return: events.Subscription，事件为dict，字段见migrations/0014_events.sql；使用完毕后必须调用close
+    """
+    get_listener().connected.wait(timeout)
+    return EVENTS.subscribe(_event_topics(user_id, goods_id))
+
+
+def _event_topics(user_id, goods_id):
+    topics = [('user', int(user_id))]
+    if goods_id is not None:
+        topics.append(('goods', int(goods_id)))
+    return topics
+
+
+def _encode_cursor(direction, *values):
+    """
+    功能：将翻页方向和当前页边界行的排序键编码为URL安全的游标字符串
+    :param direction: next或prev
+    :param values: 排序键的值，可以为None
+    :return: 游标字符串
+    """
+    data = json.dumps([direction] + [None if value is None else str(value) for value in values]).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def _decode_cursor(cursor, *parsers):
+    """
+    功能：解码_encode_cursor生成的游标
+    :param cursor: 游标字符串，可以为None
+    :param parsers: 将每个排序键字符串转换为查询参数的函数
+    :return: [方向, 排序键...]；游标为None或无效时返回None
+    """
+    if not cursor:
+        return None
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        position = json.loads(data.decode('utf-8'))
+        if not isinstance(position, list) or len(position) != len(parsers) + 1 or position[0] not in ('next', 'prev'):
+            return None
+        return [position[0]] + [parse(value) for parse, value in zip(parsers, position[1:])]
+    except (ValueError, TypeError, ArithmeticError):
+        return None
+
+
+def _keyset_page(rows, page_size, position, key):
+    """
+    功能：整理keyset分页查询的结果，查询需要按翻页方向排序并多取一行（limit page_size + 1）
+    :param rows: 查询结果list
+    :param page_size: 每页的行数
+    :param position: _decode_cursor的返回值，第一页为None
+    :param key: 返回某一行排序键tuple的函数
+    :return: (本页的行list, 下一页的游标, 上一页的游标)，没有下一页或上一页时游标为None
+    """
+    backward = position is not None and position[0] == 'prev'
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backward:
+        rows.reverse()
+    has_next = has_more if not backward else True
+    has_prev = has_more if backward else position is not None
+    next_cursor = _encode_cursor('next', *key(rows[-1])) if has_next and rows else None
+    prev_cursor = _encode_cursor('prev', *key(rows[0])) if has_prev and rows else None
+    return rows, next_cursor, prev_cursor
+
+
+def _run_query(statement):
+    """
+    功能：借出一个连接执行一条查询。查询由各个函数对应的_xxx_statement生成，async_db_api执行相同的语句。
+    :param statement: (查询, 参数, 函数(结果行list) -> 返回值)
+    :return: 该函数的返回值
+    """
+    query, params, result = statement
+    with db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+    return result(rows)
+
+
+def _run_update(statement):
+    """
+    功能：借出一个连接执行一条写入语句，修改了数据时提交并删除相应的缓存条目，否则回滚
+    :param statement: (语句, 参数, 缓存键list)
+    :return: 如果修改了数据，返回True；否则返回False
+    """
+    query, params, keys = statement
+    with db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        if cursor.rowcount == 0:
+            conn.rollback()
+            return False
+        commit_and_invalidate(conn, *keys)
+        return True
+
+
+def _one(item):
+    # _xxx_statement的结果函数：结果最多一行，没有结果时返回None
+    return lambda rows: item(rows[0]) if rows else None
+
+
+def _all(item):
+    # _xxx_statement的结果函数：返回每一行转换后的list
+    return lambda rows: [item(row) for row in rows]
 
 
 # =========================================== 大作业分数组成 ===========================================
@@ -84,16 +1085,11 @@ def check_username_used(username):
     :param username: 要检测的用户名
     :return: 如果用户名已被注册，返回True；否则返回False。
     """
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    query = 'select * from "User" where username = %s'
-    cursor.execute(query, (username,))
-    user = cursor.fetchone()
-    conn.close()
-    if user is not None:
-        return True
-    else:
-        return False
+    return _run_query(_check_username_used_statement(username))
+
+
+def _check_username_used_statement(username):
+    return 'select * from "User" where username = %s', (username,), lambda rows: len(rows) > 0
 
 
 def create_user(username, password):
@@ -104,20 +1100,15 @@ def create_user(username, password):
     :param password: 用户明文密码，建议存储时使用md5加密
     :return: 如果创建成功，返回True；否则返回False。
     """
-    password = get_md5(password)
-    success = True
     try:
-        conn = get_db_conn()
-        cursor = conn.cursor()
-        query = 'insert into "User" (username, password) values (%s, %s)'
-        cursor.execute(query, (username, password))
-        conn.commit()
+        return _run_update(_create_user_statement(username, password))
     except psycopg2.Error as err:
-        success = False
         print(err)
-    else:
-        conn.close()
-    return success
+        return False
+
+
+def _create_user_statement(username, password):
+    return 'insert into "User" (username, password) values (%s, %s)', (username, get_md5(password)), []
 
 
 def login(username, password):
@@ -128,17 +1119,15 @@ def login(username, password):
     :param password: 用户明文密码
     :return: 如果登录成功，返回用户id；否则返回None
     """
-    password = get_md5(password)
-    conn = get_db_conn()
-    cursor = conn.cursor()
+    return _run_query(_login_statement(username, password))
+
+
+def _login_statement(username, password):
     query = 'select id from "User" where username = %s and password = %s'
-    cursor.execute(query, (username, password))
-    user = cursor.fetchone()
-    user_id = user[0] if user is not None else None
-    conn.close()
-    return user_id
+    return query, (username, get_md5(password)), _one(lambda row: row[0])
 
 
+@cached
 def get_user_info(user_id):
     """
     功能：获取用户信息摘要，用于商品详情页中显示卖家的信息。
@@ -146,25 +1135,35 @@ def get_user_info(user_id):
     :param user_id: 要获取的用户id
     :return: 如果获取用户信息失败，返回None；否则返回包含如下字段的dict：
         username: 字符串，该用户的名称
-        sale_count: 数字，该用户卖出的商品数量（即完成的订单数）
-    """
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    query = 'select username from "User" where id = %s'
-    cursor.execute(query, (user_id,))
-    user = cursor.fetchone()
-    username = user[0] if user is not None else None
-    query = 'select count(*) from "Order" where user_id = %s and state = %s'
-    cursor.execute(query, (user_id, ORDER_STATE_FINISHED))
-    sale_count = cursor.fetchone()[0]
-    conn.close()
-    if username is None:
-        return None
-    else:
-        return {
-            'username': username,
-            'sale_count': sale_count
-        }
+        sale_count: 数字，该用户卖出的商品数量（即该用户发布的商品中已完成的订单数）
+    """
+    return _run_query(_get_user_info_statement(user_id))
+
+
+def _get_user_info_statement(user_id):
+    return 'select username, sale_count from "User" where id = %s', (user_id,), _one(lambda row: {
+        'username': row[0],
+        'sale_count': row[1]
+    })
+
+
+def get_user_versions(user_id):
+    """
+    功能：读取用户的订单和收货地址的变更版本，用于JSON接口的ETag。每个版本只需一次索引查找，与订单数量无关。
+    :param user_id: 用户id
+    :return: 用户不存在时返回None；否则返回dict，字段如下：
+        orders_version: 用户发起的或收到的订单、或这些订单的商品每次改变时增大（"OrderChange"）
+        addresses_version: 字符串，用户的收货地址每次增删时改变
+    """
+    return _run_query(_get_user_versions_statement(user_id))
+
+
+def _get_user_versions_statement(user_id):
+    query = 'select user_orders_version(id), user_addresses_version(id) from "User" where id = %s'
+    return query, (user_id,), _one(lambda row: {
+        'orders_version': row[0],
+        'addresses_version': row[1]
+    })
 
 
 # ======================= 商品接口 (2 + 2 + 5 + 3 + 2 + 3 = 17分) ======================= #
@@ -180,17 +1179,13 @@ def create_goods(owner, name, description, img, price, exempt_postage):
     :param exempt_postage: 商品是否包邮，布尔值，True表示包邮，False表示不包邮
     :return: 如果创建成功，返回True；否则返回False。
     """
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    query = 'insert into "Goods" (owner, name, description, img, price, exempt_postage) values (%s, %s, %s, %s, %s, %s)'
-    cursor.execute(query, (owner, name, description, img, price, exempt_postage))
-    if cursor.rowcount == 0:
-        conn.close()
-        return False
-    else:
-        conn.commit()
-        conn.close()
-        return True
+    return _run_update(_create_goods_statement(owner, name, description, img, price, exempt_postage))
+
+
+def _create_goods_statement(owner, name, description, img, price, exempt_postage):
+    query = 'insert into "Goods" (owner, name, description, img, price, exempt_postage, thumbnails) values (%s, %s, ' \
+            '%s, %s, %s, %s, ' + _SAME_IMAGE_THUMBNAILS + ')'
+    return query, (owner, name, description, img, price, exempt_postage, img), _goods_keys()
 
 
 def update_goods(owner, goods_id, name, description, img, price, exempt_postage):
@@ -206,26 +1201,22 @@ def update_goods(owner, goods_id, name, description, img, price, exempt_postage)
     :param exempt_postage: 商品是否包邮，布尔值，True表示包邮，False表示不包邮
     :return: 如果更新成功，返回True；否则返回False。
     """
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    if img is None:
-        query = 'update "Goods" set name = %s, description = %s, price = %s, exempt_postage = %s where id = %s and ' \
-                'owner = %s'
-        cursor.execute(query, (name, description, price, exempt_postage, goods_id, owner))
+    return _run_update(_update_goods_statement(owner, goods_id, name, description, img, price, exempt_postage))
 
+
+def _update_goods_statement(owner, goods_id, name, description, img, price, exempt_postage):
+    if img is None:
+        query = 'update "Goods" set name = %s, description = %s, price = %s, exempt_postage = %s where id = %s ' \
+                'and owner = %s'
+        params = (name, description, price, exempt_postage, goods_id, owner)
     else:
-        query = 'update "Goods" set name = %s, description = %s, img = %s, price = %s, exempt_postage = %s where id = ' \
-                '%s and owner = %s'
-        cursor.execute(query, (name, description, img, price, exempt_postage, goods_id, owner))
-    if cursor.rowcount == 0:
-        conn.close()
-        return False
-    else:
-        conn.commit()
-        conn.close()
-        return True
+        query = 'update "Goods" set name = %s, description = %s, img = %s, price = %s, exempt_postage = %s, ' \
+                'thumbnails = ' + _SAME_IMAGE_THUMBNAILS + ' where id = %s and owner = %s'
+        params = (name, description, img, price, exempt_postage, img, goods_id, owner)
+    return query, params, _goods_keys(goods_id)
 
 
+@cached
 def get_goods_list(key=None, exempt_postage=None, state=None, price=None):
     """
     功能：获取商品列表，用于交易大厅的商品展示。
@@ -233,7 +1224,7 @@ def get_goods_list(key=None, exempt_postage=None, state=None, price=None):
     :param key: 搜索关键词，用于进行商品名称和商品描述等的搜索。可能为None或为空字符串，此时表示不指定搜索关键词。
     :param exempt_postage: 用于根据是否包邮对商品进行筛选。为None或为all时表示不筛选，为yes时仅选择包邮的商品，为no时仅选择不包邮的商品。
     :param state: 用于根据商品状态对商品进行筛选。为None或为all时表示不筛选，为yes时仅选择可购买的商品，为no时仅选择已售出的商品。
-    :param price: 用于按价格对商品进行排序。为None或asc时表示价格升序，为desc时表示价格降序。
+    :param price: 用于按价格对商品进行排序。为None或asc时表示价格升序，为desc时表示价格降序，为rank且指定了搜索关键词时表示按相关度降序。
     :return: 返回list形式的商品列表，list的每一项为一个以dict表示的商品，每个dict的字段如下：
         id: 商品id
         name: 商品名称
@@ -242,55 +1233,149 @@ def get_goods_list(key=None, exempt_postage=None, state=None, price=None):
         price: 商品价格
         exempt_postage: 是否包邮
         owner: 商品发布者id
+        thumbnails: 商品图片的缩略图list，每一项为dict：width为宽度，url为链接；尚未生成时为None
+        version: 商品卡片上显示的字段或商品状态每次改变时加一，用于缓存渲染的卡片
+    """
+    return _run_query(_get_goods_list_statement(key, exempt_postage, state, price))
+
+
+def _get_goods_list_statement(key, exempt_postage, state, price):
+    conditions, params = _goods_list_conditions(key, exempt_postage, state)
+    sort_key, sort_params, ascending, _, _ = _goods_list_sort(key, price)
+    direction = 'asc' if ascending else 'desc'
+    query = 'select id, name, description, img, price, exempt_postage, owner, thumbnails, version from "Goods"'
+    if conditions:
+        query += ' where ' + ' and '.join(conditions)
+    query += ' order by %s %s, id %s' % (sort_key, direction, direction)
+    return query, params + sort_params, _all(_goods_list_item)
+
+
+@cached
+def get_goods_page(key=None, exempt_postage=None, state=None, price=None, cursor=None, page_size=GOODS_PAGE_SIZE):
+    """
+    功能：分页获取商品列表，按(排序字段, id)进行keyset分页，每页的查询代价与商品总数无关。
+    没有价格的商品与get_goods_list相同，价格升序时排在最后，降序时排在最前，按id排序。
+    :param key: 同get_goods_list
+    :param exempt_postage: 同get_goods_list
+    :param state: 同get_goods_list
+    :param price: 同get_goods_list
+    :param cursor: 翻页游标，取值为上一次返回的next_cursor或prev_cursor；为None或无效时返回第一页
+    :param page_size: 每页的商品数量
+    :return: dict，字段如下：
+        goods_list: 本页的商品列表，每一项与get_goods_list相同
+        next_cursor: 下一页的游标，没有下一页时为None
+        prev_cursor: 上一页的游标，没有上一页时为None
     """
-    conn = get_db_conn()
-    cursor = conn.cursor()
+    return _run_query(_get_goods_page_statement(key, exempt_postage, state, price, cursor, page_size))
+
+
+def _get_goods_page_statement(key, exempt_postage, state, price, cursor, page_size):
+    conditions, params = _goods_list_conditions(key, exempt_postage, state)
+    sort_key, sort_params, ascending, parse, nullable = _goods_list_sort(key, price)
+    parse_key = parse
+    if nullable:  # 没有价格的商品作为边界行时，游标中的排序键为null
+        def parse_key(value):
+            return None if value is None else parse(value)
+    position = _decode_cursor(cursor, parse_key, int)
+    backward = position is not None and position[0] == 'prev'
+    forward = ascending != backward  # 是否按排序键升序读取，升序时NULL排在最后，降序时排在最前
+    direction = 'asc' if forward else 'desc'
+    goods = 'select id, name, description, img, price, exempt_postage, owner, thumbnails, version, sort_key ' \
+            'from (select *, %s as sort_key from "Goods"%s) g' % \
+            (sort_key, ' where ' + ' and '.join(conditions) if conditions else '')
+    order = ' order by sort_key %s, id %s limit %%s' % (direction, direction)
+    params = sort_params + params
+
+    def result(rows):
+        rows, next_cursor, prev_cursor = _keyset_page(rows, page_size, position, lambda row: (row[9], row[0]))
+        return {
+            'goods_list': [_goods_list_item(row) for row in rows],
+            'next_cursor': next_cursor,
+            'prev_cursor': prev_cursor
+        }
+
+    if position is None:
+        return goods + order, params + [page_size + 1], result
+    # 排序键不为NULL的行按(sort_key, id)比较，为NULL的行只按id比较。两部分分别查询，都可以使用(price, id)索引
+    value, goods_id = position[1], position[2]
+    operator = '>' if forward else '<'
+    branches = []
+    if value is not None:
+        branches.append(('(sort_key, id) %s (%%s, %%s)' % operator, [value, goods_id]))
+    elif not forward:
+        branches.append(('sort_key is not null', []))
+    if nullable and value is None:
+        branches.append(('sort_key is null and id %s %%s' % operator, [goods_id]))
+    elif nullable and forward:
+        branches.append(('sort_key is null', []))
+    if len(branches) == 1:
+        condition, values = branches[0]
+        return goods + ' where ' + condition + order, params + values + [page_size + 1], result
+    query = 'select * from (%s) p%s' % (' union all '.join('(%s where %s%s)' % (goods, condition, order)
+                                                           for condition, _ in branches), order)
+    values = [param for _, branch_values in branches for param in params + branch_values + [page_size + 1]]
+    return query, values + [page_size + 1], result
+
+
+def _goods_list_conditions(key, exempt_postage, state):
+    """
+    功能：将get_goods_list的筛选参数转换为SQL条件
+    :return: (条件list, 参数list)
+    """
+    conditions, params = [], []
     if state == 'yes':
-        order_state = ORDER_STATE_APPLIED
-        query = 'select id, name, description, img, price, exempt_postage, owner from "Goods" where (id not in (' \
-                'select goods_id from "Order") or id in (select goods_id from "Order" where state = %s))'
-        if key is None or key == '':
-            cursor.execute(query, (order_state,))
-        else:
-            q = ' and name like %s or description like %s'
-            cursor.execute(query + q, (order_state, key, key))
+        conditions.append('on_sale = %s')
+        params.append(True)
     elif state == 'no':
-        order_state = ORDER_STATE_APPLIED
-        query = 'select id, name, description, img, price, exempt_postage, owner from "Goods" where (id in (select ' \
-                'goods_id from "Order") and id not in (select goods_id from "Order" where state = %s))'
-        if key is None or key == '':
-            cursor.execute(query, (order_state,))
-        else:
-            q = ' and name like %s or description like %s'
-            cursor.execute(query + q, (order_state, key, key))
-    else:
-        query = 'select id, name, description, img, price, exempt_postage, owner from "Goods"'
-        if key is None or key == '':
-            cursor.execute(query)
-        else:
-            q = ' where name like %s or description like %s'
-            cursor.execute(query + q, (key, key))
-    goods_list = []
-    for row in cursor.fetchall():
-        goods_list.append({
-            'id': row[0],
-            'name': row[1],
-            'description': row[2],
-            'img': row[3],
-            'price': row[4],
-            'exempt_postage': row[5],
-            'owner': row[6]
-        })
-    conn.close()
-    if price == 'asc':
-        goods_list.sort(key=lambda x: x['price'])
-    elif price == 'desc':
-        goods_list.sort(key=lambda x: x['price'], reverse=True)
+        conditions.append('on_sale = %s')
+        params.append(False)
+    if key is not None and key != '':
+        conditions.append('search_vector @@ goods_search_query(%s)')
+        params.append(key)
     if exempt_postage == 'yes':
-        goods_list = list(filter(lambda x: x['exempt_postage'] is True, goods_list))
+        conditions.append('exempt_postage = %s')
+        params.append(True)
     elif exempt_postage == 'no':
-        goods_list = list(filter(lambda x: x['exempt_postage'] is False, goods_list))
-    return goods_list
+        conditions.append('exempt_postage = %s')
+        params.append(False)
+    return conditions, params
+
+
+def get_goods_list_version():
+    """
+    功能：读取商品列表的变更版本，用于JSON接口的ETag。任何商品增删或卡片上的字段改变时增大（"GoodsChange"），
+    只需一次索引查找，不执行列表查询。
+    :return: int
+    """
+    return _run_query(_get_goods_list_version_statement())
+
+
+def _get_goods_list_version_statement():
+    return 'select goods_list_version()', (), _one(lambda row: row[0])
+
+
+def _goods_list_sort(key, price):
+    """
+    功能：将get_goods_list的排序参数转换为SQL排序表达式
+    :return: (排序表达式, 表达式参数list, 是否升序, 将游标中的排序键字符串转换为参数值的函数, 排序键是否可能为NULL)
+    """
+    if price == 'rank' and key is not None and key != '':
+        return 'ts_rank(search_vector, goods_search_query(%s))::float8', [key], False, float, False
+    return 'price', [], price != 'desc', Decimal, True
+
+
+def _goods_list_item(row):
+    return {
+        'id': row[0],
+        'name': row[1],
+        'description': row[2],
+        'img': row[3],
+        'price': row[4],
+        'exempt_postage': row[5],
+        'owner': row[6],
+        'thumbnails': row[7],
+        'version': row[8]
+    }
 
 
 def get_goods_list_of_user(user_id):
@@ -305,23 +1390,25 @@ def get_goods_list_of_user(user_id):
         img: 商品图片链接
         price: 商品价格
         exempt_postage: 是否包邮
+        thumbnails: 同get_goods_list
+        version: 同get_goods_list
     """
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    query = 'select id, name, description, img, price, exempt_postage from "Goods" where owner = %s'
-    cursor.execute(query, (user_id,))
-    goods_list = []
-    for row in cursor.fetchall():
-        goods_list.append({
-            'id': row[0],
-            'name': row[1],
-            'description': row[2],
-            'img': row[3],
-            'price': row[4],
-            'exempt_postage': row[5]
-        })
-    conn.close()
-    return goods_list
+    return _run_query(_get_goods_list_of_user_statement(user_id))
+
+
+def _get_goods_list_of_user_statement(user_id):
+    query = 'select id, name, description, img, price, exempt_postage, thumbnails, version from "Goods" ' \
+            'where owner = %s'
+    return query, (user_id,), _all(lambda row: {
+        'id': row[0],
+        'name': row[1],
+        'description': row[2],
+        'img': row[3],
+        'price': row[4],
+        'exempt_postage': row[5],
+        'thumbnails': row[6],
+        'version': row[7]
+    })
 
 
 def delete_goods(owner, goods_id):
@@ -332,19 +1419,14 @@ def delete_goods(owner, goods_id):
     :param goods_id: 商品id
     :return: 如果删除成功，返回True；否则返回False
     """
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    query = 'delete from "Goods" where id = %s and owner = %s'
-    cursor.execute(query, (goods_id, owner))
-    if cursor.rowcount == 0:
-        conn.close()
-        return False
-    else:
-        conn.commit()
-        conn.close()
-        return True
+    return _run_update(_delete_goods_statement(owner, goods_id))
+
 
+def _delete_goods_statement(owner, goods_id):
+    return 'delete from "Goods" where id = %s and owner = %s', (goods_id, owner), _goods_keys(goods_id)
 
+
+@cached
 def get_goods_detail(goods_id):
     """
     功能：获取商品详情。
@@ -360,37 +1442,291 @@ def get_goods_detail(goods_id):
         id: 商品id
         apply_count: 该商品”想要“的人数
         off_sale: 商品是否已售出，True表示已售出，False表示可购买
+        thumbnails: 同get_goods_list
     """
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    query = 'select name, description, img, price, exempt_postage, owner from "Goods" where id = %s'
-    cursor.execute(query, (goods_id,))
-    row = cursor.fetchone()
-    if row is None:
-        conn.close()
-        return None
-    else:
-        query = 'select count(*) from "Order" where goods_id = %s and state = %s'
-        cursor.execute(query, (goods_id, ORDER_STATE_OFF_SALE))
-        off_sale = cursor.fetchone()
-        query = 'select count(*) from "Order" where goods_id = %s and state = %s'
-        cursor.execute(query, (goods_id, ORDER_STATE_APPLIED))
-        apply = cursor.fetchone()
-        conn.close()
-        return {
-            'name': row[0],
-            'description': row[1],
-            'img': row[2],
-            'price': row[3],
-            'exempt_postage': row[4],
-            'owner': row[5],
-            'id': goods_id,
-            'apply_count': apply[0],
-            'off_sale': off_sale[0] > 0
-        }
+    return _run_query(_get_goods_detail_statement(goods_id))
+
+
+def _get_goods_detail_statement(goods_id):
+    query = 'select name, description, img, price, exempt_postage, owner, apply_count, not on_sale, thumbnails ' \
+            'from "Goods" where id = %s'
+    return query, (goods_id,), _one(lambda row: {
+        'name': row[0],
+        'description': row[1],
+        'img': row[2],
+        'price': row[3],
+        'exempt_postage': row[4],
+        'owner': row[5],
+        'id': goods_id,
+        'apply_count': row[6],
+        'off_sale': row[7],
+        'thumbnails': row[8]
+    })
+
+
+def get_goods_versions(goods_id):
+    """
+    功能：读取商品的变更版本，用于JSON接口的ETag，不读取评论的内容。
+    :param goods_id: 商品id
+    :return: 商品不存在时返回None；否则返回dict，字段如下：
+        version: 同get_goods_list
+        apply_count: 该商品“想要”的人数，它改变时version不变
+        comments_version: 字符串，该商品的评论每次增删时改变，由comment_count和最新一条评论的id组成
+    """
+    return _run_query(_get_goods_versions_statement(goods_id))
+
+
+def _get_goods_versions_statement(goods_id):
+    query = 'select version, apply_count, goods_comments_version(id) from "Goods" where id = %s'
+    return query, (goods_id,), _one(lambda row: {
+        'version': row[0],
+        'apply_count': row[1],
+        'comments_version': row[2]
+    })
+
+
+def import_goods(owner, rows, resolve_image=None):
+    """
+    功能：批量发布商品。逐行校验rows，校验通过的行通过COPY FROM STDIN流式写入"Goods"表，整个导入在一个事务中完成；
+    校验失败的行不会写入，也不影响其他行。内存占用与总行数无关。
+    :param owner: 商品发布者id
+    :param rows: (行号, dict)的可迭代对象，dict的字段见GOODS_IMPORT_FIELDS，值均可以是字符串：
+        name: 商品名称，必填
+        description: 商品描述
+        price: 商品价格，最多两位小数
+        exempt_postage: 是否包邮，true/false、1/0、yes/no、是/否，默认不包邮
+        img: 商品图片文件名，为空时不设置图片
+        解析失败的行可以传入(行号, 错误信息字符串)，直接计入错误
+    :param resolve_image: 函数(图片文件名) -> 图片链接，图片不存在时返回None；为None时不接受图片
+    :return: (导入的商品数, [(行号, 错误信息)...])
+    """
+    errors = []
+
+    def lines():
+        for line, row in rows:
+            if isinstance(row, str):
+                errors.append((line, row))
+                continue
+            try:
+                values = _goods_import_values(row, resolve_image)
+            except ValueError as err:
+                errors.append((line, str(err)))
+                continue
+            yield '\t'.join([str(owner)] + [_copy_text(value) for value in values]) + '\n'
+
+    with db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.copy_expert('copy "Goods" (owner, name, description, img, price, exempt_postage) from stdin',
+                           _LineReader(lines()))
+        imported = cursor.rowcount
+        commit_and_invalidate(conn, *_goods_keys())
+    return imported, errors
+
+
+def _goods_import_values(row, resolve_image):
+    """
+    功能：校验并转换import_goods的一行
+    :return: [name, description, img, price, exempt_postage]
+    :raise ValueError: 校验失败，异常信息为错误原因
+    """
+    if not isinstance(row, dict):
+        raise ValueError('格式不正确')
+    row = {key: '' if row.get(key) is None else str(row.get(key)).strip() for key in GOODS_IMPORT_FIELDS}
+    if not row['name']:
+        raise ValueError('商品名称不能为空')
+    if len(row['name']) > 255 or len(row['description']) > 255:
+        raise ValueError('商品名称和描述不能超过255个字符')
+    try:
+        price = Decimal(row['price'])
+    except ArithmeticError:
+        raise ValueError('价格不正确：%s' % row['price'])
+    if not price.is_finite() or price < 0 or price >= 10 ** 8 or price.as_tuple().exponent < -2:
+        raise ValueError('价格不正确：%s' % row['price'])
+    exempt_postage = row['exempt_postage'].lower()
+    if exempt_postage not in ('', 'true', 'false', '1', '0', 'yes', 'no', '是', '否'):
+        raise ValueError('是否包邮不正确：%s' % row['exempt_postage'])
+    img = None
+    if row['img']:
+        img = resolve_image(row['img']) if resolve_image is not None else None
+        if img is None:
+            raise ValueError('图片不存在：%s' % row['img'])
+    return [row['name'], row['description'] or None, img, str(price), str(exempt_postage in ('true', '1', 'yes', '是'))]
+
+
+def set_goods_thumbnails(img, thumbnails):
+    """
+    功能：记录商品图片的缩略图，所有使用该图片的商品都会更新。由生成缩略图的后台任务调用。
+    :param img: 商品图片链接
+    :param thumbnails: 缩略图list，每一项为dict：width为宽度，url为链接；为None时清除
+    :return: 更新的商品数
+    """
+    with db_conn() as conn:
+        cursor = conn.cursor()
+        query = 'update "Goods" set thumbnails = %s where img = %s returning id'
+        cursor.execute(query, (None if thumbnails is None else json.dumps(thumbnails), img))
+        goods_ids = [row[0] for row in cursor.fetchall()]
+        commit_and_invalidate(conn, *_goods_keys(), *[('get_goods_detail', goods_id) for goods_id in goods_ids])
+    return len(goods_ids)
+
+
+def register_image(img, size):
+    """
+    功能：登记按内容命名的图片。相同内容的图片只有一条记录，重复登记时刷新登记时间，使其在IMAGE_GC_GRACE秒内不会被回收。
+    图片被商品使用的次数由"Goods"表上的触发器维护。
+    :param img: 图片链接
+    :param size: 图片的字节数
+    """
+    with db_conn() as conn:
+        cursor = conn.cursor()
+        query = 'insert into "Image" (img, size) values (%s, %s) on conflict (img) do update set registered_at = ' \
+                'current_timestamp'
+        cursor.execute(query, (img, size))
+        conn.commit()
+
+
+def collect_images(remove, grace=IMAGE_GC_GRACE):
+    """
+    功能：回收没有商品使用、且登记时间早于grace秒之前的图片，每次最多IMAGE_GC_BATCH_SIZE张。
+    图片文件在持有记录行锁的事务中删除，同时登记相同内容的register_image会等待回收完成后重新登记，因此不会丢失文件。
+    :param remove: 函数(图片链接)，删除图片文件，文件不存在时不应抛出异常
+    :param grace: 未被使用的图片至少保留的秒数
+    :return: 回收的图片链接list
+    """
+    with db_conn() as conn:
+        cursor = conn.cursor()
+        query = 'select img from "Image" where ref_count = 0 and registered_at < current_timestamp - ' \
+                'make_interval(secs => %s) order by registered_at limit %s for update skip locked'
+        cursor.execute(query, (grace, IMAGE_GC_BATCH_SIZE))
+        imgs = [row[0] for row in cursor.fetchall()]
+        if not imgs:
+            return imgs
+        for img in imgs:
+            remove(img)
+        cursor.execute('delete from "Image" where img = any(%s)', (imgs,))
+        conn.commit()
+    return imgs
+
+
+def get_goods_images(missing_thumbnails=False):
+    """
+    功能：获取全部商品图片，用于生成缩略图
+    :param missing_thumbnails: 为True时只返回还没有缩略图的商品图片
+    :return: 商品图片链接list
+    """
+    query = 'select distinct img from "Goods" where img is not null'
+    if missing_thumbnails:
+        query += ' and thumbnails is null'
+    with db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query + ' order by img')
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _copy_text(value):
+    # COPY文本格式：\N表示null，转义反斜杠、制表符和换行符
+    if value is None:
+        return '\\N'
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class _LineReader:
+    """
+    将逐行生成文本的迭代器包装为copy_expert需要的只读文件对象
+    """
+
+    def __init__(self, lines):
+        self._lines = lines
+        self._buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer += line.encode('utf-8')
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
 
 
 # ======================= 订单接口 (2 + 3 + 3 + 2 + 2 + 2 + 2 + 4 + 5 = 25分) ======================= #
+# 订单状态机：每个状态转换由一个存储函数在一条语句中完成（见migrations/0008_order_transitions.sql），
+# 函数检查订单和商品的当前状态，条件不满足时不修改任何数据。各转换的起止状态如下：
+ORDER_TRANSITIONS = {
+    'order_apply': ((), ORDER_STATE_APPLIED),
+    'order_approve': ((ORDER_STATE_APPLIED,), ORDER_STATE_APPROVED),
+    'order_abandon': ((ORDER_STATE_APPLIED, ORDER_STATE_APPROVED, ORDER_STATE_OFF_SALE), None),
+    'order_establish': ((ORDER_STATE_APPROVED,), ORDER_STATE_ESTABLISHED),
+    'order_deliver': ((ORDER_STATE_ESTABLISHED,), ORDER_STATE_ON_ROAD),
+    'order_finish': ((ORDER_STATE_ON_ROAD,), ORDER_STATE_FINISHED),
+    'order_approve_many': ((ORDER_STATE_APPLIED,), ORDER_STATE_APPROVED),
+    'order_deliver_many': ((ORDER_STATE_ESTABLISHED,), ORDER_STATE_ON_ROAD),
+}
+
+
+def _transition_order(transition, args, keys):
+    """
+    功能：执行一个订单状态转换并立即提交，锁只在这一条语句和提交期间持有
+    :param transition: ORDER_TRANSITIONS中的存储函数名
+    :param args: 存储函数的参数
+    :param keys: 函数(商品发布者id) -> 转换成功后需要删除的缓存键list
+    :return: 如果转换成功，返回True；否则返回False
+    """
+    query = _transition_query(transition, args)
+    with db_conn() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(query, args)
+        except (psycopg2.DataError, psycopg2.IntegrityError) as err:
+            print(err)
+            conn.rollback()
+            return False
+        seller = cursor.fetchone()[0]
+        if seller is None:
+            conn.rollback()
+            return False
+        commit_and_invalidate(conn, *keys(seller))
+        return True
+
+
+def _transition_orders(transition, args, keys):
+    """
+    功能：在一个事务中执行一个批量订单状态转换并立即提交
+    :param transition: ORDER_TRANSITIONS中的存储函数名，函数返回被修改的订单
+    :param args: 存储函数的参数，订单id等以list传入
+    :param keys: 函数(存储函数返回的行list) -> 转换成功后需要删除的缓存键list
+    :return: 存储函数返回的行list，没有订单被修改时为空list
+    """
+    query = _transition_query(transition, args, rows=True)
+    with db_conn() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(query, args)
+        except (psycopg2.DataError, psycopg2.IntegrityError) as err:
+            print(err)
+            conn.rollback()
+            return []
+        rows = cursor.fetchall()
+        if not rows:
+            conn.rollback()
+            return []
+        commit_and_invalidate(conn, *keys(rows))
+        return rows
+
+
+def _transition_query(transition, args, rows=False):
+    """
+    功能：生成调用订单状态转换存储函数的查询
+    :param transition: ORDER_TRANSITIONS中的存储函数名
+    :param args: 存储函数的参数
+    :param rows: 存储函数是否返回多行（批量转换）
+    """
+    if transition not in ORDER_TRANSITIONS:
+        raise ValueError('unknown order transition: %s' % transition)
+    return ('select * from %s(%s)' if rows else 'select %s(%s)') % (transition, ', '.join(['%s'] * len(args)))
+
+
 def apply_order(customer, goods_id):
     """
     功能：用户点击“想要”，申请购买商品（即创建ORDER_STATE_APPLIED状态的订单）。
@@ -399,17 +1735,12 @@ def apply_order(customer, goods_id):
     :param goods_id: 商品id
     :return: 如果申请成功，返回True；否则返回False
     """
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    query = 'insert into "Order" (user_id, goods_id, state) values (%s, %s, %s)'
-    cursor.execute(query, (customer, goods_id, ORDER_STATE_APPLIED))
-    if cursor.rowcount == 0:
-        conn.close()
-        return False
-    else:
-        conn.commit()
-        conn.close()
-        return True
+    return _transition_order(*_apply_order_transition(customer, goods_id))
+
+
+def _apply_order_transition(customer, goods_id):
+    # (存储函数名, 参数, 缓存键函数)，同_transition_order的参数，async_db_api使用相同的转换
+    return 'order_apply', (customer, goods_id), lambda seller: [('get_goods_detail', goods_id)]
 
 
 def abandon_order(customer, goods_id):
@@ -420,19 +1751,11 @@ def abandon_order(customer, goods_id):
     :param goods_id: 商品id
     :return: 如果放弃成功，返回True；否则返回False
     """
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    query_delete = 'delete from "Order" where user_id = %s and goods_id = %s'
-    query_update = 'update "Order" set state = %s where goods_id = %s and state = %s'
-    cursor.execute(query_delete, (customer, goods_id))
-    if cursor.rowcount == 0:
-        conn.close()
-        return False
-    else:
-        cursor.execute(query_update, (ORDER_STATE_APPLIED, goods_id, ORDER_STATE_OFF_SALE))
-        conn.commit()
-        conn.close()
-        return True
+    return _transition_order(*_abandon_order_transition(customer, goods_id))
+
+
+def _abandon_order_transition(customer, goods_id):
+    return 'order_abandon', (customer, goods_id), lambda seller: _goods_keys(goods_id)
 
 
 def approve_order(owner, goods_id, order_id):
@@ -444,20 +1767,11 @@ def approve_order(owner, goods_id, order_id):
     :param order_id: 订单id
     :return: 如果操作成功，返回True；否则返回False
     """
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    query = 'update "Order" set state = %s where id = %s and goods_id = %s and goods_id in (select id from "Goods" ' \
-            'where owner = %s)'
-    cursor.execute(query, (ORDER_STATE_APPROVED, order_id, goods_id, owner))
-    if cursor.rowcount == 0:
-        conn.close()
-        return False
-    else:
-        query_update = 'update "Order" set state = %s where goods_id = %s and id != %s'
-        cursor.execute(query_update, (ORDER_STATE_OFF_SALE, goods_id, order_id))
-        conn.commit()
-        conn.close()
-        return True
+    return _transition_order(*_approve_order_transition(owner, goods_id, order_id))
+
+
+def _approve_order_transition(owner, goods_id, order_id):
+    return 'order_approve', (owner, goods_id, order_id), lambda seller: _goods_keys(goods_id)
 
 
 def establish_order(customer, goods_id, order_id, address_id):
@@ -470,18 +1784,11 @@ def establish_order(customer, goods_id, order_id, address_id):
     :param address_id: 收货地址id
     :return: 如果操作成功，返回True；否则返回False
     """
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    query = 'update "Order" set state = %s, address_id = %s where id = %s and user_id = %s and goods_id = %s and ' \
-            'state = %s'
-    cursor.execute(query, (ORDER_STATE_ESTABLISHED, address_id, order_id, customer, goods_id, ORDER_STATE_APPROVED))
-    if cursor.rowcount == 0:
-        conn.close()
-        return False
-    else:
-        conn.commit()
-        conn.close()
-        return True
+    return _transition_order(*_establish_order_transition(customer, goods_id, order_id, address_id))
+
+
+def _establish_order_transition(customer, goods_id, order_id, address_id):
+    return 'order_establish', (customer, goods_id, order_id, address_id), lambda seller: []
 
 
 def deliver_goods(owner, goods_id, order_id, code, company):
@@ -495,18 +1802,11 @@ def deliver_goods(owner, goods_id, order_id, code, company):
     :param company: 快递公司
     :return: 如果操作成功，返回True；否则返回False
     """
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    query = 'update "Order" set state = %s, express_code = %s, express_company = %s where id = %s and goods_id = %s ' \
-            'and state = %s'
-    cursor.execute(query, (ORDER_STATE_ON_ROAD, code, company, order_id, goods_id, ORDER_STATE_ESTABLISHED))
-    if cursor.rowcount == 0:
-        conn.close()
-        return False
-    else:
-        conn.commit()
-        conn.close()
-        return True
+    return _transition_order(*_deliver_goods_transition(owner, goods_id, order_id, code, company))
+
+
+def _deliver_goods_transition(owner, goods_id, order_id, code, company):
+    return 'order_deliver', (owner, goods_id, order_id, code, company), lambda seller: []
 
 
 def finish_order(customer, goods_id, order_id):
@@ -518,17 +1818,80 @@ def finish_order(customer, goods_id, order_id):
     :param order_id: 订单id
     :return: 如果操作成功，返回True；否则返回False
     """
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    query = 'update "Order" set state = %s where id = %s and user_id = %s and goods_id = %s'
-    cursor.execute(query, (ORDER_STATE_FINISHED, order_id, customer, goods_id))
-    if cursor.rowcount == 0:
-        conn.close()
-        return False
-    else:
-        conn.commit()
-        conn.close()
-        return True
+    return _transition_order(*_finish_order_transition(customer, goods_id, order_id))
+
+
+def _finish_order_transition(customer, goods_id, order_id):
+    return 'order_finish', (customer, goods_id, order_id), lambda seller: [('get_user_info', seller)]
+
+
+def approve_orders(owner, order_ids):
+    """
+    功能：商品发布者在一个事务中批量同意购买申请。同一商品只同意所选订单中id最小的一个，该商品的其他申请订单变为
+    ORDER_STATE_OFF_SALE；不属于该发布者、不是ORDER_STATE_APPLIED状态或商品已卖出的订单不做修改。
+    :param owner: 商品发布者id
+    :param order_ids: 订单id list
+    :return: 成功同意的订单id list
+    """
+    transition = _approve_orders_transition(owner, order_ids)
+    if transition is None:
+        return []
+    return [row[0] for row in _transition_orders(*transition)]
+
+
+def _approve_orders_transition(owner, order_ids):
+    # 同_transition_orders的参数，订单id无效时返回None
+    try:
+        order_ids = [int(order_id) for order_id in order_ids]
+    except ValueError:
+        return None
+    return 'order_approve_many', (owner, order_ids), lambda rows: [key for row in rows for key in _goods_keys(row[1])]
+
+
+def deliver_orders(owner, shipments):
+    """
+    功能：商品发布者在一个事务中批量发货，订单状态变为ORDER_STATE_ON_ROAD；
+    不属于该发布者或不是ORDER_STATE_ESTABLISHED状态的订单不做修改。
+    :param owner: 商品发布者id
+    :param shipments: (订单id, 快递公司, 快递单号)的list
+    :return: 成功发货的订单id list
+    """
+    transition = _deliver_orders_transition(owner, shipments)
+    if transition is None:
+        return []
+    return [row[0] for row in _transition_orders(*transition)]
+
+
+def _deliver_orders_transition(owner, shipments):
+    # 同_transition_orders的参数，订单id无效或没有订单时返回None
+    try:
+        shipments = sorted((int(order_id), company, code) for order_id, company, code in shipments)
+    except ValueError:
+        return None
+    if not shipments:
+        return None
+    order_ids, companies, codes = (list(column) for column in zip(*shipments))
+    return 'order_deliver_many', (owner, order_ids, codes, companies), lambda rows: []
+
+
+def import_shipments(owner, shipments, batch_size=SHIPMENT_BATCH_SIZE):
+    """
+    功能：批量导入快递信息并发货。shipments可以是逐行读取文件的生成器，每batch_size行调用一次deliver_orders，
+    每批在单独的事务中提交，内存占用与总行数无关。
+    :param owner: 商品发布者id
+    :param shipments: (订单id, 快递公司, 快递单号)的可迭代对象
+    :param batch_size: 每批的订单数量
+    :return: (成功发货的订单数, 未能发货的订单id list)
+    """
+    delivered, rejected = 0, []
+    shipments = iter(shipments)
+    while True:
+        batch = list(itertools.islice(shipments, batch_size))
+        if not batch:
+            return delivered, rejected
+        done = set(deliver_orders(owner, batch))
+        delivered += len(done)
+        rejected.extend(shipment[0] for shipment in batch if shipment[0] not in done)
 
 
 def get_order_by_user_and_goods(user_id, goods_id):
@@ -541,19 +1904,15 @@ def get_order_by_user_and_goods(user_id, goods_id):
         id: 订单id
         state: 订单的状态
     """
-    conn = get_db_conn()
-    cursor = conn.cursor()
+    return _run_query(_get_order_by_user_and_goods_statement(user_id, goods_id))
+
+
+def _get_order_by_user_and_goods_statement(user_id, goods_id):
     query = 'select id, state from "Order" where user_id = %s and goods_id = %s'
-    cursor.execute(query, (user_id, goods_id))
-    result = cursor.fetchone()
-    conn.close()
-    if result is None:
-        return None
-    else:
-        return {
-            'id': result[0],
-            'state': result[1]
-        }
+    return query, (user_id, goods_id), _one(lambda row: {
+        'id': row[0],
+        'state': row[1]
+    })
 
 
 def get_orders_from_user(user_id):
@@ -571,26 +1930,22 @@ def get_orders_from_user(user_id):
         express_code: 订单的快递单号，可以为空
         express_company: 订单的快递公司，可以为空
     """
-    conn = get_db_conn()
-    cursor = conn.cursor()
+    return _run_query(_get_orders_from_user_statement(user_id))
+
+
+def _get_orders_from_user_statement(user_id):
     query = 'select "Order".id, goods_id, name, state, price, exempt_postage, express_code, express_company from ' \
             '"Order" join "Goods" on "Order".goods_id = "Goods".id where user_id = %s'
-    cursor.execute(query, (user_id,))
-    result = cursor.fetchall()
-    conn.close()
-    if result is None:
-        return None
-    else:
-        return [{
-            'id': result[0],
-            'goods_id': result[1],
-            'name': result[2],
-            'state': result[3],
-            'price': result[4],
-            'exempt_postage': result[5],
-            'express_code': result[6],
-            'express_company': result[7]
-        } for result in result]
+    return query, (user_id,), _all(lambda row: {
+        'id': row[0],
+        'goods_id': row[1],
+        'name': row[2],
+        'state': row[3],
+        'price': row[4],
+        'exempt_postage': row[5],
+        'express_code': row[6],
+        'express_company': row[7]
+    })
 
 
 def get_orders_to_user(user_id):
@@ -611,32 +1966,28 @@ def get_orders_to_user(user_id):
         address_phone: 订单关联的收件人手机号
         address_location: 订单关联的收件人地址
     """
-    conn = get_db_conn()
-    cursor = conn.cursor()
+    return _run_query(_get_orders_to_user_statement(user_id))
+
+
+def _get_orders_to_user_statement(user_id):
     query = 'select "Order".id, "Order".user_id, "Order".goods_id, "Goods".name, "Order".state, "Goods".price, ' \
             '"Goods".exempt_postage, "User".username, "Address".name, "Address".phone, "Address".location from ' \
             '"Order" left outer join "Goods" on "Order".goods_id = "Goods".id left outer join "User" on ' \
             '"Order".user_id = "User".id left outer join "Address" on "Order".address_id = "Address".id where ' \
-            '"Goods".owner= %s;'
-    cursor.execute(query, (user_id,))
-    result = cursor.fetchall()
-    conn.close()
-    if result is None:
-        return None
-    else:
-        return [{
-            'id': result[0],
-            'user_id': result[1],
-            'goods_id': result[2],
-            'name': result[3],
-            'state': result[4],
-            'price': result[5],
-            'exempt_postage': result[6],
-            'username': result[7],
-            'address_name': result[8],
-            'address_phone': result[9],
-            'address_location': result[10]
-        } for result in result]
+            '"Order".seller = %s'
+    return query, (user_id,), _all(lambda row: {
+        'id': row[0],
+        'user_id': row[1],
+        'goods_id': row[2],
+        'name': row[3],
+        'state': row[4],
+        'price': row[5],
+        'exempt_postage': row[6],
+        'username': row[7],
+        'address_name': row[8],
+        'address_phone': row[9],
+        'address_location': row[10]
+    })
 
 
 # ======================= 评论接口 (2 + 3 + 2 = 7分) ======================= #
@@ -650,26 +2001,26 @@ def create_comment(user_id, goods_id, content):
     :param content: 评论内容
     :return: 如果评论添加成功，返回True，否则返回False
     """
-    conn = get_db_conn()
-    cursor = conn.cursor()
+    return _run_update(_create_comment_statement(user_id, goods_id, content))
+
+
+def _create_comment_statement(user_id, goods_id, content):
     query = 'insert into "Comment" (user_id, goods_id, content, create_at) values (%s, %s, %s, current_timestamp)'
-    cursor.execute(query, (user_id, goods_id, content))
-    if cursor.rowcount == 1:
-        conn.commit()
-        conn.close()
-        return True
-    else:
-        conn.rollback()
-        conn.close()
-        return False
+    return query, (user_id, goods_id, content), _comment_keys(goods_id)
+
+
+def _comment_direction(order):
+    # 排序方式只能是asc或desc，其他值按asc处理，避免将参数直接拼接到SQL中
+    return 'desc' if order == 'desc' else 'asc'
 
 
+@cached(normalize={'order': _comment_direction})
 def get_comments(goods_id, order='asc'):
     """
     功能：获取某商品的评论列表。
     分值：3分
     :param goods_id: 要获取评论的商品id
-    :param order: 评论的排序方式，asc表示时间升序，desc表示时间降序
+    :param order: 评论的排序方式，asc表示时间升序，desc表示时间降序，其他值按asc处理
     :return: 返回list形式的评论列表，list的每一项为一个以dict表示的评论，每个dict的字段如下：
         id: 评论id
         user_id: 评论发表人id
@@ -677,23 +2028,86 @@ def get_comments(goods_id, order='asc'):
         content: 评论内容
         create_at: 字符串形式的评论发布时间，请在后台完成时间的格式化
     """
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    query = 'select "Comment".id, user_id, username, content, "Comment".create_at from "Comment" join "User" on ' \
-            '"Comment".user_id = "User".id where goods_id = %s order by create_at ' + order
-    cursor.execute(query, (goods_id,))
-    result = cursor.fetchall()
-    conn.close()
-    if result is None:
-        return None
-    else:
-        return [{
-            'id': result[0],
-            'user_id': result[1],
-            'username': result[2],
-            'content': result[3],
-            'create_at': result[4].strftime('%Y-%m-%d %H:%M:%S')
-        } for result in result]
+    return _run_query(_get_comments_statement(goods_id, order))
+
+
+def _get_comments_statement(goods_id, order):
+    query = 'select "Comment".id, user_id, username, content, to_char("Comment".create_at, %s) from "Comment" ' \
+            'join "User" on "Comment".user_id = "User".id where goods_id = %s ' \
+            'order by "Comment".create_at {0}, "Comment".id {0}'.format(_comment_direction(order))
+    return query, (COMMENT_TIME_FORMAT, goods_id), _all(lambda row: {
+        'id': row[0],
+        'user_id': row[1],
+        'username': row[2],
+        'content': row[3],
+        'create_at': row[4]
+    })
+
+
+def get_comment_page(goods_id, order='asc', cursor=None, page_size=COMMENT_PAGE_SIZE):
+    """
+    功能：分页获取某商品的评论，按(create_at, id)进行keyset分页，每页的查询代价与评论总数无关。
+    :param goods_id: 要获取评论的商品id
+    :param order: 同get_comments
+    :param cursor: 翻页游标，取值为上一次返回的next_cursor或prev_cursor；为None或无效时返回第一页
+    :param page_size: 每页的评论数量
+    :return: 商品不存在时返回None；否则返回dict，字段如下：
+        comments: 本页的评论列表，每一项与get_comments相同
+        total: 该商品的评论总数
+        next_cursor: 下一页的游标，没有下一页时为None
+        prev_cursor: 上一页的游标，没有上一页时为None
+    """
+    return _run_query(_get_comment_page_statement(goods_id, order, cursor, page_size))
+
+
+def _get_comment_page_statement(goods_id, order, cursor, page_size):
+    position = _decode_cursor(cursor, datetime.datetime.fromisoformat, int)
+    query = 'select comment_count, %s from "Goods" g where g.id = %%(goods_id)s' % _comments_query(order, position)
+    return query, _comments_params(goods_id, position, page_size), \
+        _one(lambda row: _comment_page(row[0], row[1], page_size, position))
+
+
+def _comments_query(order, position):
+    """
+    功能：生成按keyset分页查询商品g的评论的标量子查询，结果为json数组，按翻页方向排序，参数见_comments_params
+    :param order: 同get_comments
+    :param position: _decode_cursor的返回值，第一页为None
+    """
+    backward = position is not None and position[0] == 'prev'
+    ascending = _comment_direction(order) == 'asc'
+    direction = 'asc' if ascending != backward else 'desc'
+    where = 'c.goods_id = g.id'
+    if position is not None:
+        where += ' and (c.create_at, c.id) %s (%%(comment_at)s, %%(comment_id)s)' % ('>' if ascending != backward else '<')
+    return '(select coalesce(json_agg(json_build_object(\'id\', c.id, \'user_id\', c.user_id, \'username\', ' \
+           'u.username, \'content\', c.content, \'create_at\', to_char(c.create_at, %(comment_time_format)s), ' \
+           '\'sort_at\', to_char(c.create_at, \'YYYY-MM-DD HH24:MI:SS.US\')) ' \
+           'order by c.create_at {0}, c.id {0}), \'[]\') ' \
+           'from (select * from "Comment" c where {1} order by c.create_at {0}, c.id {0} limit %(comment_limit)s) c ' \
+           'join "User" u on c.user_id = u.id)'.format(direction, where)
+
+
+def _comments_params(goods_id, position, page_size):
+    params = {'goods_id': goods_id, 'comment_time_format': COMMENT_TIME_FORMAT, 'comment_limit': page_size + 1}
+    if position is not None:
+        params['comment_at'], params['comment_id'] = position[1], position[2]
+    return params
+
+
+def _comment_page(total, comments, page_size, position):
+    """
+    功能：将_comments_query的结果整理为get_comment_page的返回值
+    """
+    comments, next_cursor, prev_cursor = _keyset_page(comments, page_size, position,
+                                                      lambda comment: (comment['sort_at'], comment['id']))
+    for comment in comments:
+        del comment['sort_at']
+    return {
+        'comments': comments,
+        'total': total,
+        'next_cursor': next_cursor,
+        'prev_cursor': prev_cursor
+    }
 
 
 def delete_comment(user_id, goods_id, comment_id):
@@ -705,18 +2119,12 @@ def delete_comment(user_id, goods_id, comment_id):
     :param comment_id: 评论id
     :return: 如果删除成功，返回True；否则返回False
     """
-    conn = get_db_conn()
-    cursor = conn.cursor()
+    return _run_update(_delete_comment_statement(user_id, goods_id, comment_id))
+
+
+def _delete_comment_statement(user_id, goods_id, comment_id):
     query = 'delete from "Comment" where id = %s and user_id = %s and goods_id = %s'
-    cursor.execute(query, (comment_id, user_id, goods_id))
-    if cursor.rowcount == 1:
-        conn.commit()
-        conn.close()
-        return True
-    else:
-        conn.rollback()
-        conn.close()
-        return False
+    return query, (comment_id, user_id, goods_id), _comment_keys(goods_id)
 
 
 # ======================= 收货地址接口 (2 + 3 + 2 = 7分) ======================= #
@@ -731,20 +2139,15 @@ def create_address(user_id, name, phone, location):
     :param location: 收件人地址
     :return: 如果添加成功，返回True；否则返回False
     """
-    conn = get_db_conn()
-    cursor = conn.cursor()
+    return _run_update(_create_address_statement(user_id, name, phone, location))
+
+
+def _create_address_statement(user_id, name, phone, location):
     query = 'insert into "Address" (user_id, name, phone, location) values (%s, %s, %s, %s)'
-    cursor.execute(query, (user_id, name, phone, location))
-    if cursor.rowcount == 1:
-        conn.commit()
-        conn.close()
-        return True
-    else:
-        conn.rollback()
-        conn.close()
-        return False
+    return query, (user_id, name, phone, location), [('get_address_list', user_id)]
 
 
+@cached
 def get_address_list(user_id):
     """
     功能：获取某用户的收货地址列表
@@ -756,21 +2159,16 @@ def get_address_list(user_id):
         phone: 收件人手机号
         location: 收件人地址
     """
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    query = 'select id, name, phone, location from "Address" where user_id = %s'
-    cursor.execute(query, (user_id,))
-    result = cursor.fetchall()
-    conn.close()
-    if result is None:
-        return None
-    else:
-        return [{
-            'id': result[0],
-            'name': result[1],
-            'phone': result[2],
-            'location': result[3]
-        } for result in result]
+    return _run_query(_get_address_list_statement(user_id))
+
+
+def _get_address_list_statement(user_id):
+    return 'select id, name, phone, location from "Address" where user_id = %s', (user_id,), _all(lambda row: {
+        'id': row[0],
+        'name': row[1],
+        'phone': row[2],
+        'location': row[3]
+    })
 
 
 def delete_address(user_id, address_id):
@@ -781,21 +2179,173 @@ def delete_address(user_id, address_id):
     :param address_id: 收货地址id
     :return: 如果删除成功，返回True；否则返回False
     """
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    query = 'delete from "Address" where id = %s and user_id = %s'
     try:
-        cursor.execute(query, (address_id, user_id))
+        return _run_update(_delete_address_statement(user_id, address_id))
     except Exception as e:
         print(e)
-        conn.rollback()
-        conn.close()
         return e
-    if cursor.rowcount == 1:
-        conn.commit()
-        conn.close()
-        return True
-    else:
-        conn.rollback()
-        conn.close()
-        return False
+
+
+def _delete_address_statement(user_id, address_id):
+    return 'delete from "Address" where id = %s and user_id = %s', (address_id, user_id), \
+        [('get_address_list', user_id)]
+
+
+# ======================= 页面接口 ======================= #
+
+def get_goods_detail_page(goods_id, user_id, comment_order='asc', comment_cursor=None):
+    """
+    功能：一次查询获取商品详情页需要的全部数据，等价于依次调用get_goods_detail、get_user_info、get_comment_page和
+    get_order_by_user_and_goods，但只需要一次数据库往返。
+    :param goods_id: 要获取的商品id
+    :param user_id: 当前浏览的用户id
+    :param comment_order: 评论的排序方式，asc表示时间升序，desc表示时间降序，其他值按asc处理
+    :param comment_cursor: 评论的翻页游标，同get_comment_page
+    :return: (goods, owner, comment_page, order)，各项与上述四个函数的返回值相同，goods另有comments_version字段
+        （同get_goods_versions，用于/events判断页面读取之后评论是否改变）；商品不存在时返回(None, None, None, None)
+    """
+    return _run_query(_get_goods_detail_page_statement(goods_id, user_id, comment_order, comment_cursor))
+
+
+def _get_goods_detail_page_statement(goods_id, user_id, comment_order, comment_cursor):
+    position = _decode_cursor(comment_cursor, datetime.datetime.fromisoformat, int)
+    query = 'select g.name, g.description, g.img, g.price, g.exempt_postage, g.owner, u.username, ' \
+            'u.sale_count, g.apply_count, not g.on_sale, o.id, o.state, g.comment_count, %s, g.thumbnails, ' \
+            'goods_comments_version(g.id) ' \
+            'from "Goods" g left outer join "User" u on g.owner = u.id ' \
+            'left outer join lateral (select id, state from "Order" where user_id = %%(user_id)s and goods_id = g.id ' \
+            'limit 1) o on true ' \
+            'where g.id = %%(goods_id)s' % _comments_query(comment_order, position)
+    params = _comments_params(goods_id, position, COMMENT_PAGE_SIZE)
+    params['user_id'] = user_id
+
+    def result(rows):
+        if not rows:
+            return None, None, None, None
+        row = rows[0]
+        goods = {
+            'name': row[0],
+            'description': row[1],
+            'img': row[2],
+            'price': row[3],
+            'exempt_postage': row[4],
+            'owner': row[5],
+            'id': goods_id,
+            'apply_count': row[8],
+            'off_sale': row[9],
+            'thumbnails': row[14],
+            'comments_version': row[15]
+        }
+        owner = None if row[6] is None else {
+            'username': row[6],
+            'sale_count': row[7]
+        }
+        order = None if row[10] is None else {
+            'id': row[10],
+            'state': row[11]
+        }
+        return goods, owner, _comment_page(row[12], row[13], COMMENT_PAGE_SIZE, position), order
+
+    return query, params, result
+
+
+def get_manage_order_page(user_id, from_state=None, from_cursor=None, to_state=None, to_cursor=None,
+                          page_size=ORDER_PAGE_SIZE):
+    """
+    功能：一次查询获取订单管理页需要的全部数据，包括分页的get_orders_from_user、get_orders_to_user和get_address_list，
+    但只需要一次数据库往返。两个订单列表分别按订单id从新到旧进行keyset分页，每页的查询代价与订单总数无关。
+    :param user_id: 当前用户id
+    :param from_state: 只显示该状态的我发起的订单，为None或无效值时显示全部状态
+    :param from_cursor: 我发起的订单的翻页游标，取值为上一次返回的next_cursor或prev_cursor
+    :param to_state: 同from_state，用于我收到的订单
+    :param to_cursor: 同from_cursor，用于我收到的订单
+    :param page_size: 每个订单列表每页的订单数量
+    :return: dict，字段如下：
+        orders_from_user: dict，字段为orders（本页订单，每一项与get_orders_from_user相同）、next_cursor和prev_cursor
+        orders_to_user: 同orders_from_user，orders的每一项与get_orders_to_user相同
+        address_list: 与get_address_list相同
+        orders_version: 同get_user_versions，与订单列表在同一查询中读取，用于/events判断页面读取之后订单是否改变
+    """
+    return _run_query(_get_manage_order_page_statement(user_id, from_state, from_cursor, to_state, to_cursor,
+                                                       page_size))
+
+
+def _get_manage_order_page_statement(user_id, from_state, from_cursor, to_state, to_cursor, page_size):
+    from_state, to_state = _order_state(from_state), _order_state(to_state)
+    from_position, to_position = _decode_cursor(from_cursor, int), _decode_cursor(to_cursor, int)
+    query = _manage_order_query(from_state, from_position, to_state, to_position)
+    params = {'user_id': user_id, 'limit': page_size + 1, 'from_state': from_state, 'to_state': to_state}
+    if from_position is not None:
+        params['from_id'] = from_position[1]
+    if to_position is not None:
+        params['to_id'] = to_position[1]
+    return query, params, _one(lambda row: {
+        'orders_from_user': _order_page(row[0], page_size, from_position),
+        'orders_to_user': _order_page(row[1], page_size, to_position),
+        'address_list': row[2],
+        'orders_version': row[3]
+    })
+
+
+def _manage_order_query(from_state, from_position, to_state, to_position):
+    """
+    功能：生成get_manage_order_page的查询，参数为%(user_id)s、%(limit)s以及_order_page_query中的状态和订单id
+    """
+    orders_from_user = '(select o.*, g.name, g.price, g.exempt_postage from %s o join "Goods" g on o.goods_id = g.id)' \
+                       % _order_page_query('user_id', from_state, from_position, 'from')
+    orders_to_user = '(select o.*, g.name, g.price, g.exempt_postage, u.username, a.name address_name, ' \
+                     'a.phone address_phone, a.location address_location from %s o ' \
+                     'left outer join "Goods" g on o.goods_id = g.id left outer join "User" u on o.user_id = u.id ' \
+                     'left outer join "Address" a on o.address_id = a.id)' \
+                     % _order_page_query('seller', to_state, to_position, 'to')
+    return 'select (select coalesce(json_agg(json_build_object(\'id\', o.id, \'goods_id\', o.goods_id, ' \
+            '\'name\', o.name, \'state\', o.state, \'price\', o.price::text, \'exempt_postage\', o.exempt_postage, ' \
+            '\'express_code\', o.express_code, \'express_company\', o.express_company)), \'[]\') from %s o), ' \
+            '(select coalesce(json_agg(json_build_object(\'id\', o.id, \'user_id\', o.user_id, ' \
+            '\'goods_id\', o.goods_id, \'name\', o.name, \'state\', o.state, \'price\', o.price::text, ' \
+            '\'exempt_postage\', o.exempt_postage, \'username\', o.username, \'address_name\', o.address_name, ' \
+            '\'address_phone\', o.address_phone, \'address_location\', o.address_location)), \'[]\') from %s o), ' \
+            '(select coalesce(json_agg(json_build_object(\'id\', id, \'name\', name, \'phone\', phone, ' \
+            '\'location\', location) order by id), \'[]\') from "Address" where user_id = %%(user_id)s), ' \
+            'user_orders_version(%%(user_id)s)' % (orders_from_user, orders_to_user)
+
+
+def _order_state(state):
+    # 订单状态筛选参数，只接受ORDER_STATE_MAP中的状态
+    try:
+        state = int(state)
+    except (TypeError, ValueError):
+        return None
+    return state if state in ORDER_STATE_MAP else None
+
+
+def _order_page_query(column, state, position, prefix):
+    """
+    功能：生成按订单id从新到旧进行keyset分页的子查询，结果按翻页方向排序
+    :param column: 筛选订单的字段，user_id（我发起的订单）或seller（我收到的订单），值为参数%(user_id)s
+    :param state: 订单状态，为None时不筛选，值为参数%(<prefix>_state)s
+    :param position: _decode_cursor的返回值，订单id为参数%(<prefix>_id)s
+    :param prefix: 参数名前缀
+    """
+    backward = position is not None and position[0] == 'prev'
+    where = '%s = %%(user_id)s' % column
+    if state is not None:
+        where += ' and state = %%(%s_state)s' % prefix
+    if position is not None:
+        where += ' and id %s %%(%s_id)s' % ('>' if backward else '<', prefix)
+    return '(select * from "Order" where %s order by id %s limit %%(limit)s)' % (where, 'asc' if backward else 'desc')
+
+
+def _order_page(orders, page_size, position):
+    """
+    功能：将_order_page_query的结果整理为订单列表的一页
+    """
+    orders.sort(key=lambda order: order['id'], reverse=position is None or position[0] != 'prev')
+    orders, next_cursor, prev_cursor = _keyset_page(orders, page_size, position, lambda order: (order['id'],))
+    for order in orders:
+        order['price'] = Decimal(order['price']) if order['price'] is not None else None
+    return {
+        'orders': orders,
+        'next_cursor': next_cursor,
+        'prev_cursor': prev_cursor
+    }
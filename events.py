@@ -0,0 +1,185 @@
+# ===================================================================================================
+# Dependencies
+# ===================================================================================================
+import asyncio
+import queue
+import threading
+
+# ===================================================================================================
+# Event fan-out
+# ===================================================================================================
+RESET = {'type': 'reset'}  # 订阅者可能错过了事件，应重新读取全部数据
+
+
+class Subscription:
+    """
+    一个客户端的订阅，事件放在有界队列中，由处理该客户端请求的线程读取。
+    """
+
+    def __init__(self, hub, topics, max_events):
+        self.hub = hub
+        self.topics = frozenset(topics)
+        self._queue = queue.Queue(max_events)
+        self._put_lock = threading.Lock()  # 发布线程和处理请求的线程都会调用put
+
+    def get(self, timeout):
+        """
+        功能：等待下一个事件
+        :param timeout: 最多等待的秒数
+        :return: 事件dict；超时返回None
+        """
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def put(self, event):
+        """
+        功能：放入一个事件，不会阻塞。队列已满时丢弃队列中的全部事件，只放入RESET。
+        可以在多个线程中同时调用，清空队列和放入RESET之间不会有其他线程放入事件。
+        :return: 是否丢弃了事件
+        """
+        with self._put_lock:
+            try:
+                self._queue.put_nowait(event)
+                return False
+            except queue.Full:
+                pass
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._queue.put_nowait(RESET)
+            return True
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class AsyncSubscription(Subscription):
+    """
+    在asyncio事件循环中读取的订阅。put仍然可以在任何线程中调用，放入事件后唤醒事件循环中等待的get。
+    """
+
+    def __init__(self, hub, topics, max_events, loop):
+        super().__init__(hub, topics, max_events)
+        self._loop = loop
+        self._ready = asyncio.Event()
+
+    def put(self, event):
+        dropped = super().put(event)
+        try:
+            self._loop.call_soon_threadsafe(self._ready.set)
+        except RuntimeError:  # 事件循环已关闭，没有人再读取
+            pass
+        return dropped
+
+    async def get(self, timeout):
+        """
+        功能：等待下一个事件，只能在创建订阅的事件循环中调用
+        :param timeout: 最多等待的秒数
+        :return: 事件dict；超时返回None
+        """
+        while True:
+            try:
+                return self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            self._ready.clear()
+            try:  # 清除之后再检查一次，之后放入的事件一定会再次唤醒
+                return self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+
+
+class EventHub:
+    """
+    线程安全的进程内事件分发。每个事件发往若干topic，放入订阅了其中任一topic的每个订阅者的队列，每个订阅者只收到一次。
+    发布者不会被处理缓慢的订阅者阻塞：订阅者的队列满时它的事件被替换为一个RESET。
+    """
+
+    def __init__(self, max_events):
+        self.max_events = max_events  # 每个订阅者最多积压的事件数
+        self._lock = threading.Lock()
+        self._topics = {}  # topic -> set(Subscription)
+        self._subscriptions = set()
+        self._stats = {'published': 0, 'delivered': 0, 'dropped': 0, 'resets': 0}
+
+    def subscribe(self, topics, loop=None):
+        """
+        功能：订阅若干topic，使用完毕后必须调用返回值的close
+        :param topics: topic的可迭代对象，topic为可哈希的值
+        :param loop: 不为None时返回在该asyncio事件循环中读取的AsyncSubscription
+        :return: Subscription或AsyncSubscription
+        """
+        if loop is None:
+            subscription = Subscription(self, topics, self.max_events)
+        else:
+            subscription = AsyncSubscription(self, topics, self.max_events, loop)
+        with self._lock:
+            self._subscriptions.add(subscription)
+            for topic in subscription.topics:
+                self._topics.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        功能：取消订阅，重复调用时忽略
+        """
+        with self._lock:
+            if subscription not in self._subscriptions:
+                return
+            self._subscriptions.remove(subscription)
+            for topic in subscription.topics:
+                subscribers = self._topics[topic]
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._topics[topic]
+
+    def publish(self, topics, event):
+        """
+        功能：发布事件
+        :param topics: 事件发往的topic list
+        :param event: 事件dict，订阅者不应修改
+        :return: 收到事件的订阅者数
+        """
+        with self._lock:
+            subscribers = set()
+            for topic in topics:
+                subscribers.update(self._topics.get(topic, ()))
+            self._stats['published'] += 1
+            for subscription in subscribers:
+                if subscription.put(event):
+                    self._stats['dropped'] += 1
+                else:
+                    self._stats['delivered'] += 1
+        return len(subscribers)
+
+    def reset(self):
+        """
+        功能：向全部订阅者发送RESET，用于事件来源中断之后
+        """
+        with self._lock:
+            self._stats['resets'] += 1
+            for subscription in self._subscriptions:
+                subscription.put(RESET)
+
+    def stats(self):
+        """
+        功能：获取统计信息
+        :return: dict，字段如下：
+            published: 发布的事件数
+            delivered: 放入订阅者队列的事件数
+            dropped: 因订阅者队列已满而丢弃的次数
+            resets: reset的调用次数
+            subscribers: 当前订阅者数
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['subscribers'] = len(self._subscriptions)
+        return stats
@@ -0,0 +1,198 @@
+# ===================================================================================================
+# Dependencies
+# ===================================================================================================
+import concurrent.futures
+import glob
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures.process import BrokenProcessPool
+
+# ===================================================================================================
+# Content-addressed storage
+# ===================================================================================================
+CONTENT_DIR = 'content'  # 按内容命名的图片目录，位于图片目录下
+MAX_IMAGE_BYTES = 10 * 1024 * 1024  # 单张图片的大小上限
+CHUNK_SIZE = 64 * 1024  # 写入图片时每次读取的字节数
+
+
+def content_name(digest, filename):
+    """
+    功能：按内容命名的图片相对于CONTENT_DIR的路径，前两位摘要作为子目录，扩展名取自上传的文件名
+    :param digest: 图片内容的SHA-256，十六进制
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if not extension[1:].isalnum() or len(extension) > 8:
+        extension = ''
+    return '%s/%s%s' % (digest[:2], digest, extension)
+
+
+def receive_image(stream, directory, max_bytes=MAX_IMAGE_BYTES):
+    """
+    功能：将上传的图片分块写入directory中的临时文件，同时计算SHA-256，内存占用与图片大小无关
+    :param stream: 上传文件的二进制流
+    :param directory: 图片目录，临时文件与图片在同一文件系统中，可以直接改名
+    :return: (临时文件路径, SHA-256的十六进制摘要, 字节数)
+    :raise ValueError: 图片超过max_bytes，临时文件已删除
+    """
+    os.makedirs(directory, exist_ok=True)
+    digest, size = hashlib.sha256(), 0
+    fd, temp = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ValueError('图片不能超过%dMB' % (max_bytes // (1024 * 1024)))
+                digest.update(chunk)
+                file.write(chunk)
+    except BaseException:
+        os.remove(temp)
+        raise
+    return temp, digest.hexdigest(), size
+
+
+def store_image(temp, path):
+    """
+    功能：将receive_image写入的临时文件保存为path。相同内容的图片已经存在时只删除临时文件。
+    应在register_image之后调用，此后图片不会被collect_images回收。
+    :return: 是否写入了新文件
+    """
+    if os.path.exists(path):
+        os.remove(temp)
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(temp, path)
+    return True
+
+
+def remove_image(path):
+    """
+    功能：删除图片文件和它的缩略图，文件不存在时忽略
+    """
+    directory, filename = os.path.split(path)
+    pattern = glob.escape(os.path.join(directory, THUMBNAIL_DIR, os.path.splitext(filename)[0])) + '_*.webp'
+    for file in [path] + glob.glob(pattern):
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+
+
+# ===================================================================================================
+# Thumbnails
+# ===================================================================================================
+THUMBNAIL_DIR = 'thumbnails'  # 缩略图目录，位于原图所在目录下
+THUMBNAIL_WIDTHS = (256, 512, 1024)  # 缩略图宽度：商品卡片、详情页及其高分辨率屏幕
+THUMBNAIL_QUALITY = 80  # WebP压缩质量
+THUMBNAIL_WORKERS = 2  # 生成缩略图的进程数
+
+logger = logging.getLogger('images')
+
+
+def thumbnail_name(filename, width, digest):
+    """
+    功能：原图文件名对应的缩略图文件名。文件名包含缩略图内容的摘要，重新生成出不同的内容时文件名随之改变，
+    因此缩略图与原图一样可以按内容不变缓存。
+    :param digest: 缩略图内容的SHA-256，十六进制
+    """
+    return '%s_%d.%s.webp' % (os.path.splitext(filename)[0], width, digest[:16])
+
+
+def make_thumbnails(source, directory, widths=THUMBNAIL_WIDTHS, quality=THUMBNAIL_QUALITY):
+    """
+    功能：将source缩放为若干宽度的WebP缩略图，保持宽高比，不放大原图。在进程池的子进程中执行。
+    :param source: 原图路径
+    :param directory: 缩略图目录
+    :param widths: 缩略图宽度，大于原图宽度的按原图宽度生成
+    :return: [(宽度, 缩略图文件名)...]，按宽度升序
+    """
+    from PIL import Image, ImageOps
+
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.basename(source)
+    thumbnails = []
+    with Image.open(source) as image:
+        image.draft('RGB', (max(widths), max(widths)))  # JPEG直接按缩小的比例解码
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+        for width in sorted({min(width, image.width) for width in widths}):
+            height = max(1, round(image.height * width / image.width))
+            thumbnail = image.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+            buffer = io.BytesIO()
+            thumbnail.save(buffer, 'WEBP', quality=quality, method=4)
+            data = buffer.getvalue()
+            path = os.path.join(directory, thumbnail_name(filename, width, hashlib.sha256(data).hexdigest()))
+            if not os.path.exists(path):
+                temp = '%s.%d.tmp' % (path, os.getpid())  # 同一图片可能同时在多个进程中生成
+                with open(temp, 'wb') as file:
+                    file.write(data)
+                os.replace(temp, path)
+            thumbnails.append((width, os.path.basename(path)))
+    return thumbnails
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    功能：获取生成缩略图的进程池，第一次调用时创建。子进程以spawn方式启动，不继承父进程的数据库连接和线程。
+    :return: concurrent.futures.ProcessPoolExecutor
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ProcessPoolExecutor(THUMBNAIL_WORKERS,
+                                                           mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def _discard_pool(pool):
+    # 子进程异常退出后进程池不再可用，下一次get_pool重新创建
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def submit(source, directory, callback):
+    """
+    功能：在后台生成source的缩略图，不等待结果
+    :param source: 原图路径
+    :param directory: 缩略图目录
+    :param callback: 生成成功后以make_thumbnails的返回值调用，在进程池的后台线程中执行；生成失败时只记录日志
+    :return: concurrent.futures.Future
+    """
+    pool = get_pool()
+    try:
+        future = pool.submit(make_thumbnails, source, directory)
+    except BrokenProcessPool:
+        _discard_pool(pool)
+        pool = get_pool()
+        future = pool.submit(make_thumbnails, source, directory)
+
+    def done(future):
+        try:
+            thumbnails = future.result()
+        except BrokenProcessPool:
+            logger.error('生成缩略图的进程异常退出：%s', source)
+            _discard_pool(pool)
+            return
+        except Exception:
+            logger.exception('生成缩略图失败：%s', source)
+            return
+        try:
+            callback(thumbnails)
+        except Exception:
+            logger.exception('记录缩略图失败：%s', source)
+
+    future.add_done_callback(done)
+    return future
@@ -1,23 +1,391 @@
+import concurrent.futures
+import csv
+import hashlib
+import io
+import json
+import mimetypes
 import os
+import threading
+import time
 from functools import wraps
-from uuid import uuid4
+from urllib.parse import quote, unquote
 
+import click
 from flask import Flask
 from flask import render_template
-from flask import request, session, url_for, redirect
+from flask import request, session, url_for, redirect, jsonify, g, Response, send_from_directory, abort
+from markupsafe import Markup
+from werkzeug.datastructures import FileStorage
+from werkzeug.security import safe_join
 
+import assets
 import db_api
+import images
+import metrics
+from cache import TTLCache
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'Database Concept (2022)'
 
+REQUEST_SECONDS = db_api.METRICS.histogram('tp_request_duration_seconds', '请求的处理时间', ('route', 'method'))
+REQUEST_QUERIES = db_api.METRICS.histogram('tp_request_queries', '每个请求执行的语句数', ('route',),
+                                           metrics.COUNT_BUCKETS)
+REQUEST_CONNECTIONS = db_api.METRICS.histogram('tp_request_connections', '每个请求从连接池借出连接的次数', ('route',),
+                                               metrics.COUNT_BUCKETS)
+REQUEST_CONNECTS = db_api.METRICS.histogram('tp_request_connects', '每个请求新建的数据库连接数', ('route',),
+                                            metrics.COUNT_BUCKETS)
+REQUEST_DB_SECONDS = db_api.METRICS.histogram('tp_request_db_seconds', '每个请求执行语句的总时间', ('route',))
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600  # 秒，内容不会改变的静态文件（带指纹的资源、按内容命名的图片及其缩略图）的缓存时间
+IMMUTABLE_PREFIXES = (assets.DIST_DIR + '/', 'images/%s/' % images.CONTENT_DIR)  # 这些静态文件的内容不会改变
+ASSET_MANIFEST = assets.load_manifest(app.static_folder)  # flask build-assets生成，为空时直接使用原文件
+REQUEST_ROWS = db_api.METRICS.histogram('tp_request_rows', '每个请求读取的行数', ('route',), metrics.COUNT_BUCKETS)
+FRAGMENT_CACHE_MAX_ENTRIES = 8192  # 最多缓存的页面片段数
+FRAGMENT_CACHE_MAX_BYTES = 32 * 1024 * 1024  # 页面片段的总字节数上限
+FRAGMENT_CACHE_TTL = 3600  # 秒，片段的键包含商品版本，不会读到旧内容，过期只用于释放不再使用的条目
+FRAGMENTS = TTLCache(FRAGMENT_CACHE_MAX_ENTRIES, FRAGMENT_CACHE_MAX_BYTES, FRAGMENT_CACHE_TTL)
+API_VERSION = 'v1'  # JSON接口的版本，是路径前缀和ETag的一部分，返回格式不兼容地改变时增加
+API_PREFIX = '/api/' + API_VERSION
+API_ETAG_LENGTH = 32  # ETag中摘要的长度
+EVENT_HEARTBEAT = 15  # 秒，/events没有事件时发送注释行的间隔，用于保持连接并及时发现已断开的客户端
+EVENT_RETRY = 3  # 秒，浏览器与/events断开后重连的间隔
+
 
 def upload_file(file):
+    """
+    保存上传的图片，文件按内容命名，相同内容的图片只保存一份。
+    :return: 图片链接，没有上传文件时返回None
+    :raise ValueError: 图片超过images.MAX_IMAGE_BYTES
+    """
     if file is None or len(file.filename) == 0:
         return None
-    filename = str(uuid4()).replace('-', '') + '_' + file.filename
-    file.save(os.path.join('static/images', filename))
-    return url_for('static', filename='images/' + filename)
+    directory = os.path.join(app.static_folder, 'images', images.CONTENT_DIR)
+    temp, digest, size = images.receive_image(file.stream, directory)
+    try:
+        filename = images.content_name(digest, file.filename)
+        img = url_for('static', filename='images/%s/%s' % (images.CONTENT_DIR, filename))
+        db_api.register_image(img, size)
+        images.store_image(temp, os.path.join(directory, filename))
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+    return img
+
+
+def static_path(img):
+    """
+    本站静态文件链接对应的文件路径，其他链接返回None。
+    """
+    prefix = app.static_url_path + '/'
+    if not img or not img.startswith(prefix):
+        return None
+    return safe_join(app.static_folder, unquote(img[len(prefix):]))
+
+
+def collect_images(grace=db_api.IMAGE_GC_GRACE):
+    """
+    回收不再被任何商品使用的图片，删除图片文件和缩略图。
+    :return: 回收的图片数
+    """
+    def remove(img):
+        path = static_path(img)
+        if path is not None:
+            images.remove_image(path)
+
+    return len(db_api.collect_images(remove, grace))
+
+
+def collect_all_images(grace=db_api.IMAGE_GC_GRACE):
+    """
+    分批回收不再被任何商品使用的图片，直到没有可回收的图片。
+    :return: 回收的图片数
+    """
+    collected = 0
+    while True:
+        removed = collect_images(grace)
+        collected += removed
+        if removed < db_api.IMAGE_GC_BATCH_SIZE:
+            return collected
+
+
+_image_collector = None  # (进程id, 单线程的ThreadPoolExecutor)，fork出的子进程创建自己的线程
+_image_collection = None  # 已提交、还未开始的后台回收
+_image_collection_lock = threading.Lock()
+
+
+def _collect_images_in_background():
+    try:
+        collect_all_images()
+    except Exception as err:
+        print(err)
+
+
+def schedule_image_collection():
+    """
+    在后台线程中回收不再被任何商品使用的图片，不等待结果，请求不占用数据库连接等待回收。
+    回收开始之前的多次调用合并为一次，它在这些调用的修改提交之后才开始，因此不会漏掉其中的图片。
+    """
+    global _image_collector, _image_collection
+    with _image_collection_lock:
+        if _image_collector is None or _image_collector[0] != os.getpid():
+            _image_collector = (os.getpid(), concurrent.futures.ThreadPoolExecutor(1, 'collect-images'))
+            _image_collection = None
+        if _image_collection is None or _image_collection.running() or _image_collection.done():
+            _image_collection = _image_collector[1].submit(_collect_images_in_background)
+
+
+def thumbnail_source(img):
+    """
+    商品图片链接对应的静态文件路径和缩略图目录，不是本站的静态文件或文件不存在时返回None。
+    """
+    path = static_path(img)
+    if path is None or not os.path.isfile(path):
+        return None
+    return path, os.path.join(os.path.dirname(path), images.THUMBNAIL_DIR)
+
+
+def record_thumbnails(img, thumbnails):
+    """
+    将images.make_thumbnails生成的缩略图文件名转换为链接，记录到使用该图片的商品。
+    """
+    base = img.rsplit('/', 1)[0] + '/' + images.THUMBNAIL_DIR + '/'
+    return db_api.set_goods_thumbnails(img, [{'width': width, 'url': base + quote(filename)}
+                                             for width, filename in thumbnails])
+
+
+def generate_thumbnails(img):
+    """
+    在后台进程池中生成商品图片的缩略图，完成后记录到使用该图片的商品，不等待结果。
+    在此之前页面显示原图，因此应在商品写入数据库之后调用。
+    """
+    source = thumbnail_source(img)
+    if source is not None:
+        images.submit(*source, lambda thumbnails: record_thumbnails(img, thumbnails))
+
+
+def generate_thumbnails_now(imgs):
+    """
+    生成并记录若干商品图片的缩略图，等待全部完成，用于命令行。
+    :return: (生成缩略图的图片数, [(图片链接, 错误信息)...])
+    """
+    futures, errors = {}, []
+    for img in imgs:
+        source = thumbnail_source(img)
+        if source is None:
+            errors.append((img, '不是本站的图片文件'))
+        else:
+            futures[images.get_pool().submit(images.make_thumbnails, *source)] = img
+    generated = 0
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            record_thumbnails(futures[future], future.result())
+            generated += 1
+        except Exception as err:
+            errors.append((futures[future], f'{type(err).__name__}: {err}'))
+    return generated, errors
+
+
+def read_shipments(file, invalid):
+    """
+    逐行读取上传的快递信息CSV文件，每行为：订单id,快递公司,快递单号，第一行可以是表头。
+    格式不正确的行号追加到invalid中。
+    """
+    reader = csv.reader(io.TextIOWrapper(file.stream, encoding='utf-8-sig', errors='replace', newline=''))
+    for row in reader:
+        row = [cell.strip() for cell in row]
+        if not any(row) or reader.line_num == 1 and not row[0].isdigit():
+            continue
+        if len(row) < 3 or not row[0].isdigit() or int(row[0]) >= 2 ** 31 or not row[1] or not row[2]:
+            invalid.append(reader.line_num)
+            continue
+        yield int(row[0]), row[1], row[2]
+
+
+def read_goods(stream, filename):
+    """
+    逐行读取批量导入的商品文件：.csv文件第一行为表头，.ndjson/.jsonl文件每行为一个JSON对象，字段见db_api.GOODS_IMPORT_FIELDS。
+    产生(行号, dict)，无法解析的行产生(行号, 错误信息)。
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='replace', newline='')
+    if filename.lower().endswith('.csv'):
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line, content in enumerate(text, 1):
+        if not content.strip():
+            continue
+        try:
+            yield line, json.loads(content)
+        except ValueError:
+            yield line, 'JSON格式不正确'
+
+
+def is_goods_file(filename):
+    return os.path.splitext(filename.lower())[1] in ('.csv', '.ndjson', '.jsonl')
+
+
+def image_resolver(files, uploaded):
+    """
+    根据文件名查找批量导入商品时上传的图片，图片在第一次被引用时保存，保存后的链接追加到uploaded中。
+    :param files: dict，文件名 -> FileStorage
+    """
+    saved = {}
+
+    def resolve_image(filename):
+        if filename not in saved:
+            saved[filename] = upload_file(files[filename]) if filename in files else None
+            if saved[filename] is not None:
+                uploaded.append(saved[filename])
+        return saved[filename]
+
+    return resolve_image
+
+
+def import_message(imported, errors):
+    message = f'已导入{imported}个商品'
+    if errors:
+        details = '；'.join(f'第{line}行：{error}' for line, error in errors[:10])
+        message += f'，{len(errors)}行导入失败（{details}{"等" if len(errors) > 10 else ""}）'
+    return message
+
+
+@app.template_filter('srcset')
+def srcset(thumbnails):
+    return ', '.join('%s %dw' % (thumbnail['url'], thumbnail['width']) for thumbnail in thumbnails)
+
+
+def render_goods_cards(template, goods_list):
+    """
+    渲染商品卡片。卡片只依赖商品本身，按(模板, 商品id, 商品版本)缓存，商品修改后版本改变，只有该商品的卡片重新渲染。
+    :param template: 卡片模板，变量goods为商品
+    :param goods_list: get_goods_page或get_goods_list_of_user返回的商品列表
+    :return: 卡片HTML的list
+    """
+    cards = []
+    for goods in goods_list:
+        key = ('goods_card', template, goods['id'], goods['version'])
+        card = FRAGMENTS.get(key)
+        if card is None:
+            card = Markup(render_template(template, goods=goods))
+            FRAGMENTS.set(key, card)
+        cards.append(card)
+    return cards
+
+
+def normalize_goods_query(key, exempt_postage, state, price):
+    """
+    将交易大厅的查询条件转换为规范形式，结果相同的查询得到相同的条件，共用缓存。
+    :return: (key, exempt_postage, state, price)
+    """
+    key = key.strip()
+    if exempt_postage not in ('yes', 'no'):
+        exempt_postage = 'all'
+    if state not in ('yes', 'no'):
+        state = 'all'
+    if price != 'desc' and (price != 'rank' or not key):
+        price = 'asc'
+    return key, exempt_postage, state, price
+
+
+def render_goods_listing(key, exempt_postage, state, price, cursor):
+    """
+    渲染交易大厅的商品列表部分（查询条件、商品卡片和翻页链接），它与当前用户无关，所有用户共用缓存。
+    缓存键包括规范化的查询条件，以及本页商品的id和版本、翻页游标，因此商品修改后不会读到旧页面，
+    页面内容相同的不同游标也共用一个条目。
+    :return: 列表部分的HTML
+    """
+    key, exempt_postage, state, price = normalize_goods_query(key, exempt_postage, state, price)
+    page = db_api.get_goods_page(key, exempt_postage, state, price, cursor)
+    fragment_key = ('goods_listing', key, exempt_postage, state, price, page['next_cursor'], page['prev_cursor'],
+                    tuple((goods['id'], goods['version']) for goods in page['goods_list']))
+    listing = FRAGMENTS.get(fragment_key)
+    if listing is None:
+        cards = render_goods_cards('goods_card.html', page['goods_list'])
+        listing = Markup(render_template('goods_listing.html', cards=cards, key=key, exempt_postage=exempt_postage,
+                                         state=state, price=price, next_cursor=page['next_cursor'],
+                                         prev_cursor=page['prev_cursor']))
+        FRAGMENTS.set(fragment_key, listing)
+    return listing
+
+
+@db_api.METRICS.collector
+def _fragment_cache_metrics():
+    collected = []
+    for key, value in FRAGMENTS.stats().items():
+        if key in ('entries', 'bytes'):
+            collected.append(('tp_fragment_cache_%s' % key, 'gauge', '页面片段缓存统计：%s' % key, value))
+        else:
+            collected.append(('tp_fragment_cache_%s_total' % key, 'counter', '页面片段缓存统计：%s' % key, value))
+    return collected
+
+
+@app.before_request
+def start_request_metrics():
+    if db_api.METRICS_ENABLED:
+        g.metrics_start = time.perf_counter()
+        g.metrics_token = metrics.start_request()
+
+
+@app.url_defaults
+def fingerprint_static(endpoint, values):
+    # url_for('static', filename=...)指向构建生成的带指纹的文件
+    if endpoint == 'static' and values.get('filename') in ASSET_MANIFEST:
+        values['filename'] = ASSET_MANIFEST[values['filename']]
+
+
+def send_static_file(filename):
+    """
+    静态文件。构建生成的文件按Accept-Encoding返回预先压缩的Brotli或gzip版本，不在请求时压缩。
+    """
+    if not filename.startswith(assets.DIST_DIR + '/'):
+        return app.send_static_file(filename)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for encoding, suffix in assets.ENCODINGS:
+        path = safe_join(app.static_folder, filename + suffix)
+        if request.accept_encodings[encoding] and path is not None and os.path.isfile(path):
+            response = send_from_directory(app.static_folder, filename + suffix, mimetype=mimetype)
+            response.content_encoding = encoding
+            break
+    else:
+        response = app.send_static_file(filename)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+app.view_functions['static'] = send_static_file
+
+
+@app.after_request
+def cache_immutable_files(response):
+    # 带指纹和按内容命名的文件内容不会改变，浏览器和CDN可以一直使用缓存而不需要再验证
+    if request.endpoint == 'static' and response.status_code in (200, 304) and \
+            request.view_args['filename'].startswith(IMMUTABLE_PREFIXES):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    token = g.pop('metrics_token', None)
+    if token is None:
+        return
+    stats = metrics.finish_request(token)
+    observe_request(request.endpoint or 'unmatched', request.method, time.perf_counter() - g.metrics_start, stats)
+
+
+def observe_request(route, method, elapsed, stats):
+    """
+    记录一个请求的耗时和metrics.finish_request返回的数据库访问统计，asgi.py中异步处理的请求也通过它记录。
+    """
+    REQUEST_SECONDS.observe(elapsed, route, method)
+    REQUEST_QUERIES.observe(stats.queries, route)
+    REQUEST_CONNECTIONS.observe(stats.connections, route)
+    REQUEST_CONNECTS.observe(stats.connects, route)
+    REQUEST_DB_SECONDS.observe(stats.db_time, route)
+    REQUEST_ROWS.observe(stats.rows, route)
 
 
 def login_required(func):
@@ -81,9 +449,9 @@ def index():
     exempt_postage = request.args.get('exempt_postage', 'all')
     state = request.args.get('state', 'all')
     price = request.args.get('price', 'asc')
-    goods_list = db_api.get_goods_list(key, exempt_postage, state, price)
-    return render_template('index.html', goods_list=goods_list, key=key, exempt_postage=exempt_postage, state=state,
-                           price=price)
+    cursor = request.args.get('cursor')
+    listing = render_goods_listing(key, exempt_postage, state, price, cursor)
+    return render_template('index.html', listing=listing)
 
 
 @app.route('/manage_goods', methods=['GET'])
@@ -93,7 +461,8 @@ def manage_goods():
     success = request.args.get('success')
     user_id = session.get('user_id')
     goods_list = db_api.get_goods_list_of_user(user_id)
-    return render_template('manage_goods.html', success=success, error=error, goods_list=goods_list)
+    cards = render_goods_cards('manage_goods_card.html', goods_list)
+    return render_template('manage_goods.html', success=success, error=error, cards=cards)
 
 
 @app.route('/add_goods', methods=['POST'])
@@ -101,29 +470,58 @@ def manage_goods():
 def add_goods():
     name = request.form.get('name', '')
     description = request.form.get('description', '')
-    img = upload_file(request.files.get('img', None))
-    if img is None:
-        img = url_for('static', filename='images/cart.jpeg')
+    try:
+        uploaded = upload_file(request.files.get('img', None))
+    except ValueError as err:
+        return redirect(url_for('manage_goods') + f'?error=添加商品失败！{err}。')
+    img = uploaded or url_for('static', filename='images/cart.jpeg')
     price = request.form.get('price', '')
     exempt_postage = request.form.get('exempt_postage', '') == 'on'
     owner = session.get('user_id')
     if db_api.create_goods(owner, name, description, img, price, exempt_postage):
+        if uploaded:
+            generate_thumbnails(uploaded)
         return redirect(url_for('manage_goods') + '?success=添加商品成功！')
     return redirect(url_for('manage_goods') + '?error=添加商品失败！参数不正确。')
 
 
+@app.route('/import_goods', methods=['POST'])
+@login_required
+def import_goods():
+    file = request.files.get('file')
+    if file is None or not is_goods_file(file.filename):
+        return redirect(url_for('manage_goods') + '?error=请选择.csv、.ndjson或.jsonl格式的商品文件！')
+    files = {image.filename: image for image in request.files.getlist('images') if image.filename}
+    owner = session.get('user_id')
+    uploaded = []
+    imported, errors = db_api.import_goods(owner, read_goods(file.stream, file.filename),
+                                           image_resolver(files, uploaded))
+    if imported:
+        for img in uploaded:
+            generate_thumbnails(img)
+    if errors:
+        return redirect(url_for('manage_goods') + f'?error={import_message(imported, errors)}！')
+    return redirect(url_for('manage_goods') + f'?success={import_message(imported, errors)}！')
+
+
 @app.route('/update_goods', methods=['POST'])
 @login_required
 def update_goods():
     name = request.form.get('name', '')
     description = request.form.get('description', '')
-    img = upload_file(request.files.get('img', None))
+    try:
+        img = upload_file(request.files.get('img', None))
+    except ValueError as err:
+        return redirect(url_for('manage_goods') + f'?error=修改商品信息失败！{err}。')
     goods_id = request.form.get('id', '')
     price = request.form.get('price', '')
     exempt_postage = request.form.get('exempt_postage', '')
     exempt_postage = exempt_postage == 'on' or exempt_postage == 'true'
     owner = session.get('user_id')
     if db_api.update_goods(owner, goods_id, name, description, img, price, exempt_postage):
+        if img is not None:
+            generate_thumbnails(img)
+            schedule_image_collection()
         return redirect(url_for('manage_goods') + '?success=修改商品信息成功！')
     return redirect(url_for('manage_goods') + '?error=修改商品信息失败！参数不正确。')
 
@@ -134,6 +532,7 @@ def delete_goods():
     goods_id = request.args.get('id', '')
     owner = session.get('user_id')
     if db_api.delete_goods(owner, goods_id):
+        schedule_image_collection()
         return redirect(url_for('manage_goods') + '?success=删除商品成功！')
     return redirect(url_for('manage_goods') + '?error=删除失败！没有权限。')
 
@@ -143,23 +542,35 @@ def delete_goods():
 def goods_detail():
     error = request.args.get('error')
     success = request.args.get('success')
-    goods_id = request.args.get('id')
-    if goods_id == '':
-        goods_id = None
-    goods = db_api.get_goods_detail(goods_id)
+    goods_id = request.args.get('id', type=int)
+    if goods_id is None:
+        abort(404)
+    comment_order = request.args.get('comment_order', 'asc')
+    goods, owner, comment_page, order = db_api.get_goods_detail_page(goods_id, session.get('user_id'), comment_order,
+                                                                     request.args.get('comment_cursor'))
     if goods is None:
         error = '错误！非法请求！该商品不存在！'
-        owner = None
-        comments = None
-        order = None
         comment_order = 'asc'
-    else:
-        owner = db_api.get_user_info(goods['owner'])
-        comment_order = request.args.get('comment_order', 'asc')
-        comments = db_api.get_comments(goods_id, comment_order)
-        order = db_api.get_order_by_user_and_goods(session.get('user_id'), goods_id)
     return render_template('goods_detail.html', error=error, success=success, goods=goods, owner=owner,
-                           comments=comments, order=order, comment_order=comment_order)
+                           comment_page=comment_page, order=order, comment_order=comment_order)
+
+
+@app.route('/comment_list', methods=['GET'])
+@login_required
+def comment_list():
+    goods_id = request.args.get('id', type=int)
+    comment_order = request.args.get('comment_order', 'asc')
+    comment_page = None
+    if goods_id is not None:
+        comment_page = db_api.get_comment_page(goods_id, comment_order, request.args.get('cursor'))
+    if comment_page is None:
+        return jsonify(error='该商品不存在！'), 404
+    next_url = None
+    if comment_page['next_cursor'] is not None:
+        next_url = url_for('comment_list', id=goods_id, comment_order=comment_order,
+                           cursor=comment_page['next_cursor'])
+    html = render_template('comment_list.html', goods_id=goods_id, comments=comment_page['comments'])
+    return jsonify(html=html, next_url=next_url, total=comment_page['total'])
 
 
 @app.route('/apply_order', methods=['GET'])
@@ -193,12 +604,24 @@ def manage_order():
     error = request.args.get('error')
     success = request.args.get('success')
     user_id = session.get('user_id')
-    orders_from_user = db_api.get_orders_from_user(user_id)
-    orders_to_user = db_api.get_orders_to_user(user_id)
-    address_list = db_api.get_address_list(user_id)
-    return render_template('manage_order.html', error=error, success=success, orders_from_user=orders_from_user,
-                           orders_to_user=orders_to_user, state_map=db_api.ORDER_STATE_MAP,
-                           state_color_map=db_api.ORDER_STATE_COLOR_MAP, **db_api.ORDER_KEYS, address_list=address_list)
+    page_args = {
+        'from_state': request.args.get('from_state', ''),
+        'from_cursor': request.args.get('from_cursor', ''),
+        'to_state': request.args.get('to_state', ''),
+        'to_cursor': request.args.get('to_cursor', ''),
+    }
+    page = db_api.get_manage_order_page(user_id, **page_args)
+
+    def page_url(**changes):
+        args = dict(page_args, **changes)
+        return url_for('manage_order', **{key: value for key, value in args.items() if value})
+
+    return render_template('manage_order.html', error=error, success=success,
+                           orders_from_user=page['orders_from_user']['orders'], from_page=page['orders_from_user'],
+                           orders_to_user=page['orders_to_user']['orders'], to_page=page['orders_to_user'],
+                           page_args=page_args, page_url=page_url, state_map=db_api.ORDER_STATE_MAP,
+                           state_color_map=db_api.ORDER_STATE_COLOR_MAP, **db_api.ORDER_KEYS,
+                           address_list=page['address_list'], orders_version=page['orders_version'])
 
 
 @app.route('/approve_order', methods=['GET'])
@@ -235,6 +658,40 @@ def deliver_goods():
     return redirect(url_for('manage_order') + f'?error=操作失败！没有权限！')
 
 
+@app.route('/approve_orders', methods=['POST'])
+@login_required
+def approve_orders():
+    user_id = session.get('user_id')
+    order_ids = request.form.getlist('order_id')
+    if not order_ids:
+        return redirect(url_for('manage_order') + '?error=请选择要同意的订单！')
+    approved = db_api.approve_orders(user_id, order_ids)
+    if len(approved) == len(order_ids):
+        return redirect(url_for('manage_order') + f'?success=已同意{len(approved)}个订单！')
+    return redirect(url_for('manage_order') + f'?error=已同意{len(approved)}个订单，{len(order_ids) - len(approved)}'
+                                              f'个订单操作失败（没有权限、状态已改变或同一商品选择了多个订单）！')
+
+
+@app.route('/deliver_orders', methods=['POST'])
+@login_required
+def deliver_orders():
+    user_id = session.get('user_id')
+    file = request.files.get('file')
+    if file is None or len(file.filename) == 0:
+        return redirect(url_for('manage_order') + '?error=请选择快递信息文件！')
+    invalid = []
+    delivered, rejected = db_api.import_shipments(user_id, read_shipments(file, invalid))
+    message = f'已发货{delivered}个订单'
+    if invalid:
+        message += f'，第{"、".join(str(line) for line in invalid[:10])}{"等" if len(invalid) > 10 else ""}行格式不正确'
+    if rejected:
+        message += f'，订单{"、".join(str(order_id) for order_id in rejected[:10])}{"等" if len(rejected) > 10 else ""}' \
+                   f'不存在、没有权限或不是待发货状态'
+    if invalid or rejected:
+        return redirect(url_for('manage_order') + f'?error={message}！')
+    return redirect(url_for('manage_order') + f'?success={message}！')
+
+
 @app.route('/finish_order/<goods_id>/<order_id>', methods=['GET'])
 @login_required
 def finish_order(goods_id, order_id):
@@ -302,6 +759,304 @@ def delete_address():
         return redirect(url_for('manage_address') + '?error=删除地址失败！没有权限。')
 
 
+@app.route('/events', methods=['GET'])
+@login_required
+def events():
+    """
+    Server-Sent Events：推送当前用户的订单状态变化（order），指定goods_id时还推送该商品的评论增删（comment），
+    事件来源断开过时推送reset。页面传入读取数据时的orders_version或comments_version，订阅之后与当前版本比较，
+    页面读取之后、订阅之前发生的变化也会推送。每个连接占用一个处理请求的线程，但不占用数据库连接。
+    """
+    user_id = session.get('user_id')
+    goods_id = request.args.get('goods_id', type=int)
+    orders_version = request.args.get('orders_version', type=int)
+    comments_version = request.args.get('comments_version')
+    subscription = db_api.subscribe_events(user_id, goods_id)
+    try:
+        if orders_version is not None:
+            versions = db_api.get_user_versions(user_id)
+            if versions is not None and versions['orders_version'] != orders_version:
+                subscription.put({'type': 'order'})
+        if goods_id is not None and comments_version is not None:
+            versions = db_api.get_goods_versions(goods_id)
+            if versions is not None and versions['comments_version'] != comments_version:
+                subscription.put({'type': 'comment', 'goods_id': goods_id})
+    except Exception:
+        subscription.close()
+        raise
+
+    def stream():
+        yield 'retry: %d\n\n' % (EVENT_RETRY * 1000)
+        while True:
+            event = subscription.get(EVENT_HEARTBEAT)
+            yield format_event(event)
+
+    response = Response(stream(), mimetype='text/event-stream')
+    response.call_on_close(subscription.close)  # 客户端断开后写入失败时关闭，生成器没有开始执行时也会调用
+    response.cache_control.no_cache = True
+    response.headers['X-Accel-Buffering'] = 'no'  # 反向代理不缓冲
+    return response
+
+
+def format_event(event):
+    """
+    一条Server-Sent Events消息，event为None时是保持连接的注释行。
+    """
+    if event is None:
+        return ': keep-alive\n\n'
+    return 'event: %s\ndata: %s\n\n' % (event['type'], json.dumps(event, separators=(',', ':')))
+
+
+def api_login_required(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if 'logged_in' not in session or not session['logged_in']:
+            return jsonify(error='请先登录！'), 401
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+def api_etag(*versions, endpoint=None):
+    """
+    由资源的版本号生成强ETag。版本号由触发器或数据库函数得到，不需要读取资源本身。
+    :param versions: 决定资源内容的版本号，按用户区分的资源应包括用户id
+    :param endpoint: 路由名，为None时使用当前请求的路由
+    """
+    digest = hashlib.sha256(repr((API_VERSION, endpoint or request.endpoint) + versions).encode('utf-8'))
+    return digest.hexdigest()[:API_ETAG_LENGTH]
+
+
+def api_json(data):
+    """
+    JSON接口返回的紧凑JSON，Decimal等类型转换为字符串。
+    """
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=str)
+
+
+def api_response(etag, load):
+    """
+    JSON接口的条件GET。If-None-Match包含etag时直接返回304，不调用load；否则返回load()的紧凑JSON。
+    etag对应的版本号应在load之前读取，这样ETag不会比返回的内容新。
+    :param load: 读取资源的函数，资源不存在时返回None
+    """
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        data = load()
+        if data is None:
+            return jsonify(error='资源不存在！'), 404
+        response = Response(api_json(data), mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+
+
+@app.route(API_PREFIX + '/login', methods=['POST'])
+def api_login():
+    fields = request.get_json(silent=True) or request.form
+    username = fields.get('username', '')
+    user_id = db_api.login(username, fields.get('password', ''))
+    if user_id is None:
+        return jsonify(error='用户名或密码错误！'), 401
+    session['logged_in'] = True
+    session['username'] = username
+    session['user_id'] = user_id
+    return jsonify(user_id=user_id, username=username)
+
+
+@app.route(API_PREFIX + '/goods', methods=['GET'])
+@api_login_required
+def api_goods_list():
+    """
+    商品列表，参数与交易大厅相同，按cursor翻页。ETag由商品列表的版本和参数生成，命中时不执行列表查询。
+    """
+    key, exempt_postage, state, price = normalize_goods_query(request.args.get('key', ''),
+                                                              request.args.get('exempt_postage', 'all'),
+                                                              request.args.get('state', 'all'),
+                                                              request.args.get('price', 'asc'))
+    cursor = request.args.get('cursor')
+    etag = api_etag(db_api.get_goods_list_version(), key, exempt_postage, state, price, cursor)
+    return api_response(etag, lambda: db_api.get_goods_page(key, exempt_postage, state, price, cursor))
+
+
+@app.route(API_PREFIX + '/goods/<int:goods_id>', methods=['GET'])
+@api_login_required
+def api_goods_detail(goods_id):
+    versions = db_api.get_goods_versions(goods_id)
+    if versions is None:
+        return jsonify(error='该商品不存在！'), 404
+    etag = api_etag(goods_id, versions['version'], versions['apply_count'])
+    return api_response(etag, lambda: db_api.get_goods_detail.uncached(goods_id))
+
+
+@app.route(API_PREFIX + '/goods/<int:goods_id>/comments', methods=['GET'])
+@api_login_required
+def api_comments(goods_id):
+    versions = db_api.get_goods_versions(goods_id)
+    if versions is None:
+        return jsonify(error='该商品不存在！'), 404
+    order, cursor = request.args.get('order', 'asc'), request.args.get('cursor')
+    etag = api_etag(goods_id, versions['comments_version'], order, cursor)
+    return api_response(etag, lambda: db_api.get_comment_page(goods_id, order, cursor))
+
+
+@app.route(API_PREFIX + '/orders', methods=['GET'])
+@api_login_required
+def api_orders():
+    """
+    我发起的订单（orders_from_user）和我收到的订单（orders_to_user），参数与订单管理页相同，两个列表分别翻页。
+    """
+    user_id = session.get('user_id')
+    versions = db_api.get_user_versions(user_id)
+    if versions is None:
+        return jsonify(error='用户不存在！'), 404
+    args = [request.args.get(name) for name in ('from_state', 'from_cursor', 'to_state', 'to_cursor')]
+
+    def load():
+        page = db_api.get_manage_order_page(user_id, *args)
+        return {'orders_from_user': page['orders_from_user'], 'orders_to_user': page['orders_to_user']}
+
+    return api_response(api_etag(user_id, versions['orders_version'], *args), load)
+
+
+@app.route(API_PREFIX + '/addresses', methods=['GET'])
+@api_login_required
+def api_addresses():
+    user_id = session.get('user_id')
+    versions = db_api.get_user_versions(user_id)
+    if versions is None:
+        return jsonify(error='用户不存在！'), 404
+    etag = api_etag(user_id, versions['addresses_version'])
+    return api_response(etag, lambda: db_api.get_address_list.uncached(user_id))
+
+
+@app.route('/cache_stats', methods=['GET'])
+@login_required
+def cache_stats():
+    return jsonify(db_api.get_cache_stats())
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Prometheus指标：每个路由的请求耗时、语句数、连接数、数据库耗时和读取行数，每个db_api函数的语句耗时和读取行数，
+    以及连接池和缓存的统计。不需要登录，部署时应只允许监控系统访问。
+    """
+    return Response(db_api.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+@app.cli.command('migrate')
+def migrate():
+    """
+    执行尚未执行的数据库迁移脚本。用法：flask --app main migrate
+    """
+    applied = db_api.apply_migrations()
+    for filename in applied:
+        print('applied', filename)
+    if not applied:
+        print('database is up to date')
+
+
+@app.cli.command('recount')
+def recount():
+    """
+    根据订单和评论重新计算用户的卖出数量、商品的想要人数、售出状态和评论数量。用法：flask --app main recount
+    """
+    print('fixed', db_api.recount_counters(), 'rows')
+
+
+@app.cli.command('slow-queries')
+@click.option('--log', 'path', default=None, help='慢查询日志文件，默认为db_api.SLOW_QUERY_LOG')
+@click.option('--sort', type=click.Choice(['total', 'count', 'max', 'mean']), default='total', help='排序字段')
+@click.option('--top', type=int, default=20, help='输出的语句形状数量')
+@click.option('--plans', is_flag=True, help='同时输出最慢一次记录的执行计划')
+def slow_queries(path, sort, top, plans):
+    """
+    按语句形状汇总慢查询日志。用法：flask --app main slow-queries [--sort total] [--top 20] [--plans]
+    """
+    report = db_api.slow_query_report(path or db_api.SLOW_QUERY_LOG, sort)
+    if not report:
+        print('no slow queries')
+    for group in report[:top]:
+        print('%8d %10.3fs total %8.3fs mean %8.3fs max  %s' % (group['count'], group['total'], group['mean'],
+                                                                 group['max'], ', '.join(group['functions'])))
+        print('    ' + group['shape'])
+        if plans and group['plan']:
+            print('\n'.join('        ' + line for line in group['plan'].splitlines()))
+
+
+@app.cli.command('import-goods')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--owner', type=int, required=True, help='商品发布者的用户id')
+@click.option('--images', type=click.Path(exists=True, file_okay=False), help='图片所在目录，默认为商品文件所在目录')
+def import_goods_command(path, owner, images):
+    """
+    从.csv、.ndjson或.jsonl文件批量导入商品，图片按文件名在图片目录中查找。用法：flask --app main import-goods <文件> --owner <用户id>
+    """
+    if not is_goods_file(path):
+        raise click.BadParameter('只支持.csv、.ndjson和.jsonl文件', param_hint='PATH')
+    if db_api.get_user_info(owner) is None:
+        raise click.BadParameter('用户不存在', param_hint='--owner')
+    images = images or os.path.dirname(os.path.abspath(path))
+    files = {name: FileStorage(open(os.path.join(images, name), 'rb'), name) for name in os.listdir(images)
+             if os.path.isfile(os.path.join(images, name))}
+    uploaded = []
+    with app.test_request_context(), open(path, 'rb') as stream:
+        try:
+            imported, errors = db_api.import_goods(owner, read_goods(stream, path), image_resolver(files, uploaded))
+        finally:
+            for file in files.values():
+                file.close()
+    for line, error in errors:
+        print(f'line {line}: {error}')
+    print(import_message(imported, errors))
+    if imported and uploaded:
+        generated, failed = generate_thumbnails_now(uploaded)
+        print(f'generated thumbnails of {generated} images, {len(failed)} failed')
+
+
+@app.cli.command('build-assets')
+def build_assets():
+    """
+    为模板引用的CSS、JS及其字体生成带指纹的文件和预压缩版本，重启后生效。用法：flask --app main build-assets
+    """
+    entries = []
+    for template in assets.ENTRY_TEMPLATES:
+        entries.extend(assets.template_assets(os.path.join(app.root_path, app.template_folder, template)))
+    results = assets.build(app.static_folder, entries)
+    for result in results:
+        sizes = ', '.join('%s %d' % (encoding, result[encoding]) for encoding, _ in assets.ENCODINGS
+                          if encoding in result)
+        print('%-60s %9d bytes  %s' % (result['asset'], result['size'], sizes))
+    print('built', len(results), 'assets')
+
+
+@app.cli.command('collect-images')
+@click.option('--grace', type=int, default=db_api.IMAGE_GC_GRACE, help='未被使用的图片至少保留的秒数')
+def collect_images_command(grace):
+    """
+    回收不再被任何商品使用的图片。修改和删除商品后会在后台自动回收，此命令用于回收宽限期内未被使用的上传。
+    用法：flask --app main collect-images [--grace 3600]
+    """
+    print('collected', collect_all_images(grace), 'images')
+
+
+@app.cli.command('thumbnails')
+@click.option('--all', 'regenerate', is_flag=True, help='重新生成全部商品图片的缩略图，默认只生成还没有缩略图的')
+def thumbnails_command(regenerate):
+    """
+    为商品图片生成缩略图，用于补充生成此前上传的图片或修改缩略图尺寸之后。用法：flask --app main thumbnails [--all]
+    """
+    generated, failed = generate_thumbnails_now(db_api.get_goods_images(missing_thumbnails=not regenerate))
+    for img, error in failed:
+        print(f'{img}: {error}')
+    print(f'generated thumbnails of {generated} images, {len(failed)} failed')
+
+
 if __name__ == '__main__':
+    db_api.apply_migrations()
     app.debug = True
     app.run(port='8000')
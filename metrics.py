@@ -0,0 +1,182 @@
+# ===================================================================================================
+# Dependencies
+# ===================================================================================================
+import bisect
+import contextvars
+import threading
+
+# ===================================================================================================
+# Metrics
+# ===================================================================================================
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000, 10000, 100000)
+
+
+def _labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    线程安全的计数器，按标签值分别计数。
+    """
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, *label_values):
+        """
+        功能：计数加amount
+        :param label_values: 标签值，顺序与labels相同
+        """
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s counter' % self.name]
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            lines.append('%s%s %s' % (self.name, _labels(self.labels, label_values), _number(value)))
+        return lines
+
+
+class Histogram:
+    """
+    线程安全的直方图，按标签值分别统计。每次observe只在对应的桶上计数，输出时再累加为Prometheus要求的累计桶。
+    """
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}  # 标签值 -> [每个桶的计数（最后一个为+Inf）, 总和]
+
+    def observe(self, value, *label_values):
+        """
+        功能：记录一个观测值
+        :param value: 观测值，例如耗时秒数
+        :param label_values: 标签值，顺序与labels相同
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            series = sorted((label_values, list(counts), total) for label_values, (counts, total)
+                            in self._series.items())
+        for label_values, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name, _labels(self.labels, label_values, 'le="%s"' % bound),
+                                                 cumulative))
+            lines.append('%s_sum%s %s' % (self.name, _labels(self.labels, label_values), _number(total)))
+            lines.append('%s_count%s %d' % (self.name, _labels(self.labels, label_values), cumulative))
+        return lines
+
+
+class Registry:
+    """
+    指标的集合，render输出全部指标的Prometheus文本格式。
+    collector为在输出时调用的函数，返回(指标名, 类型, 说明, 值)的列表，用于导出其他模块已经维护的统计信息。
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation, labels=()):
+        metric = Counter(name, documentation, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, documentation, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, func):
+        self._collectors.append(func)
+        return func
+
+    def render(self):
+        """
+        功能：输出全部指标
+        :return: Prometheus文本格式的字符串
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            for name, kind, documentation, value in collector():
+                lines.extend(['# HELP %s %s' % (name, documentation), '# TYPE %s %s' % (name, kind),
+                              '%s %s' % (name, _number(value))])
+        return '\n'.join(lines) + '\n'
+
+
+# ===================================================================================================
+# Per-request statistics
+# ===================================================================================================
+class RequestStats:
+    """
+    一个请求中的数据库访问统计：queries为执行的语句数，connections为从连接池借出连接的次数，
+    connects为新建的数据库连接数，db_time为执行语句的总秒数，rows为读取的行数。
+    """
+    __slots__ = ('queries', 'connections', 'connects', 'db_time', 'rows')
+
+    def __init__(self):
+        self.queries = 0
+        self.connections = 0
+        self.connects = 0
+        self.db_time = 0.0
+        self.rows = 0
+
+
+_request = contextvars.ContextVar('metrics_request', default=None)
+
+
+def start_request():
+    """
+    功能：开始统计当前请求的数据库访问
+    :return: 传给finish_request的token
+    """
+    return _request.set(RequestStats())
+
+
+def finish_request(token):
+    """
+    功能：结束统计当前请求的数据库访问
+    :return: RequestStats
+    """
+    stats = _request.get()
+    _request.reset(token)
+    return stats
+
+
+def current_request():
+    """
+    功能：获取当前请求的统计，不在请求中时返回None
+    :return: RequestStats或None
+    """
+    return _request.get()
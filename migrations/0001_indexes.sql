@@ -0,0 +1,22 @@
+-- Indexes for the predicates used by db_api.py
+
+-- get_goods_detail: count(*) ... where goods_id = ? and state = ?
+-- get_goods_list: goods_id in / not in (select goods_id from "Order" ...)
+-- abandon_order, approve_order: update ... where goods_id = ? and state = ?
+create index if not exists order_goods_id_state_idx on "Order" (goods_id, state);
+
+-- get_user_info: count(*) ... where user_id = ? and state = ?
+-- get_orders_from_user, get_order_by_user_and_goods
+create index if not exists order_user_id_state_idx on "Order" (user_id, state);
+
+-- delete_address: foreign key check of "Order".address_id
+create index if not exists order_address_id_idx on "Order" (address_id);
+
+-- get_goods_list_of_user, get_orders_to_user: where "Goods".owner = ?
+create index if not exists goods_owner_idx on "Goods" (owner);
+
+-- get_comments: where goods_id = ? order by create_at
+create index if not exists comment_goods_id_create_at_idx on "Comment" (goods_id, create_at);
+
+-- get_address_list: where user_id = ?
+create index if not exists address_user_id_idx on "Address" (user_id);
@@ -0,0 +1,2 @@
+-- get_goods_list, get_goods_page: order by price, id and keyset pagination on (price, id)
+create index if not exists goods_price_id_idx on "Goods" (price, id);
@@ -0,0 +1,105 @@
+-- Full-text search over "Goods".name and "Goods".description
+--
+-- The built-in text search parsers do not segment Chinese, so the text is split into
+-- lowercase latin/digit words and, for runs of CJK characters, every single character
+-- followed by the pair it starts. Latin words in a keyword match as prefixes, and the
+-- character pairs of a CJK keyword must occur at consecutive positions, so a keyword
+-- matches where it occurs as a substring.
+
+create or replace function goods_search_tokens(content text) returns text[]
+    language plpgsql
+    immutable as
+$$
+declare
+    tokens text[] := '{}';
+    run    text;
+begin
+    for run in select m[1]
+               from regexp_matches(lower(coalesce(content, '')),
+                                   '([a-z0-9]+|[㐀-䶿一-鿿豈-﫿]+)', 'g') m
+        loop
+            if run ~ '^[a-z0-9]' then
+                tokens := tokens || run;
+            else
+                for i in 1 .. char_length(run)
+                    loop
+                        tokens := tokens || substr(run, i, 1);
+                        if i < char_length(run) then
+                            tokens := tokens || substr(run, i, 2);
+                        end if;
+                    end loop;
+            end if;
+        end loop;
+    return tokens;
+end;
+$$;
+
+create or replace function goods_search_field_vector(content text, weight text) returns tsvector
+    language sql
+    immutable as
+$$
+select coalesce(array_to_string(array(select quote_literal(token) || ':' || least(position, 16383) || weight
+                                      from unnest(goods_search_tokens(content)) with ordinality t(token, position)),
+                                ' ')::tsvector, '');
+$$;
+
+create or replace function goods_search_vector(name text, description text) returns tsvector
+    language sql
+    immutable as
+$$
+select goods_search_field_vector(name, 'A') || goods_search_field_vector(description, 'B');
+$$;
+
+-- Returns null when the keyword contains no searchable characters
+create or replace function goods_search_query(keyword text) returns tsquery
+    language plpgsql
+    immutable as
+$$
+declare
+    terms text[] := '{}';
+    run   text;
+begin
+    for run in select m[1]
+               from regexp_matches(lower(coalesce(keyword, '')),
+                                   '([a-z0-9]+|[㐀-䶿一-鿿豈-﫿]+)', 'g') m
+        loop
+            if run ~ '^[a-z0-9]' then
+                terms := terms || (quote_literal(run) || ':*');
+            elsif char_length(run) = 1 then
+                terms := terms || quote_literal(run);
+            else
+                terms := terms || ('(' || array_to_string(array(select quote_literal(substr(run, i, 2))
+                                                                from generate_series(1, char_length(run) - 1) i),
+                                                          ' <2> ') || ')');
+            end if;
+        end loop;
+    if cardinality(terms) = 0 then
+        return null;
+    end if;
+    return array_to_string(terms, ' & ')::tsquery;
+end;
+$$;
+
+alter table "Goods"
+    add column if not exists search_vector tsvector;
+
+create or replace function goods_search_vector_trigger() returns trigger
+    language plpgsql as
+$$
+begin
+    new.search_vector := goods_search_vector(new.name, new.description);
+    return new;
+end;
+$$;
+
+drop trigger if exists goods_search_vector_update on "Goods";
+create trigger goods_search_vector_update
+    before insert or update of name, description
+    on "Goods"
+    for each row
+execute function goods_search_vector_trigger();
+
+update "Goods"
+set search_vector = goods_search_vector(name, description);
+
+create index if not exists goods_search_vector_idx on "Goods" using gin (search_vector);
@@ -0,0 +1,66 @@
+-- "Goods".on_sale: false once an order of the goods has been approved
+--
+-- A goods is sold while one of its orders is in ORDER_STATE_APPROVED (2), ORDER_STATE_ESTABLISHED (3),
+-- ORDER_STATE_ON_ROAD (4) or ORDER_STATE_FINISHED (5). Statement level triggers on "Order" recompute the
+-- flag for the goods touched by each statement, so get_goods_list can filter on an indexed column instead of
+-- anti-joining the whole order table.
+
+alter table "Goods"
+    add column if not exists on_sale boolean not null default true;
+
+create or replace function refresh_goods_on_sale(goods_ids int4[]) returns void
+    language sql as
+$$
+update "Goods" g
+set on_sale = s.on_sale
+from (select t.goods_id, not exists(select 1 from "Order" o where o.goods_id = t.goods_id and o.state in (2, 3, 4, 5))
+      from unnest(goods_ids) t(goods_id)) s(goods_id, on_sale)
+where g.id = s.goods_id
+  and g.on_sale is distinct from s.on_sale;
+$$;
+
+create or replace function order_refresh_goods_on_sale() returns trigger
+    language plpgsql as
+$$
+begin
+    if tg_op = 'INSERT' then
+        perform refresh_goods_on_sale(array(select distinct goods_id from new_rows));
+    elsif tg_op = 'DELETE' then
+        perform refresh_goods_on_sale(array(select distinct goods_id from old_rows));
+    else
+        perform refresh_goods_on_sale(array(select goods_id from old_rows union select goods_id from new_rows));
+    end if;
+    return null;
+end;
+$$;
+
+drop trigger if exists order_insert_goods_on_sale on "Order";
+create trigger order_insert_goods_on_sale
+    after insert
+    on "Order"
+    referencing new table as new_rows
+    for each statement
+execute function order_refresh_goods_on_sale();
+
+drop trigger if exists order_update_goods_on_sale on "Order";
+create trigger order_update_goods_on_sale
+    after update
+    on "Order"
+    referencing old table as old_rows new table as new_rows
+    for each statement
+execute function order_refresh_goods_on_sale();
+
+drop trigger if exists order_delete_goods_on_sale on "Order";
+create trigger order_delete_goods_on_sale
+    after delete
+    on "Order"
+    referencing old table as old_rows
+    for each statement
+execute function order_refresh_goods_on_sale();
+
+update "Goods" g
+set on_sale = false
+where exists(select 1 from "Order" o where o.goods_id = g.id and o.state in (2, 3, 4, 5));
+
+-- get_goods_page(state=yes/no): filter on on_sale, order by price, id
+create index if not exists goods_on_sale_price_id_idx on "Goods" (on_sale, price, id);
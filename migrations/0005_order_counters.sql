@@ -0,0 +1,134 @@
+-- "User".sale_count: number of finished orders of the goods the user owns
+-- "Goods".apply_count: number of orders of the goods in ORDER_STATE_APPLIED (1)
+--
+-- Statement level triggers on "Order" add the net change of each statement to the counters, so reading them
+-- is O(1) and an update that does not change an order's state does not write the counters at all.
+-- The sold flag is "Goods".on_sale (0004). recount_order_counters() rebuilds all three from "Order".
+
+alter table "User"
+    add column if not exists sale_count int4 not null default 0;
+
+alter table "Goods"
+    add column if not exists apply_count int4 not null default 0;
+
+create or replace function add_order_counters(old_goods int4[], old_states int4[],
+                                              new_goods int4[], new_states int4[]) returns void
+    language sql as
+$$
+with changes(goods_id, state, delta) as (select goods_id, state, -1
+                                         from unnest(old_goods, old_states) t(goods_id, state)
+                                         union all
+                                         select goods_id, state, 1
+                                         from unnest(new_goods, new_states) t(goods_id, state))
+update "Goods" g
+set apply_count = g.apply_count + s.delta
+from (select goods_id, sum(delta) from changes where state = 1 group by goods_id having sum(delta) <> 0) s(goods_id, delta)
+where g.id = s.goods_id;
+
+with changes(goods_id, state, delta) as (select goods_id, state, -1
+                                         from unnest(old_goods, old_states) t(goods_id, state)
+                                         union all
+                                         select goods_id, state, 1
+                                         from unnest(new_goods, new_states) t(goods_id, state))
+update "User" u
+set sale_count = u.sale_count + s.delta
+from (select g.owner, sum(c.delta)
+      from changes c
+               join "Goods" g on g.id = c.goods_id
+      where c.state = 5
+      group by g.owner
+      having sum(c.delta) <> 0) s(owner, delta)
+where u.id = s.owner;
+$$;
+
+create or replace function order_add_counters() returns trigger
+    language plpgsql as
+$$
+declare
+    old_goods  int4[] := '{}';
+    old_states int4[] := '{}';
+    new_goods  int4[] := '{}';
+    new_states int4[] := '{}';
+begin
+    if tg_op in ('UPDATE', 'DELETE') then
+        select coalesce(array_agg(goods_id), '{}'), coalesce(array_agg(state), '{}')
+        into old_goods, old_states
+        from old_rows;
+    end if;
+    if tg_op in ('INSERT', 'UPDATE') then
+        select coalesce(array_agg(goods_id), '{}'), coalesce(array_agg(state), '{}')
+        into new_goods, new_states
+        from new_rows;
+    end if;
+    perform add_order_counters(old_goods, old_states, new_goods, new_states);
+    return null;
+end;
+$$;
+
+drop trigger if exists order_insert_counters on "Order";
+create trigger order_insert_counters
+    after insert
+    on "Order"
+    referencing new table as new_rows
+    for each statement
+execute function order_add_counters();
+
+drop trigger if exists order_update_counters on "Order";
+create trigger order_update_counters
+    after update
+    on "Order"
+    referencing old table as old_rows new table as new_rows
+    for each statement
+execute function order_add_counters();
+
+drop trigger if exists order_delete_counters on "Order";
+create trigger order_delete_counters
+    after delete
+    on "Order"
+    referencing old table as old_rows
+    for each statement
+execute function order_add_counters();
+
+-- Rebuild sale_count, apply_count and on_sale from "Order" and return the number of rows that were wrong.
+-- "Order" is locked against writes meanwhile, so no trigger delta can interleave with the recount.
+create or replace function recount_order_counters() returns int4
+    language plpgsql as
+$$
+declare
+    fixed int4 := 0;
+    n     int4;
+begin
+    lock table "Order" in share mode;
+
+    update "User" u
+    set sale_count = s.sale_count
+    from (select u.id, count(o.id)
+          from "User" u
+                   left join "Goods" g on g.owner = u.id
+                   left join "Order" o on o.goods_id = g.id and o.state = 5
+          group by u.id) s(id, sale_count)
+    where u.id = s.id
+      and u.sale_count <> s.sale_count;
+    get diagnostics n = row_count;
+    fixed := fixed + n;
+
+    update "Goods" g
+    set apply_count = s.apply_count
+    from (select g.id, count(o.id)
+          from "Goods" g
+                   left join "Order" o on o.goods_id = g.id and o.state = 1
+          group by g.id) s(id, apply_count)
+    where g.id = s.id
+      and g.apply_count <> s.apply_count;
+    get diagnostics n = row_count;
+    fixed := fixed + n;
+
+    update "Goods" g
+    set on_sale = not g.on_sale
+    where g.on_sale = exists(select 1 from "Order" o where o.goods_id = g.id and o.state in (2, 3, 4, 5));
+    get diagnostics n = row_count;
+    return fixed + n;
+end;
+$$;
+
+select recount_order_counters();
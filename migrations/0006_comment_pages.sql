@@ -0,0 +1,87 @@
+-- Comment pages: keyset pagination over ("Comment".create_at, id) and a trigger-maintained "Goods".comment_count
+--
+-- get_comment_page seeks to (create_at, id) of the last comment shown and reads the next page from the index
+-- in either direction, so its cost does not depend on how many comments the goods has. The total shown on the
+-- page is read from comment_count instead of counting the comments.
+
+create index if not exists comment_goods_id_create_at_id_idx on "Comment" (goods_id, create_at, id);
+drop index if exists comment_goods_id_create_at_idx;
+
+alter table "Goods"
+    add column if not exists comment_count int4 not null default 0;
+
+create or replace function add_comment_counts(old_goods int4[], new_goods int4[]) returns void
+    language sql as
+$$
+update "Goods" g
+set comment_count = g.comment_count + s.delta
+from (select goods_id, sum(delta)
+      from (select goods_id, -1 from unnest(old_goods) t(goods_id)
+            union all
+            select goods_id, 1 from unnest(new_goods) t(goods_id)) c(goods_id, delta)
+      group by goods_id
+      having sum(delta) <> 0) s(goods_id, delta)
+where g.id = s.goods_id;
+$$;
+
+create or replace function comment_add_counts() returns trigger
+    language plpgsql as
+$$
+begin
+    if tg_op = 'INSERT' then
+        perform add_comment_counts('{}', array(select goods_id from new_rows));
+    elsif tg_op = 'DELETE' then
+        perform add_comment_counts(array(select goods_id from old_rows), '{}');
+    else
+        perform add_comment_counts(array(select goods_id from old_rows), array(select goods_id from new_rows));
+    end if;
+    return null;
+end;
+$$;
+
+drop trigger if exists comment_insert_counts on "Comment";
+create trigger comment_insert_counts
+    after insert
+    on "Comment"
+    referencing new table as new_rows
+    for each statement
+execute function comment_add_counts();
+
+drop trigger if exists comment_update_counts on "Comment";
+create trigger comment_update_counts
+    after update
+    on "Comment"
+    referencing old table as old_rows new table as new_rows
+    for each statement
+execute function comment_add_counts();
+
+drop trigger if exists comment_delete_counts on "Comment";
+create trigger comment_delete_counts
+    after delete
+    on "Comment"
+    referencing old table as old_rows
+    for each statement
+execute function comment_add_counts();
+
+-- Rebuild comment_count from "Comment" and return the number of rows that were wrong.
+create or replace function recount_comment_counts() returns int4
+    language plpgsql as
+$$
+declare
+    fixed int4;
+begin
+    lock table "Comment" in share mode;
+    update "Goods" g
+    set comment_count = s.comment_count
+    from (select g.id, count(c.id)
+          from "Goods" g
+                   left join "Comment" c on c.goods_id = g.id
+          group by g.id) s(id, comment_count)
+    where g.id = s.id
+      and g.comment_count <> s.comment_count;
+    get diagnostics fixed = row_count;
+    return fixed;
+end;
+$$;
+
+select recount_comment_counts();
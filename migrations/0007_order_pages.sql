@@ -0,0 +1,39 @@
+-- Order pages on manage_order: keyset pagination over "Order".id, optionally filtered by state
+--
+-- "Order".seller copies "Goods".owner of the ordered goods (goods never change owner), so the orders a seller
+-- received can be read newest first from one index instead of joining every goods of the seller to its orders
+-- and sorting them all.
+
+alter table "Order"
+    add column if not exists seller int4 references "User" (id) on delete restrict;
+
+create or replace function order_set_seller() returns trigger
+    language plpgsql as
+$$
+begin
+    select owner into new.seller from "Goods" where id = new.goods_id;
+    return new;
+end;
+$$;
+
+drop trigger if exists order_set_seller on "Order";
+create trigger order_set_seller
+    before insert or update of goods_id
+    on "Order"
+    for each row
+execute function order_set_seller();
+
+update "Order" o
+set seller = g.owner
+from "Goods" g
+where g.id = o.goods_id
+  and o.seller is distinct from g.owner;
+
+-- get_manage_order_page: orders from the user, newest first, all states or one state
+create index if not exists order_user_id_id_idx on "Order" (user_id, id);
+create index if not exists order_user_id_state_id_idx on "Order" (user_id, state, id);
+drop index if exists order_user_id_state_idx;
+
+-- get_manage_order_page: orders to the seller, newest first, all states or one state
+create index if not exists order_seller_id_idx on "Order" (seller, id);
+create index if not exists order_seller_state_id_idx on "Order" (seller, state, id);
@@ -0,0 +1,147 @@
+-- Order state machine: one function per transition, each called as a single statement by db_api
+--
+-- Every function checks the current state of the order (and of the goods) and applies the transition, or changes
+-- nothing and returns null if the transition is not allowed. On success it returns the seller of the goods.
+--
+--   order_apply      none -> ORDER_STATE_APPLIED (1)                     buyer, goods on sale, one order per buyer
+--   order_approve    APPLIED (1) -> APPROVED (2), other APPLIED -> OFF_SALE (6)      seller
+--   order_abandon    APPLIED (1), APPROVED (2), OFF_SALE (6) -> deleted              buyer
+--                    abandoning the APPROVED order puts the OFF_SALE orders back to APPLIED
+--   order_establish  APPROVED (2) -> ESTABLISHED (3), with one of the buyer's addresses   buyer
+--   order_deliver    ESTABLISHED (3) -> ON_ROAD (4), with the express company and code      seller
+--   order_finish     ON_ROAD (4) -> FINISHED (5)                                            buyer
+--
+-- Transitions that decide whether the goods is sold (apply, approve, abandon) first lock the goods row, so they
+-- run one at a time per goods. The triggers on "Order" update the same row (apply_count, on_sale) anyway. After
+-- the lock is granted each following statement sees every order committed meanwhile. Requests that are bound to
+-- fail (no order to abandon, already applied) are rejected before queueing for the lock. The others only touch
+-- their own order row. db_api commits right after the call, so locks are held for a single statement.
+
+-- At most one order per (user, goods): turns a race between two applies of the same buyer into a unique violation.
+-- Databases that already hold duplicates keep working without the index; remove the duplicates and create it by hand.
+do
+$$
+    begin
+        if exists(select 1 from "Order" group by user_id, goods_id having count(*) > 1) then
+            raise warning 'duplicate orders for the same user and goods, order_user_id_goods_id_key not created';
+        else
+            create unique index if not exists order_user_id_goods_id_key on "Order" (user_id, goods_id);
+        end if;
+    end
+$$;
+
+create or replace function order_apply(customer int4, goods int4) returns int4
+    language plpgsql as
+$$
+declare
+    seller_id int4;
+begin
+    if exists(select 1 from "Order" where user_id = customer and goods_id = goods) then
+        return null;
+    end if;
+    select owner into seller_id from "Goods" where id = goods and owner <> customer and on_sale for no key update;
+    if not found then
+        return null;
+    end if;
+    insert into "Order" (user_id, goods_id, state)
+    select customer, goods, 1
+    where not exists(select 1 from "Order" where user_id = customer and goods_id = goods);
+    if not found then
+        return null;
+    end if;
+    return seller_id;
+end;
+$$;
+
+create or replace function order_approve(seller_id int4, goods int4, target int4) returns int4
+    language plpgsql as
+$$
+begin
+    if not exists(select 1 from "Order" where id = target and goods_id = goods and state = 1) then
+        return null;
+    end if;
+    perform from "Goods" where id = goods and owner = seller_id and on_sale for no key update;
+    if not found then
+        return null;
+    end if;
+    update "Order"
+    set state = case when id = target then 2 else 6 end
+    where goods_id = goods
+      and state = 1
+      and exists(select 1 from "Order" where id = target and goods_id = goods and state = 1);
+    if not found then
+        return null;
+    end if;
+    return seller_id;
+end;
+$$;
+
+create or replace function order_abandon(customer int4, goods int4) returns int4
+    language plpgsql as
+$$
+declare
+    seller_id int4;
+    abandoned int4;
+    reopen    boolean;
+begin
+    if not exists(select 1 from "Order" where user_id = customer and goods_id = goods and state in (1, 2, 6)) then
+        return null;
+    end if;
+    select owner into seller_id from "Goods" where id = goods for no key update;
+    if not found then
+        return null;
+    end if;
+    with deleted as (delete from "Order" where user_id = customer and goods_id = goods and state in (1, 2, 6)
+        returning state)
+    select count(*), coalesce(bool_or(state = 2), false)
+    into abandoned, reopen
+    from deleted;
+    if abandoned = 0 then
+        return null;
+    end if;
+    if reopen then
+        update "Order" set state = 1 where goods_id = goods and state = 6;
+    end if;
+    return seller_id;
+end;
+$$;
+
+create or replace function order_establish(customer int4, goods int4, target int4, address int4) returns int4
+    language sql as
+$$
+update "Order"
+set state      = 3,
+    address_id = address
+where id = target
+  and user_id = customer
+  and goods_id = goods
+  and state = 2
+  and exists(select 1 from "Address" where id = address and user_id = customer)
+returning seller;
+$$;
+
+create or replace function order_deliver(seller_id int4, goods int4, target int4, code text, company text) returns int4
+    language sql as
+$$
+update "Order"
+set state           = 4,
+    express_code    = code,
+    express_company = company
+where id = target
+  and goods_id = goods
+  and seller = seller_id
+  and state = 3
+returning seller;
+$$;
+
+create or replace function order_finish(customer int4, goods int4, target int4) returns int4
+    language sql as
+$$
+update "Order"
+set state = 5
+where id = target
+  and user_id = customer
+  and goods_id = goods
+  and state = 4
+returning seller;
+$$;
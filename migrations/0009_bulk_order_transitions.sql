@@ -0,0 +1,59 @@
+-- Bulk versions of order_approve and order_deliver (0008) taking arrays, so a list of orders is handled in one call
+--
+--   order_approve_many  per goods, the smallest requested APPLIED order -> APPROVED, other APPLIED -> OFF_SALE
+--   order_deliver_many  ESTABLISHED -> ON_ROAD for each (order, express code, express company) of the seller
+--
+-- Both return the orders that were changed; requested orders that are not allowed are left untouched.
+-- order_approve_many locks the goods rows in id order, so it cannot deadlock with itself or with order_approve.
+
+create or replace function order_approve_many(seller_id int4, targets int4[])
+    returns table
+            (
+                approved_order int4,
+                approved_goods int4
+            )
+    language plpgsql as
+$$
+begin
+    perform
+    from "Goods"
+    where id in (select goods_id from "Order" where id = any (targets) and state = 1)
+      and owner = seller_id
+      and on_sale
+    order by id
+        for no key update;
+    return query
+        with chosen as (select distinct on (o.goods_id) o.id, o.goods_id
+                        from "Order" o
+                                 join "Goods" g on g.id = o.goods_id
+                        where o.id = any (targets)
+                          and o.state = 1
+                          and g.owner = seller_id
+                          and g.on_sale
+                        order by o.goods_id, o.id),
+             updated as (update "Order" o
+                 set state = case when o.id = c.id then 2 else 6 end
+                 from chosen c
+                 where o.goods_id = c.goods_id
+                   and o.state = 1
+                 returning o.id, o.goods_id, o.state)
+        select u.id, u.goods_id
+        from updated u
+        where u.state = 2;
+end;
+$$;
+
+create or replace function order_deliver_many(seller_id int4, targets int4[], codes text[], companies text[])
+    returns setof int4
+    language sql as
+$$
+update "Order" o
+set state           = 4,
+    express_code    = s.code,
+    express_company = s.company
+from unnest(targets, codes, companies) s(id, code, company)
+where o.id = s.id
+  and o.seller = seller_id
+  and o.state = 3
+returning o.id;
+$$;
@@ -0,0 +1,11 @@
+-- "Goods".thumbnails: WebP thumbnails of "Goods".img, a json list of {"width": <px>, "url": <link>} in ascending width
+--
+-- The thumbnails are generated by a background process pool after upload (images.py) and recorded on every goods
+-- using the image. The column is null until then and the pages fall back to img.
+
+alter table "Goods"
+    add column if not exists thumbnails jsonb;
+
+-- set_goods_thumbnails updates every goods using one image; create_goods and update_goods copy the thumbnails of an
+-- image that is already in use
+create index if not exists goods_img_idx on "Goods" (img);
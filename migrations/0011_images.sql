@@ -0,0 +1,94 @@
+-- "Image": uploaded goods images stored by content (images.py), one row per distinct file
+--
+-- img is the link stored in "Goods".img, derived from the SHA-256 of the file, so identical uploads share one row
+-- and one file. ref_count is the number of goods using the image. Statement level triggers on "Goods" recount the
+-- images whose goods changed, so updates that keep img (e.g. the on_sale refresh) cost nothing.
+-- collect_images deletes rows with ref_count 0 whose registered_at is older than a grace period; register_image
+-- refreshes registered_at, so a file that was just uploaded and is not yet used by a goods is never collected.
+-- Images uploaded before this migration are not in "Image" and are never collected.
+
+create table if not exists "Image"
+(
+    img           varchar(255) primary key not null,
+    size          int8                     not null,
+    ref_count     int4                     not null default 0,
+    registered_at timestamp                not null default current_timestamp
+);
+
+-- collect_images: orphans ordered by registered_at
+create index if not exists image_orphan_registered_at_idx on "Image" (registered_at) where ref_count = 0;
+
+create or replace function refresh_image_ref_counts(imgs varchar[]) returns void
+    language sql as
+$$
+update "Image" i
+set ref_count = (select count(*) from "Goods" g where g.img = i.img)
+where i.img = any (imgs);
+$$;
+
+create or replace function goods_refresh_image_ref_counts() returns trigger
+    language plpgsql as
+$$
+begin
+    if tg_op = 'INSERT' then
+        perform refresh_image_ref_counts(array(select distinct img from new_rows where img is not null));
+    elsif tg_op = 'DELETE' then
+        perform refresh_image_ref_counts(array(select distinct img from old_rows where img is not null));
+    else
+        perform refresh_image_ref_counts(array(select o.img
+                                               from old_rows o
+                                                        join new_rows n on n.id = o.id
+                                               where o.img is distinct from n.img
+                                               union
+                                               select n.img
+                                               from old_rows o
+                                                        join new_rows n on n.id = o.id
+                                               where o.img is distinct from n.img));
+    end if;
+    return null;
+end;
+$$;
+
+drop trigger if exists goods_insert_image_ref_counts on "Goods";
+create trigger goods_insert_image_ref_counts
+    after insert
+    on "Goods"
+    referencing new table as new_rows
+    for each statement
+execute function goods_refresh_image_ref_counts();
+
+drop trigger if exists goods_update_image_ref_counts on "Goods";
+create trigger goods_update_image_ref_counts
+    after update
+    on "Goods"
+    referencing old table as old_rows new table as new_rows
+    for each statement
+execute function goods_refresh_image_ref_counts();
+
+drop trigger if exists goods_delete_image_ref_counts on "Goods";
+create trigger goods_delete_image_ref_counts
+    after delete
+    on "Goods"
+    referencing old table as old_rows
+    for each statement
+execute function goods_refresh_image_ref_counts();
+
+create or replace function recount_image_ref_counts() returns int4
+    language plpgsql as
+$$
+declare
+    fixed int4;
+begin
+    lock table "Goods" in share mode;
+    update "Image" i
+    set ref_count = s.ref_count
+    from (select i.img, count(g.id)
+          from "Image" i
+                   left join "Goods" g on g.img = i.img
+          group by i.img) s(img, ref_count)
+    where i.img = s.img
+      and i.ref_count <> s.ref_count;
+    get diagnostics fixed = row_count;
+    return fixed;
+end;
+$$;
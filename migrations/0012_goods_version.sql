@@ -0,0 +1,27 @@
+-- "Goods".version: bumped whenever a column shown on a goods card changes
+--
+-- main.py caches the rendered goods cards under (goods id, version), so a card is rendered again only after the goods
+-- is edited, sold or gets its thumbnails, and stale cards are never looked up. The counters (apply_count,
+-- comment_count) are not shown on the cards and do not bump the version.
+
+alter table "Goods"
+    add column if not exists version int4 not null default 0;
+
+create or replace function goods_bump_version() returns trigger
+    language plpgsql as
+$$
+begin
+    if (new.name, new.description, new.img, new.price, new.exempt_postage, new.thumbnails, new.on_sale) is distinct from
+       (old.name, old.description, old.img, old.price, old.exempt_postage, old.thumbnails, old.on_sale) then
+        new.version := old.version + 1;
+    end if;
+    return new;
+end;
+$$;
+
+drop trigger if exists goods_version on "Goods";
+create trigger goods_version
+    before update
+    on "Goods"
+    for each row
+execute function goods_bump_version();
@@ -0,0 +1,179 @@
+-- Change stamps for the ETags of the JSON API (main.py, API_PREFIX routes)
+--
+-- "OrderChange": a row for each user whose orders (from or to the user, or the goods of such an order) changed
+-- "GoodsChange": a row for each statement that added or deleted goods or changed a goods card ("Goods".version)
+--
+--   user_orders_version(user_id)       max("OrderChange".version) of the user
+--   goods_list_version()               max("GoodsChange".version)
+--   goods_comments_version(goods_id)   "Goods".comment_count and the id of the newest comment
+--   user_addresses_version(user_id)    max(id) and count of the user's addresses (a user has a few)
+--
+-- Each stamp is one short index scan, so the API can answer If-None-Match without reading the pages, whatever the
+-- number of orders or goods. The triggers only insert change rows and never lock a "User" or "Goods" row for a stamp;
+-- order transitions keep their short single-row locks (0008). Each insert also deletes the older rows of the same
+-- keys that no other writer holds (skip locked), so the tables keep about one row per user.
+--
+-- The versions come from sequences, so a transaction that took a smaller version may commit after a larger one was
+-- read. db_api commits right after each statement, and /events still pushes such a change, so an ETag read in that
+-- instant stays valid until the next change of the same list.
+
+create table if not exists "OrderChange"
+(
+    user_id int4      not null,
+    version bigserial not null,
+    primary key (user_id, version)
+);
+
+create table if not exists "GoodsChange"
+(
+    version bigserial primary key not null
+);
+
+create or replace function record_order_changes(user_ids int4[]) returns void
+    language sql as
+$$
+with added as (
+    insert into "OrderChange" (user_id)
+        select distinct id from unnest(user_ids) t(id) where id is not null
+        returning user_id, version)
+delete
+from "OrderChange"
+where ctid in (select c.ctid
+               from "OrderChange" c
+                        join added a on a.user_id = c.user_id and c.version < a.version
+               for update of c skip locked);
+$$;
+
+create or replace function order_record_changes() returns trigger
+    language plpgsql as
+$$
+begin
+    if tg_op = 'INSERT' then
+        perform record_order_changes(array(select user_id from new_rows union select seller from new_rows));
+    elsif tg_op = 'DELETE' then
+        perform record_order_changes(array(select user_id from old_rows union select seller from old_rows));
+    else
+        perform record_order_changes(array(select user_id from old_rows
+                                           union
+                                           select seller from old_rows
+                                           union
+                                           select user_id from new_rows
+                                           union
+                                           select seller from new_rows));
+    end if;
+    return null;
+end;
+$$;
+
+drop trigger if exists order_insert_changes on "Order";
+create trigger order_insert_changes
+    after insert
+    on "Order"
+    referencing new table as new_rows
+    for each statement
+execute function order_record_changes();
+
+drop trigger if exists order_update_changes on "Order";
+create trigger order_update_changes
+    after update
+    on "Order"
+    referencing old table as old_rows new table as new_rows
+    for each statement
+execute function order_record_changes();
+
+drop trigger if exists order_delete_changes on "Order";
+create trigger order_delete_changes
+    after delete
+    on "Order"
+    referencing old table as old_rows
+    for each statement
+execute function order_record_changes();
+
+-- The order lists show the name, price and exempt_postage of the goods, the goods list every card column
+create or replace function goods_record_changes() returns trigger
+    language plpgsql as
+$$
+begin
+    if tg_op = 'UPDATE' then
+        perform record_order_changes(array(select unnest(array [o.user_id, o.seller])
+                                           from "Order" o
+                                           where o.goods_id in (select n.id
+                                                                from old_rows p
+                                                                         join new_rows n on n.id = p.id
+                                                                where (n.name, n.price, n.exempt_postage) is distinct from
+                                                                      (p.name, p.price, p.exempt_postage))));
+        if not exists(select 1 from old_rows p join new_rows n on n.id = p.id where n.version <> p.version) then
+            return null;
+        end if;
+    end if;
+    with added as (insert into "GoodsChange" default values returning version)
+    delete
+    from "GoodsChange"
+    where ctid in (select c.ctid
+                   from "GoodsChange" c
+                            join added a on c.version < a.version
+                   for update of c skip locked);
+    return null;
+end;
+$$;
+
+drop trigger if exists goods_insert_changes on "Goods";
+create trigger goods_insert_changes
+    after insert
+    on "Goods"
+    for each statement
+execute function goods_record_changes();
+
+drop trigger if exists goods_update_changes on "Goods";
+create trigger goods_update_changes
+    after update
+    on "Goods"
+    referencing old table as old_rows new table as new_rows
+    for each statement
+execute function goods_record_changes();
+
+drop trigger if exists goods_delete_changes on "Goods";
+create trigger goods_delete_changes
+    after delete
+    on "Goods"
+    for each statement
+execute function goods_record_changes();
+
+create or replace function user_orders_version(user_id int4) returns int8
+    language sql
+    stable as
+$$
+select coalesce(max(version), 0)
+from "OrderChange"
+where "OrderChange".user_id = user_orders_version.user_id;
+$$;
+
+create or replace function goods_list_version() returns int8
+    language sql
+    stable as
+$$
+select coalesce(max(version), 0)
+from "GoodsChange";
+$$;
+
+create or replace function goods_comments_version(goods_id int4) returns text
+    language sql
+    stable as
+$$
+select concat_ws('.', g.comment_count, (select c.id
+                                        from "Comment" c
+                                        where c.goods_id = g.id
+                                        order by c.create_at desc, c.id desc
+                                        limit 1))
+from "Goods" g
+where g.id = goods_comments_version.goods_id;
+$$;
+
+create or replace function user_addresses_version(user_id int4) returns text
+    language sql
+    stable as
+$$
+select concat_ws('.', coalesce(max(id), 0), count(*))
+from "Address"
+where "Address".user_id = user_addresses_version.user_id;
+$$;
@@ -0,0 +1,95 @@
+-- Order and comment events for the Server-Sent Events endpoint (main.py /events)
+--
+-- Statement level triggers send one notification per changed row on the channel trading_platform_events
+-- (db_api.EVENT_CHANNEL). Notifications are delivered only when the transaction commits. Each application process
+-- receives them on the listener connection it already keeps for cache invalidation and fans them out to its clients.
+--
+--   {"type": "order", "id", "goods_id", "user_id", "seller", "state"}   state changed, null when the order is deleted
+--   {"type": "comment", "id", "goods_id", "user_id", "deleted"}         comment added or deleted
+--
+-- Orders whose state is unchanged (e.g. express code updates) send nothing.
+
+create or replace function order_notify_events() returns trigger
+    language plpgsql as
+$$
+begin
+    if tg_op = 'INSERT' then
+        perform pg_notify('trading_platform_events',
+                          json_build_object('type', 'order', 'id', id, 'goods_id', goods_id, 'user_id', user_id,
+                                            'seller', seller, 'state', state)::text)
+        from new_rows;
+    elsif tg_op = 'DELETE' then
+        perform pg_notify('trading_platform_events',
+                          json_build_object('type', 'order', 'id', id, 'goods_id', goods_id, 'user_id', user_id,
+                                            'seller', seller, 'state', null)::text)
+        from old_rows;
+    else
+        perform pg_notify('trading_platform_events',
+                          json_build_object('type', 'order', 'id', n.id, 'goods_id', n.goods_id, 'user_id', n.user_id,
+                                            'seller', n.seller, 'state', n.state)::text)
+        from new_rows n
+                 join old_rows o on o.id = n.id
+        where n.state is distinct from o.state;
+    end if;
+    return null;
+end;
+$$;
+
+drop trigger if exists order_insert_events on "Order";
+create trigger order_insert_events
+    after insert
+    on "Order"
+    referencing new table as new_rows
+    for each statement
+execute function order_notify_events();
+
+drop trigger if exists order_update_events on "Order";
+create trigger order_update_events
+    after update
+    on "Order"
+    referencing old table as old_rows new table as new_rows
+    for each statement
+execute function order_notify_events();
+
+drop trigger if exists order_delete_events on "Order";
+create trigger order_delete_events
+    after delete
+    on "Order"
+    referencing old table as old_rows
+    for each statement
+execute function order_notify_events();
+
+create or replace function comment_notify_events() returns trigger
+    language plpgsql as
+$$
+begin
+    if tg_op = 'INSERT' then
+        perform pg_notify('trading_platform_events',
+                          json_build_object('type', 'comment', 'id', id, 'goods_id', goods_id, 'user_id', user_id,
+                                            'deleted', false)::text)
+        from new_rows;
+    else
+        perform pg_notify('trading_platform_events',
+                          json_build_object('type', 'comment', 'id', id, 'goods_id', goods_id, 'user_id', user_id,
+                                            'deleted', true)::text)
+        from old_rows;
+    end if;
+    return null;
+end;
+$$;
+
+drop trigger if exists comment_insert_events on "Comment";
+create trigger comment_insert_events
+    after insert
+    on "Comment"
+    referencing new table as new_rows
+    for each statement
+execute function comment_notify_events();
+
+drop trigger if exists comment_delete_events on "Comment";
+create trigger comment_delete_events
+    after delete
+    on "Comment"
+    referencing old table as old_rows
+    for each statement
+execute function comment_notify_events();